@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import os
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Mapping, Optional
+from uuid import UUID
+
+from app import models
+from app.database import get_sessionmaker
+
+# Audit trail of entitlement writes, kept off the write path. crud records an event once
+# its transaction has committed, which only appends to a bounded in-process queue; a
+# background task started in the app lifespan writes queued events with one multi-row
+# INSERT per batch every AUDIT_FLUSH_INTERVAL_SECONDS, or as soon as AUDIT_BATCH_SIZE
+# events are waiting. On shutdown it drains the queue before the engine is disposed.
+#
+# A full queue drops new events rather than slowing writes down; `dropped` counts them.
+# A batch that fails to insert is kept and retried on the next flush, and no new events
+# are taken meanwhile, so memory stays bounded by the queue plus one batch.
+AUDIT_ENABLED = os.getenv("AUDIT_ENABLED", "true").strip().lower() in ("1", "true", "yes", "on")
+AUDIT_QUEUE_SIZE = int(os.getenv("AUDIT_QUEUE_SIZE", "20000"))
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", "1000"))
+AUDIT_FLUSH_INTERVAL_SECONDS = float(os.getenv("AUDIT_FLUSH_INTERVAL_SECONDS", "1"))
+
+# Row columns kept in before/after
+AUDIT_STATE_COLUMNS = [column.name for column in models.Entitlement.__table__.columns]
+
+logger = logging.getLogger(__name__)
+
+
+def _jsonable(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, UUID):
+        return str(value)
+    return value
+
+
+def entitlement_state(entitlement: Any) -> Dict[str, Any]:
+    # before/after value of an ORM entitlement, or of a row or mapping with its columns
+    if isinstance(entitlement, Mapping):
+        return {name: _jsonable(entitlement[name]) for name in AUDIT_STATE_COLUMNS}
+    return {name: _jsonable(getattr(entitlement, name)) for name in AUDIT_STATE_COLUMNS}
+
+
+class AuditWriter:
+    def __init__(
+        self,
+        session_factory=None,
+        queue_size: int = AUDIT_QUEUE_SIZE,
+        batch_size: int = AUDIT_BATCH_SIZE,
+        flush_interval: float = AUDIT_FLUSH_INTERVAL_SECONDS,
+        enabled: bool = AUDIT_ENABLED,
+    ):
+        self.session_factory = session_factory # None uses the app's, looked up when needed
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.enabled = enabled
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._batch: List[dict] = [] # Taken from the queue, not yet written
+        self._wake = asyncio.Event()
+        self._stopping = False
+        self._task: Optional[asyncio.Task] = None
+        self.written = 0
+        self.batches = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def record(self, action: str, before: Optional[dict] = None, after: Optional[dict] = None) -> None:
+        # Call after commit, with entitlement_state() values; never blocks
+        if not self.enabled:
+            return
+        state = after if after is not None else before
+        event = {
+            "occurred_at": datetime.now(timezone.utc),
+            "action": action,
+            "entitlement_id": UUID(state["id"]),
+            "user_id": state["user_id"],
+            "resource_type": state["resource_type"],
+            "resource_id": state["resource_id"],
+            "actor": state.get("granted_by"),
+            "before": before,
+            "after": after,
+        }
+        try:
+            self._queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            if self.dropped == 1 or self.dropped % 1000 == 0:
+                logger.warning("Audit queue full; %d events dropped so far", self.dropped)
+            return
+        if self._queue.qsize() >= self.batch_size:
+            self._wake.set()
+
+    async def flush(self) -> int:
+        # Writes every queued event, batch_size rows per INSERT; returns the number written
+        from app import crud # crud records its writes here, so it is imported late
+
+        written = 0
+        while self._batch or not self._queue.empty():
+            if not self._batch:
+                self._batch = [self._queue.get_nowait() for _ in range(min(self.batch_size, self._queue.qsize()))]
+            async with (self.session_factory or get_sessionmaker())() as db:
+                await crud.insert_audit_events(db, self._batch)
+            written += len(self._batch)
+            self.written += len(self._batch)
+            self.batches += 1
+            self._batch = []
+        return written
+
+    async def _run(self) -> None:
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await self.flush()
+            except Exception:
+                self.errors += 1
+                logger.exception("Audit flush failed; retrying on the next flush")
+
+    def start(self) -> None:
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._run(), name="audit-writer")
+
+    async def stop(self) -> None:
+        # Lets the writer finish its current flush, then drains what is left
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wake.set()
+        await self._task
+        self._task = None
+        try:
+            await self.flush()
+        except Exception:
+            self.errors += 1
+            logger.exception("Audit drain failed; %d events lost", len(self._batch) + self._queue.qsize())
+
+    def stats(self) -> dict:
+        return {
+            "running": self._task is not None,
+            "queued": self._queue.qsize() + len(self._batch),
+            "written": self.written,
+            "batches": self.batches,
+            "dropped": self.dropped,
+            "errors": self.errors,
+        }
+
+
+audit_log = AuditWriter()
@@ -0,0 +1,120 @@
+import os
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from threading import Lock
+from typing import Dict, Hashable, Optional, Set, Tuple
+
+# In-process cache for authorization decisions served by the check endpoint.
+# Entries are evicted least-recently-used once the cache is full and expire after
+# a fixed TTL, so a stale decision can outlive a write in another worker for at
+# most DECISION_CACHE_TTL_SECONDS. Keys are (user_id, resource_type, resource_id)
+# tuples and are also indexed by user, since one wildcard or parent grant decides
+# many of a user's keys at once.
+DECISION_CACHE_MAXSIZE = int(os.getenv("DECISION_CACHE_MAXSIZE", "100000"))
+DECISION_CACHE_TTL_SECONDS = float(os.getenv("DECISION_CACHE_TTL_SECONDS", "30"))
+
+
+class DecisionCache:
+    def __init__(self, maxsize: int = DECISION_CACHE_MAXSIZE, ttl: float = DECISION_CACHE_TTL_SECONDS):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, Tuple[float, object]]" = OrderedDict()
+        self._by_user: Dict[Hashable, Set[Hashable]] = {}
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        # Bumped on every invalidation; a reader that started its lookup before a write
+        # passes the generation it saw to set() so it cannot re-cache a stale decision.
+        self.generation = 0
+
+    def get(self, key: Hashable) -> Optional[object]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(
+        self,
+        key: Hashable,
+        value: object,
+        valid_until: Optional[datetime] = None,
+        generation: Optional[int] = None,
+    ) -> None:
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+        ttl = self.ttl
+        if valid_until is not None:
+            # Never cache a decision past the moment the underlying grant expires
+            ttl = min(ttl, (valid_until - datetime.now(timezone.utc)).total_seconds())
+            if ttl <= 0:
+                return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            self._by_user.setdefault(key[0], set()).add(key)
+            while len(self._data) > self.maxsize:
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+
+    def _remove(self, key: Hashable) -> bool:
+        # Callers hold the lock
+        if self._data.pop(key, None) is None:
+            return False
+        keys = self._by_user.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_user[key[0]]
+        return True
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self.generation += 1
+            if self._remove(key):
+                self.invalidations += 1
+
+    def invalidate_user(self, user_id: Hashable) -> None:
+        with self._lock:
+            self.generation += 1
+            for key in self._by_user.pop(user_id, ()):
+                if self._data.pop(key, None) is not None:
+                    self.invalidations += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self.generation += 1
+            self.invalidations += len(self._data)
+            self._data.clear()
+            self._by_user.clear()
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+            }
+
+
+decision_cache = DecisionCache()
@@ -0,0 +1,46 @@
+import argparse
+import asyncio
+import json
+import sys
+from typing import List, Optional
+
+from app import crud
+
+# Maintenance of entitlement_counters, which backs GET /entitlements/stats:
+#
+#   python -m app.counters check     # exit status 1 if any group has drifted
+#   python -m app.counters rebuild   # recount from the entitlements table
+#
+# Every write path keeps the counters exact in its own transaction, so drift means rows
+# were changed outside this service (manual SQL, a restored backup) or the table was
+# created after entitlements already existed. A rebuild briefly blocks writes.
+
+
+async def _main(args: argparse.Namespace) -> int:
+    from .database import dispose_engine, get_sessionmaker
+
+    try:
+        async with get_sessionmaker()() as session:
+            if args.command == "rebuild":
+                groups = await crud.rebuild_counters(session)
+                print(f"rebuilt {groups} counter groups", file=sys.stderr)
+                return 0
+            drift = await crud.counter_drift(session)
+    finally:
+        await dispose_engine()
+    for group in drift:
+        print(json.dumps(group))
+    print(f"{len(drift)} counter groups drifted", file=sys.stderr)
+    return 1 if drift else 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Check or rebuild the entitlement counters behind /entitlements/stats.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("check", help="Compare the counters with the entitlements table and print drifted groups")
+    commands.add_parser("rebuild", help="Recount the counters from the entitlements table")
+    return asyncio.run(_main(parser.parse_args(argv)))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,27 +1,241 @@
-from typing import List, Optional  # Import Optional and List
+import base64
+import json
+import os
+import random
+import uuid
+from collections import Counter
+from datetime import datetime
+from typing import (Any, AsyncIterator, Dict, Iterable, List, Optional,  # Import Optional and List
+                    Sequence, Tuple)
 from uuid import UUID
 
+from pydantic import ValidationError
+from sqlalchemy import (BigInteger, Column, Float, Integer, MetaData, String,
+                        Table, and_, any_, bindparam, case, cast, delete,
+                        func, literal, not_, or_, text, true, tuple_, union_all,
+                        update)
+from sqlalchemy.dialects.postgresql import ARRAY, UUID as PG_UUID, insert
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
 from sqlalchemy.orm import selectinload
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.schema import CreateTable
 
-from . import models, schemas
+from . import models, replicas, schemas
+from .audit import AUDIT_STATE_COLUMNS, audit_log, entitlement_state
+from .cache import decision_cache
+from .metrics import track_operation
+from .singleflight import coalesce
 
 
+# Rows per multi-row INSERT/UPDATE statement in the bulk write paths
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "1000"))
+BULK_MAX_CHUNK_SIZE = 10000
+BULK_MAX_ITEMS = int(os.getenv("BULK_MAX_ITEMS", "50000"))
+
+# Rows fetched per round trip from the server-side cursor of streamed exports
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "2000"))
+
+# Resource or user IDs accepted per reverse lookup request
+LOOKUP_MAX_IDS = int(os.getenv("LOOKUP_MAX_IDS", "10000"))
+
+# Rows each entitlement counter group is spread over (see models.EntitlementCounter)
+COUNTER_SLOTS = int(os.getenv("COUNTER_SLOTS", "8"))
+
+# Past this many users it is cheaper to drop the whole decision cache than to evict one by one
+_CACHE_CLEAR_THRESHOLD = 1000
+
+# Access levels from weakest to strongest; a check returns the strongest effective one.
+# Other levels (e.g. 'use') and grants without a level still allow access, below 'read'.
+ACCESS_LEVELS = ("read", "write", "admin")
+# resource_id of a grant covering every resource of its resource_type
+WILDCARD = "*"
+
+
+# Positions in the change log are transaction ids (xid8, as bigint). Ids are handed out
+# in start order, not commit order, so a reader only trusts positions below the oldest
+# transaction still running: nothing can commit there any more.
+_CURRENT_XACT = cast(cast(func.pg_current_xact_id(), String), BigInteger)
+_SETTLED_XACT = cast(cast(func.pg_snapshot_xmin(func.pg_current_snapshot()), String), BigInteger) - 1
+
+def _write_generation() -> int:
+    # Splits coalesced reads at every write in this worker (each one bumps the decision
+    # cache generation), so a read that starts after a write never joins an older flight.
+    # Writes through other workers do not count; a read that must see one sends X-Min-LSN,
+    # which skips coalescing altogether.
+    return decision_cache.generation
+
+def _decision_key(user_id: str, resource_type: str, resource_id: str):
+    return (user_id, resource_type, resource_id)
+
+def _invalidate_decisions(keys: Iterable[tuple]) -> None:
+    # A grant can decide any of its user's keys through a wildcard or the hierarchy,
+    # so every cached decision of each affected user goes
+    users = {key[0] for key in keys}
+    if len(users) > _CACHE_CLEAR_THRESHOLD:
+        decision_cache.clear()
+        return
+    for user_id in users:
+        decision_cache.invalidate_user(user_id)
+
+async def _record_changes(db: AsyncSession, keys: Iterable[tuple]) -> None:
+    # Appends the (user_id, resource_type, resource_id) keys a write touched to the change
+    # log under the writing transaction's id; user_id None marks a resource whose
+    # ancestors changed. Nothing is locked, so writers never wait on each other here;
+    # readers only go as far as _SETTLED_XACT, see get_changes.
+    keys = list(dict.fromkeys(keys))
+    if not keys:
+        return
+    replicas.mark_written() # The response carries X-Write-LSN
+    changed = _unnest_keys(keys, "changed")
+    await db.execute(
+        insert(models.EntitlementChange).from_select(
+            ["seq", "user_id", "resource_type", "resource_id"],
+            select(_CURRENT_XACT, changed.c.user_id, changed.c.resource_type, changed.c.resource_id),
+        )
+    )
+
+def _counter_group(resource_type: str, access_level: Optional[str], is_active: Optional[bool]) -> tuple:
+    return (resource_type, access_level or "", bool(is_active))
+
+_COUNTER_COLUMNS = ["slot", "resource_type", "access_level", "is_active", "count"]
+
+async def _count_changes(db: AsyncSession, added: Iterable[tuple] = (), removed: Iterable[tuple] = ()) -> None:
+    # Applies the net change per _counter_group() to one random slot of each group, so
+    # concurrent writes to the same group rarely wait on each other's counter row
+    deltas = Counter(added)
+    deltas.subtract(removed)
+    slot = random.randrange(COUNTER_SLOTS)
+    rows = [
+        {"slot": slot, "resource_type": group[0], "access_level": group[1], "is_active": group[2], "count": count}
+        for group, count in sorted(deltas.items()) if count
+    ]
+    if not rows:
+        return
+    # A plain UPDATE covers counter rows that already exist, which is nearly always; unlike
+    # the dialect INSERT needed for ON CONFLICT it is compiled once and cached
+    counters = models.EntitlementCounter.__table__
+    keys = [counters.c[name] for name in _COUNTER_COLUMNS[:-1]]
+    source = _unnest_rows(rows, _COUNTER_COLUMNS, "deltas", counters)
+    updated = await db.execute(
+        update(counters)
+        .where(*[column == source.c[column.name] for column in keys])
+        .values(count=counters.c.count + source.c.count)
+        .returning(*keys)
+    )
+    existing = {tuple(row) for row in updated.all()}
+    missing = [row for row in rows if tuple(row[column.name] for column in keys) not in existing]
+    if not missing:
+        return
+    source = _unnest_rows(missing, _COUNTER_COLUMNS, "deltas", counters)
+    stmt = insert(counters).from_select(_COUNTER_COLUMNS, select(*[source.c[name] for name in _COUNTER_COLUMNS]))
+    await db.execute(stmt.on_conflict_do_update(
+        index_elements=keys,
+        set_={"count": counters.c.count + stmt.excluded.count},
+    ))
+
+def _chunks(items: Sequence, size: int):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def _unnest_keys(keys: Sequence[tuple], name: str):
+    # Set of (user_id, resource_type, resource_id) keys usable as a table in one statement
+    return func.unnest(
+        bindparam(f"{name}_user_ids", [key[0] for key in keys], type_=ARRAY(String)),
+        bindparam(f"{name}_resource_types", [key[1] for key in keys], type_=ARRAY(String)),
+        bindparam(f"{name}_resource_ids", [key[2] for key in keys], type_=ARRAY(String)),
+    ).table_valued("user_id", "resource_type", "resource_id").render_derived(name=name)
+
+def _grants_access(entity=models.Entitlement):
+    # A grant is in effect only while it is active and not yet expired. Every read treats
+    # an expired grant as inactive, whether or not the sweeper has deactivated it yet.
+    return and_(
+        entity.is_active, # Not IS TRUE, which would not match the partial index predicates
+        or_(entity.expires_at.is_(None), entity.expires_at > func.now()),
+    )
+
+def _matching_grants(targets, target_type, target_id, user_id, *columns):
+    # Grants of user_id covering any target, from direct entitlements and from the group
+    # expansion. Each source is joined to the targets on its own, and exact and wildcard
+    # grants separately, so every join stays an equality lookup on (user_id,
+    # resource_type, resource_id); only the matches are unioned. A single
+    # IN (target_id, '*') condition turned into a hash join over all of a user's grants
+    # for users with many of them.
+    matches = []
+    for entity in (models.Entitlement, models.GroupGrantExpansion):
+        for resource_id in (target_id, literal(WILDCARD, String)):
+            matches.append(
+                select(*columns, entity.access_level, entity.expires_at, entity.created_at)
+                .select_from(targets)
+                .join(
+                    entity,
+                    and_(
+                        entity.user_id == user_id,
+                        entity.resource_type == target_type,
+                        entity.resource_id == resource_id,
+                    ),
+                )
+                .filter(_grants_access(entity))
+            )
+    return union_all(*matches).subquery("grants")
+
+def _access_rank(access_level):
+    return case(
+        {level: rank for rank, level in enumerate(ACCESS_LEVELS, start=1)},
+        value=access_level,
+        else_=0,
+    )
+
+def _decision(key, row) -> schemas.EntitlementCheck:
+    user_id, resource_type, resource_id = key
+    return schemas.EntitlementCheck(
+        user_id=user_id,
+        resource_type=resource_type,
+        resource_id=resource_id,
+        allowed=row is not None,
+        access_level=row.access_level if row is not None else None,
+    )
+
+
+def _entitlement_columns(names: Sequence[str]):
+    # Table columns by name, with the effective is_active in place of the stored one
+    table = models.Entitlement.__table__
+    return [_grants_access().label(name) if name == "is_active" else table.c[name] for name in names]
+
+def _with_effective_state(rows) -> list:
+    # ORM grants loaded with _grants_access() as "active", showing that as is_active.
+    # Set as the loaded value, so the session does not see a change to flush.
+    grants = []
+    for grant, active in rows:
+        set_committed_value(grant, "is_active", active)
+        grants.append(grant)
+    return grants
+
+async def _adopt_entitlements(db: AsyncSession, result):
+    # Copies ORM grants loaded by a coalesced read into the follower's own session, as
+    # they were loaded (effective is_active included), without querying again. Plain rows
+    # are immutable and shared as they are.
+    if isinstance(result, models.Entitlement):
+        return await db.merge(result, load=False)
+    if isinstance(result, list) and result and isinstance(result[0], models.Entitlement):
+        return [await db.merge(grant, load=False) for grant in result]
+    return result
+
+@track_operation
+@coalesce(key=_write_generation, adopt=_adopt_entitlements)
 async def get_entitlement(db: AsyncSession, entitlement_id: UUID) -> Optional[models.Entitlement]:
-    result = await db.execute(select(models.Entitlement).filter(models.Entitlement.id == entitlement_id))
-    return result.scalars().first()
+    result = await db.execute(
+        select(models.Entitlement, _grants_access().label("active")).filter(models.Entitlement.id == entitlement_id)
+    )
+    return next(iter(_with_effective_state(result.all())), None)
 
-async def get_entitlements(
-    db: AsyncSession, 
-    skip: int = 0, 
-    limit: int = 100,
+def _filter_entitlements(
+    query,
     user_id: Optional[str] = None,
     resource_type: Optional[str] = None,
     resource_id: Optional[str] = None,
     is_active: Optional[bool] = None
-) -> List[models.Entitlement]:
-    query = select(models.Entitlement)
+):
     if user_id:
         query = query.filter(models.Entitlement.user_id == user_id)
     if resource_type:
@@ -29,43 +243,715 @@ async def get_entitlements(
     if resource_id:
         query = query.filter(models.Entitlement.resource_id == resource_id)
     if is_active is not None:
-        query = query.filter(models.Entitlement.is_active == is_active)
-    
-    result = await db.execute(query.offset(skip).limit(limit))
-    return result.scalars().all()
+        query = query.filter(_grants_access() if is_active else not_(_grants_access()))
+    return query
+
+def encode_cursor(created_at: datetime, entitlement_id: UUID) -> str:
+    # Opaque keyset position: the (created_at, id) of the last row of a page
+    raw = f"{created_at.isoformat()}|{entitlement_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[datetime, UUID]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        created_at, entitlement_id = raw.split("|")
+        return datetime.fromisoformat(created_at), UUID(entitlement_id)
+    except (ValueError, UnicodeDecodeError) as exc:
+        raise ValueError("Invalid cursor") from exc
 
+# Columns of an entitlement response, in the field order of schemas.Entitlement
+ENTITLEMENT_FIELDS = list(schemas.Entitlement.model_fields)
+
+@track_operation
+@coalesce(key=_write_generation, adopt=_adopt_entitlements)
+async def get_entitlements(
+    db: AsyncSession, 
+    skip: int = 0, 
+    limit: int = 100,
+    user_id: Optional[str] = None,
+    resource_type: Optional[str] = None,
+    resource_id: Optional[str] = None,
+    is_active: Optional[bool] = None,
+    cursor: Optional[Tuple[datetime, UUID]] = None,
+    as_rows: bool = False
+) -> List[models.Entitlement]:
+    # Rows come back in (created_at, id) order, served by ix_entitlements_created_at_id or,
+    # filtered by user or resource, by the composite index with that prefix.
+    # With a cursor the page starts right after it instead of scanning `skip` rows.
+    # as_rows returns plain rows of ENTITLEMENT_FIELDS instead of ORM objects, skipping
+    # identity-map bookkeeping for callers that only serialize the result.
+    if as_rows:
+        query = select(*_entitlement_columns(ENTITLEMENT_FIELDS))
+    else:
+        query = select(models.Entitlement, _grants_access().label("active"))
+    query = _filter_entitlements(query, user_id, resource_type, resource_id, is_active)
+    query = query.order_by(models.Entitlement.created_at, models.Entitlement.id)
+    if cursor is not None:
+        query = query.filter(tuple_(models.Entitlement.created_at, models.Entitlement.id) > tuple_(*cursor))
+    elif skip:
+        query = query.offset(skip)
+
+    result = await db.execute(query.limit(limit))
+    return result.all() if as_rows else _with_effective_state(result.all())
+
+EXPORT_COLUMNS = [column.name for column in models.Entitlement.__table__.columns]
+
+@track_operation
+async def stream_entitlements(
+    db: AsyncSession,
+    user_id: Optional[str] = None,
+    resource_type: Optional[str] = None,
+    resource_id: Optional[str] = None,
+    is_active: Optional[bool] = None,
+    batch_size: int = EXPORT_BATCH_SIZE
+) -> AsyncIterator[Sequence]:
+    # Yields batches of plain rows (EXPORT_COLUMNS order) from a server-side cursor, so
+    # memory stays bounded by batch_size whatever the number of matching rows.
+    query = _filter_entitlements(select(*_entitlement_columns(EXPORT_COLUMNS)), user_id, resource_type, resource_id, is_active)
+    result = await db.stream(query.execution_options(yield_per=batch_size))
+    async for rows in result.partitions():
+        yield rows
+
+AUDIT_COLUMNS = [column.name for column in models.EntitlementAudit.__table__.columns]
+
+@track_operation
+async def stream_audit_history(
+    db: AsyncSession,
+    user_id: Optional[str] = None,
+    resource_type: Optional[str] = None,
+    resource_id: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    batch_size: int = EXPORT_BATCH_SIZE
+) -> AsyncIterator[Sequence]:
+    # Audit events of a user and/or a resource, oldest first, as batches of plain rows
+    # (AUDIT_COLUMNS order); served by the (user_id, ...) or (resource_type, resource_id, ...)
+    # index in that order
+    audit = models.EntitlementAudit
+    query = select(*[audit.__table__.c[name] for name in AUDIT_COLUMNS])
+    if user_id:
+        query = query.filter(audit.user_id == user_id)
+    if resource_type:
+        query = query.filter(audit.resource_type == resource_type)
+    if resource_id:
+        query = query.filter(audit.resource_id == resource_id)
+    if since is not None:
+        query = query.filter(audit.occurred_at >= since)
+    if until is not None:
+        query = query.filter(audit.occurred_at < until)
+    query = query.order_by(audit.occurred_at, audit.id)
+    result = await db.stream(query.execution_options(yield_per=batch_size))
+    async for rows in result.partitions():
+        yield rows
+
+_AUDIT_INSERT_COLUMNS = [name for name in AUDIT_COLUMNS if name != "id"]
+
+@track_operation
+async def insert_audit_events(db: AsyncSession, events: Sequence[Dict[str, Any]]) -> None:
+    # One multi-row INSERT of events built by app.audit, committed on its own
+    audit = models.EntitlementAudit.__table__
+    source = _unnest_rows(events, _AUDIT_INSERT_COLUMNS, "events", audit)
+    await db.execute(insert(audit).from_select(_AUDIT_INSERT_COLUMNS, select(*[source.c[name] for name in _AUDIT_INSERT_COLUMNS])))
+    await db.commit()
+
+@track_operation
 async def create_entitlement(db: AsyncSession, entitlement: schemas.EntitlementCreate) -> models.Entitlement:
-    db_entitlement = models.Entitlement(**entitlement.dict())
+    db_entitlement = models.Entitlement(**entitlement.model_dump())
     db.add(db_entitlement)
+    await _count_changes(db, added=[_counter_group(entitlement.resource_type, entitlement.access_level, entitlement.is_active)])
+    await _record_changes(db, [_decision_key(entitlement.user_id, entitlement.resource_type, entitlement.resource_id)])
     await db.commit()
     await db.refresh(db_entitlement)
+    decision_cache.invalidate_user(db_entitlement.user_id)
+    audit_log.record("create", after=entitlement_state(db_entitlement))
     return db_entitlement
 
+class StaleEntitlementError(Exception):
+    """The entitlement exists but its version matches none of the expected ones."""
+
+async def _raise_if_exists(db: AsyncSession, entitlement_id: UUID) -> None:
+    # Only reached when a versioned write matched no row, to tell 404 from 412 apart
+    found = await db.execute(select(models.Entitlement.id).filter(models.Entitlement.id == entitlement_id))
+    if found.first() is not None:
+        raise StaleEntitlementError(entitlement_id)
+
+def _locked_copy(*criteria):
+    # The matching rows as they were before an UPDATE that joins this on id and returns
+    # _previous_columns(); locked, so nothing changes them between the read and the write
+    table = models.Entitlement.__table__
+    return select(table).filter(*criteria).with_for_update(of=table).subquery("old")
+
+def _previous_columns(old) -> list:
+    return [old.c[name].label(f"old_{name}") for name in AUDIT_STATE_COLUMNS]
+
+def _previous_state(row) -> Dict[str, Any]:
+    return entitlement_state({name: row._mapping[f"old_{name}"] for name in AUDIT_STATE_COLUMNS})
+
+@track_operation
 async def update_entitlement(
     db: AsyncSession, 
     entitlement_id: UUID, 
-    entitlement_update: schemas.EntitlementUpdate
+    entitlement_update: schemas.EntitlementUpdate,
+    expected_versions: Optional[Sequence[int]] = None
 ) -> Optional[models.Entitlement]:
-    db_entitlement = await get_entitlement(db, entitlement_id)
-    if not db_entitlement:
+    # One UPDATE ... RETURNING statement. The self-join on a locked copy of the row also
+    # returns the row as it was before the update, so both old and new decisions get
+    # evicted and the audit trail gets both states.
+    # With expected_versions the write only applies if the stored version is one of them.
+    entity = models.Entitlement
+    old = _locked_copy(entity.id == entitlement_id)
+    stmt = (
+        update(entity)
+        .where(entity.id == old.c.id)
+        .values(**entitlement_update.model_dump(exclude_unset=True), version=entity.version + 1, updated_at=func.now())
+        .returning(entity, *_previous_columns(old))
+        .execution_options(synchronize_session=False, populate_existing=True)
+    )
+    if expected_versions is not None:
+        stmt = stmt.where(entity.version.in_(expected_versions))
+    row = (await db.execute(stmt)).first()
+    if row is None:
+        if expected_versions is not None:
+            await _raise_if_exists(db, entitlement_id)
         return None
 
-    update_data = entitlement_update.dict(exclude_unset=True)
-    for key, value in update_data.items():
-        setattr(db_entitlement, key, value)
-
+    db_entitlement = row[0]
+    db.expunge(db_entitlement) # Keep the returned values; commit would expire them
+    await _count_changes(
+        db,
+        added=[_counter_group(db_entitlement.resource_type, db_entitlement.access_level, db_entitlement.is_active)],
+        removed=[_counter_group(row.old_resource_type, row.old_access_level, row.old_is_active)],
+    )
+    await _record_changes(db, [
+        _decision_key(row.old_user_id, row.old_resource_type, row.old_resource_id),
+        _decision_key(db_entitlement.user_id, db_entitlement.resource_type, db_entitlement.resource_id),
+    ])
     await db.commit()
-    await db.refresh(db_entitlement)
+    decision_cache.invalidate_user(row.old_user_id)
+    decision_cache.invalidate_user(db_entitlement.user_id)
+    audit_log.record("update", before=_previous_state(row), after=entitlement_state(db_entitlement))
     return db_entitlement
 
-async def delete_entitlement(db: AsyncSession, entitlement_id: UUID) -> Optional[models.Entitlement]:
-    db_entitlement = await get_entitlement(db, entitlement_id)
-    if not db_entitlement:
+@track_operation
+async def delete_entitlement(
+    db: AsyncSession,
+    entitlement_id: UUID,
+    expected_versions: Optional[Sequence[int]] = None
+) -> Optional[models.Entitlement]:
+    stmt = (
+        delete(models.Entitlement)
+        .where(models.Entitlement.id == entitlement_id)
+        .returning(models.Entitlement)
+        .execution_options(synchronize_session=False, populate_existing=True)
+    )
+    if expected_versions is not None:
+        stmt = stmt.where(models.Entitlement.version.in_(expected_versions))
+    db_entitlement = (await db.execute(stmt)).scalars().first()
+    if db_entitlement is None:
+        if expected_versions is not None:
+            await _raise_if_exists(db, entitlement_id)
         return None
-    await db.delete(db_entitlement)
+
+    db.expunge(db_entitlement)
+    await _count_changes(db, removed=[_counter_group(db_entitlement.resource_type, db_entitlement.access_level, db_entitlement.is_active)])
+    await _record_changes(db, [_decision_key(db_entitlement.user_id, db_entitlement.resource_type, db_entitlement.resource_id)])
     await db.commit()
+    decision_cache.invalidate_user(db_entitlement.user_id)
+    audit_log.record("delete", before=entitlement_state(db_entitlement))
     return db_entitlement
 
+@track_operation
+async def check_entitlement(
+    db: AsyncSession,
+    user_id: str,
+    resource_type: str,
+    resource_id: str
+) -> schemas.EntitlementCheck:
+    key = _decision_key(user_id, resource_type, resource_id)
+    cached = decision_cache.get(key)
+    if cached is not None:
+        return cached
+    # Concurrent misses for the same key, e.g. in a login storm, share one query
+    return await _resolve_decision(db, user_id, resource_type, resource_id)
+
+@coalesce(key=_write_generation)
+async def _resolve_decision(db: AsyncSession, user_id: str, resource_type: str, resource_id: str) -> schemas.EntitlementCheck:
+    key = _decision_key(user_id, resource_type, resource_id)
+    generation = decision_cache.generation
+    # The resource itself plus its precomputed ancestors; a direct or group grant on any
+    # of them, or a wildcard grant on any of their types, applies. One statement, index
+    # lookups only.
+    ancestors = models.ResourceAncestor
+    targets = union_all(
+        select(literal(resource_type, String).label("resource_type"), literal(resource_id, String).label("resource_id")),
+        select(ancestors.ancestor_type, ancestors.ancestor_id).filter(
+            ancestors.resource_type == resource_type, ancestors.resource_id == resource_id
+        ),
+    ).subquery("targets")
+    grants = _matching_grants(targets, targets.c.resource_type, targets.c.resource_id, user_id)
+    query = (
+        select(grants.c.access_level, grants.c.expires_at)
+        .order_by(_access_rank(grants.c.access_level).desc(), grants.c.created_at.desc())
+        .limit(1)
+    )
+    row = (await db.execute(query)).first()
+    decision = _decision(key, row)
+    decision_cache.set(key, decision, valid_until=row.expires_at if row is not None else None, generation=generation)
+    return decision
+
+@track_operation
+async def check_entitlements_batch(
+    db: AsyncSession,
+    items: Sequence[schemas.EntitlementKey]
+) -> List[schemas.EntitlementCheck]:
+    keys = [_decision_key(item.user_id, item.resource_type, item.resource_id) for item in items]
+    decisions: Dict[tuple, schemas.EntitlementCheck] = {}
+    missing = []
+    for key in dict.fromkeys(keys): # Deduplicate while keeping input order
+        cached = decision_cache.get(key)
+        if cached is not None:
+            decisions[key] = cached
+        else:
+            missing.append(key)
+
+    if missing:
+        generation = decision_cache.generation
+        # Resolve every uncached pair in one statement: an unnest() of the requested keys,
+        # expanded with each resource's ancestors, joined against the entitlements table.
+        requested = select(_unnest_keys(missing, "requested")).cte("requested")
+        ancestors = models.ResourceAncestor
+        targets = union_all(
+            select(requested, requested.c.resource_type.label("target_type"), requested.c.resource_id.label("target_id")),
+            select(requested, ancestors.ancestor_type, ancestors.ancestor_id).join(
+                ancestors,
+                and_(ancestors.resource_type == requested.c.resource_type, ancestors.resource_id == requested.c.resource_id),
+            ),
+        ).subquery("targets")
+        grants = _matching_grants(
+            targets, targets.c.target_type, targets.c.target_id, targets.c.user_id,
+            targets.c.user_id, targets.c.resource_type, targets.c.resource_id,
+        )
+        query = select(grants).order_by(_access_rank(grants.c.access_level).desc(), grants.c.created_at.desc())
+        rows = {}
+        for row in (await db.execute(query)).all():
+            rows.setdefault((row.user_id, row.resource_type, row.resource_id), row) # Strongest grant wins, as in check_entitlement
+        for key in missing:
+            row = rows.get(key)
+            decisions[key] = _decision(key, row)
+            decision_cache.set(key, decisions[key], valid_until=row.expires_at if row is not None else None, generation=generation)
+
+    return [decisions[key] for key in keys]
+
+def _unnest_ids(ids: Sequence[str], name: str):
+    # One-column table of IDs, bound as a single array parameter
+    return func.unnest(bindparam(f"{name}_ids", list(ids), type_=ARRAY(String))).table_valued("id").render_derived(name=name)
+
+def _lookup_targets(resource_type: str, resource_ids: Sequence[str]):
+    # The requested resources, each paired with itself and with each of its ancestors
+    requested = select(_unnest_ids(resource_ids, "requested")).cte("requested")
+    ancestors = models.ResourceAncestor
+    return union_all(
+        select(
+            requested.c.id.label("resource_id"),
+            literal(resource_type, String).label("target_type"),
+            requested.c.id.label("target_id"),
+        ),
+        select(requested.c.id, ancestors.ancestor_type, ancestors.ancestor_id).join(
+            ancestors,
+            and_(ancestors.resource_type == resource_type, ancestors.resource_id == requested.c.id),
+        ),
+    ).subquery("targets")
+
+def _lookup_grants(targets, user_ids: Optional[Sequence[str]] = None):
+    # (resource_id, user_id, access_level) of the grants covering any target, optionally
+    # only those of user_ids. As in _matching_grants, exact and wildcard grants are joined
+    # separately; with no single user to look up, wildcards are found once per target
+    # type and then fanned out to the targets.
+    target_types = select(targets.c.target_type).distinct().subquery("target_types")
+    among = bindparam("user_ids", list(user_ids or []), type_=ARRAY(String))
+    matches = []
+    for entity in (models.Entitlement, models.GroupGrantExpansion):
+        exact = (
+            select(targets.c.resource_id, entity.user_id, entity.access_level)
+            .select_from(targets)
+            .join(entity, and_(entity.resource_type == targets.c.target_type, entity.resource_id == targets.c.target_id))
+        )
+        wildcard = (
+            select(targets.c.resource_id, entity.user_id, entity.access_level)
+            .select_from(target_types)
+            .join(entity, and_(entity.resource_type == target_types.c.target_type, entity.resource_id == WILDCARD))
+            .join(targets, targets.c.target_type == target_types.c.target_type)
+        )
+        for query in (exact, wildcard):
+            query = query.filter(_grants_access(entity))
+            if user_ids is not None:
+                query = query.filter(entity.user_id == any_(among))
+            matches.append(query)
+    return union_all(*matches).subquery("grants")
+
+def _descendant_grants(user_id: str, resource_type: str):
+    # (resource_id, access_level) of every resource of resource_type the user has a grant
+    # on, directly or on an ancestor; a wildcard grant on the type itself stays a WILDCARD row
+    ancestors = models.ResourceAncestor
+    matches = []
+    for entity in (models.Entitlement, models.GroupGrantExpansion):
+        granted = and_(entity.user_id == user_id, _grants_access(entity))
+        matches.append(select(entity.resource_id, entity.access_level).filter(granted, entity.resource_type == resource_type))
+        # Below an ancestor granted exactly, then below every resource of a wildcard grant's type
+        for ancestor_id in (entity.resource_id, None):
+            matches.append(
+                select(ancestors.resource_id, entity.access_level)
+                .select_from(entity)
+                .join(
+                    ancestors,
+                    and_(
+                        ancestors.ancestor_type == entity.resource_type,
+                        ancestors.ancestor_id == ancestor_id if ancestor_id is not None else entity.resource_id == WILDCARD,
+                        ancestors.resource_type == resource_type,
+                    ),
+                )
+                .filter(granted)
+            )
+    return union_all(*matches).subquery("grants")
+
+def _strongest_grants(grants, keys: Sequence[str], columns: Sequence[str]):
+    # One row of `columns` per key, from its grant with the strongest access level, in key order
+    return (
+        select(*[grants.c[name] for name in columns])
+        .distinct(*[grants.c[key] for key in keys])
+        .order_by(*[grants.c[key] for key in keys], _access_rank(grants.c.access_level).desc())
+    )
+
+LOOKUP_USER_COLUMNS = ["resource_id", "user_id", "access_level"]
+
+@track_operation
+async def stream_resource_users(
+    db: AsyncSession,
+    resource_type: str,
+    resource_ids: Sequence[str],
+    user_ids: Optional[Sequence[str]] = None,
+    batch_size: int = EXPORT_BATCH_SIZE
+) -> AsyncIterator[Sequence]:
+    # Users with access to each of the resources, with the same grants a check honors
+    # (direct, group, wildcard and inherited from ancestors), optionally only among
+    # user_ids. Yields batches of (resource_id, user_id, access_level) rows ordered by
+    # resource and user, one per pair with the strongest level. Grants are found by
+    # resource, as index-only scans of the *_active_by_resource indexes.
+    grants = _lookup_grants(_lookup_targets(resource_type, resource_ids), user_ids)
+    query = _strongest_grants(grants, ["resource_id", "user_id"], LOOKUP_USER_COLUMNS)
+    result = await db.stream(query.execution_options(yield_per=batch_size))
+    async for rows in result.partitions():
+        yield rows
+
+LOOKUP_RESOURCE_COLUMNS = ["resource_id", "access_level"]
+
+@track_operation
+async def stream_user_resources(
+    db: AsyncSession,
+    user_id: str,
+    resource_type: str,
+    resource_ids: Optional[Sequence[str]] = None,
+    batch_size: int = EXPORT_BATCH_SIZE
+) -> AsyncIterator[Sequence]:
+    # Resources of resource_type the user can access, as batches of (resource_id,
+    # access_level) rows ordered by resource_id, with the strongest level of each.
+    # With resource_ids (e.g. search hits) only those are checked, with the semantics of
+    # check_entitlements_batch. Without, every resource granted directly or below a
+    # granted ancestor is listed, and a wildcard grant on the type comes back as a
+    # resource_id of WILDCARD, standing for all of them.
+    if resource_ids is not None:
+        grants = _lookup_grants(_lookup_targets(resource_type, resource_ids), [user_id])
+    else:
+        grants = _descendant_grants(user_id, resource_type)
+    query = _strongest_grants(grants, ["resource_id"], LOOKUP_RESOURCE_COLUMNS)
+    result = await db.stream(query.execution_options(yield_per=batch_size))
+    async for rows in result.partitions():
+        yield rows
+
+def _unnest_rows(rows: Sequence[Dict[str, Any]], columns: Sequence[str], name: str, table: Table = models.Entitlement.__table__):
+    # Multi-row source for INSERT ... SELECT. Binding one array per column keeps the
+    # statement the same for every chunk, so it is compiled and prepared only once
+    # instead of rendering a VALUES list with one parameter per cell.
+    return func.unnest(
+        *[bindparam(f"{name}_{column}", [row[column] for row in rows], type_=ARRAY(table.c[column].type)) for column in columns]
+    ).table_valued(*columns).render_derived(name=name)
+
+def _validate_bulk_items(
+    items: Sequence[Dict[str, Any]],
+    keep: str
+) -> Tuple[List[Tuple[int, schemas.EntitlementCreate]], List[schemas.BulkItemResult]]:
+    # Validates raw items one by one. Items repeating the key of another item in the same
+    # request are reported as duplicates; `keep` picks whether the first or last one is written.
+    valid: Dict[tuple, Tuple[int, schemas.EntitlementCreate]] = {}
+    failed: List[schemas.BulkItemResult] = []
+    for index, item in enumerate(items):
+        try:
+            entitlement = schemas.EntitlementCreate.model_validate(item)
+        except ValidationError as exc:
+            failed.append(schemas.BulkItemResult(index=index, status="invalid", error=str(exc.errors()[0]["msg"])))
+            continue
+        if not all([entitlement.user_id, entitlement.resource_type, entitlement.resource_id]):
+            failed.append(schemas.BulkItemResult(index=index, status="invalid", error="user_id, resource_type, and resource_id are required"))
+            continue
+        key = _decision_key(entitlement.user_id, entitlement.resource_type, entitlement.resource_id)
+        previous = valid.get(key)
+        if previous is not None:
+            if keep == "first":
+                failed.append(schemas.BulkItemResult(index=index, status="duplicate", error="Duplicate of an earlier item in this request"))
+                continue
+            failed.append(schemas.BulkItemResult(index=previous[0], status="duplicate", error="Superseded by a later item in this request"))
+            del valid[key] # Re-insert so the surviving item keeps its position
+        valid[key] = (index, entitlement)
+    return list(valid.values()), failed
+
+def _upsert_values(stmt) -> Dict[str, Any]:
+    # Columns overwritten when an upsert hits an existing entitlement for the same key
+    return {
+        "access_level": stmt.excluded.access_level,
+        "is_active": stmt.excluded.is_active,
+        "description": stmt.excluded.description,
+        "granted_by": stmt.excluded.granted_by,
+        "expires_at": stmt.excluded.expires_at,
+        "updated_at": func.now(),
+        "version": models.Entitlement.__table__.c.version + 1,
+    }
+
+def _bulk_result(results: List[schemas.BulkItemResult]) -> schemas.BulkResult:
+    results.sort(key=lambda result: result.index)
+    failed = sum(1 for result in results if result.error is not None)
+    return schemas.BulkResult(succeeded=len(results) - failed, failed=failed, results=results)
+
+_BULK_INSERT_COLUMNS = ["id"] + list(schemas.EntitlementCreate.model_fields)
+
+def _insert_rows(entries: Sequence[Tuple[int, schemas.EntitlementCreate]]):
+    table = models.Entitlement.__table__
+    rows = [{"id": uuid.uuid4(), **entitlement.model_dump()} for _, entitlement in entries]
+    source = _unnest_rows(rows, _BULK_INSERT_COLUMNS, "source")
+    return insert(table).from_select(_BULK_INSERT_COLUMNS, select(*[source.c[column] for column in _BULK_INSERT_COLUMNS]))
+
+@track_operation
+async def bulk_create_entitlements(
+    db: AsyncSession,
+    items: Sequence[Dict[str, Any]],
+    chunk_size: int = BULK_CHUNK_SIZE
+) -> schemas.BulkResult:
+    entries, results = _validate_bulk_items(items, keep="first")
+    table = models.Entitlement.__table__
+    created: Dict[tuple, Any] = {}
+    for chunk in _chunks(entries, chunk_size):
+        stmt = (
+            _insert_rows(chunk)
+            .on_conflict_do_nothing(constraint="uq_entitlements_user_resource")
+            .returning(table)
+        )
+        written = {
+            _decision_key(row.user_id, row.resource_type, row.resource_id): row
+            for row in (await db.execute(stmt)).all()
+        }
+        created.update(written)
+        for index, entitlement in chunk:
+            row = written.get(_decision_key(entitlement.user_id, entitlement.resource_type, entitlement.resource_id))
+            if row is None:
+                results.append(schemas.BulkItemResult(index=index, status="conflict", error="Entitlement for this user and resource already exists"))
+            else:
+                results.append(schemas.BulkItemResult(index=index, status="created", id=row.id))
+    await _count_changes(db, added=[_counter_group(row.resource_type, row.access_level, row.is_active) for row in created.values()])
+    await _record_changes(db, created)
+    await db.commit()
+    _invalidate_decisions(_decision_key(e.user_id, e.resource_type, e.resource_id) for _, e in entries)
+    for row in created.values():
+        audit_log.record("create", after=entitlement_state(row._mapping))
+    return _bulk_result(results)
+
+@track_operation
+async def bulk_upsert_entitlements(
+    db: AsyncSession,
+    items: Sequence[Dict[str, Any]],
+    chunk_size: int = BULK_CHUNK_SIZE
+) -> schemas.BulkResult:
+    entries, results = _validate_bulk_items(items, keep="last")
+    written: Dict[tuple, Any] = {}
+    previous: Dict[tuple, Any] = {}
+    for chunk in _chunks(entries, chunk_size):
+        by_key = {_decision_key(e.user_id, e.resource_type, e.resource_id): (index, e) for index, e in chunk}
+        chunk_written, chunk_previous = await _upsert_locked(db, list(by_key), lambda keys: _insert_rows([by_key[key] for key in keys]))
+        written.update(chunk_written)
+        previous.update(chunk_previous)
+        for key, (index, _) in by_key.items():
+            results.append(schemas.BulkItemResult(index=index, status="updated" if key in previous else "created", id=written[key].id))
+    await _count_upserts(db, written, previous)
+    await _record_changes(db, written)
+    await db.commit()
+    _invalidate_decisions(written)
+    _audit_upserts(written, previous)
+    return _bulk_result(results)
+
+async def _lock_entitlements(db: AsyncSession, keys: Sequence[tuple]) -> Dict[tuple, Any]:
+    # Current rows for these keys, locked until commit
+    table = models.Entitlement.__table__
+    requested = _unnest_keys(keys, "requested")
+    query = select(table).join(requested, and_(
+        table.c.user_id == requested.c.user_id,
+        table.c.resource_type == requested.c.resource_type,
+        table.c.resource_id == requested.c.resource_id,
+    )).with_for_update(of=table)
+    return {_decision_key(row.user_id, row.resource_type, row.resource_id): row for row in (await db.execute(query)).all()}
+
+async def _upsert_locked(db: AsyncSession, keys: Sequence[tuple], build) -> Tuple[Dict[tuple, Any], Dict[tuple, Any]]:
+    # Writes `keys` with build(pending_keys), an INSERT for those keys made an upsert here,
+    # and returns the (written, previous) rows by key. Existing rows are read and locked
+    # first, which gives the state they replace, and only rows locked that way are
+    # updated: a key another transaction inserts in between conflicts without being
+    # written and goes to the next round, which then finds and locks it.
+    table = models.Entitlement.__table__
+    written: Dict[tuple, Any] = {}
+    previous: Dict[tuple, Any] = {}
+    pending = list(keys)
+    while pending:
+        existing = await _lock_entitlements(db, pending)
+        previous.update(existing)
+        locked = bindparam("locked_ids", [row.id for row in existing.values()], type_=ARRAY(PG_UUID(as_uuid=True)))
+        stmt = build(pending)
+        stmt = stmt.on_conflict_do_update(
+            constraint="uq_entitlements_user_resource",
+            set_=_upsert_values(stmt),
+            where=table.c.id == any_(locked),
+        ).returning(table)
+        for row in (await db.execute(stmt)).all():
+            written[_decision_key(row.user_id, row.resource_type, row.resource_id)] = row
+        pending = [key for key in pending if key not in written]
+    return written, previous
+
+async def _count_upserts(db: AsyncSession, written: Dict[tuple, Any], previous: Dict[tuple, Any]) -> None:
+    await _count_changes(
+        db,
+        added=[_counter_group(row.resource_type, row.access_level, row.is_active) for row in written.values()],
+        removed=[_counter_group(row.resource_type, row.access_level, row.is_active) for row in previous.values()],
+    )
+
+def _audit_upserts(written: Dict[tuple, Any], previous: Dict[tuple, Any]) -> None:
+    for key, row in written.items():
+        if key in previous:
+            audit_log.record("update", before=entitlement_state(previous[key]._mapping), after=entitlement_state(row._mapping))
+        else:
+            audit_log.record("create", after=entitlement_state(row._mapping))
+
+@track_operation
+async def bulk_revoke_entitlements(
+    db: AsyncSession,
+    items: Sequence[schemas.EntitlementKey],
+    chunk_size: int = BULK_CHUNK_SIZE
+) -> schemas.BulkResult:
+    keys = [_decision_key(item.user_id, item.resource_type, item.resource_id) for item in items]
+    unique_keys = list(dict.fromkeys(keys))
+    revoked: Dict[tuple, Any] = {}
+    entity = models.Entitlement
+    for chunk in _chunks(unique_keys, chunk_size):
+        requested = _unnest_keys(chunk, "requested")
+        old = _locked_copy(
+            entity.user_id == requested.c.user_id,
+            entity.resource_type == requested.c.resource_type,
+            entity.resource_id == requested.c.resource_id,
+        )
+        stmt = (
+            update(entity)
+            .where(entity.id == old.c.id)
+            .values(is_active=False, updated_at=func.now(), version=entity.version + 1)
+            .returning(entity.__table__, *_previous_columns(old))
+            .execution_options(synchronize_session=False)
+        )
+        for row in (await db.execute(stmt)).all():
+            revoked[_decision_key(row.user_id, row.resource_type, row.resource_id)] = row
+    await _count_changes(
+        db,
+        added=[_counter_group(row.resource_type, row.access_level, row.is_active) for row in revoked.values()],
+        removed=[_counter_group(row.old_resource_type, row.old_access_level, row.old_is_active) for row in revoked.values()],
+    )
+    await _record_changes(db, revoked)
+    await db.commit()
+    _invalidate_decisions(revoked)
+    for row in revoked.values():
+        audit_log.record("revoke", before=_previous_state(row), after=entitlement_state(row._mapping))
+
+    results = []
+    for index, key in enumerate(keys):
+        if key in revoked:
+            results.append(schemas.BulkItemResult(index=index, status="revoked", id=revoked[key].id))
+        else:
+            results.append(schemas.BulkItemResult(index=index, status="not_found", error="Entitlement not found"))
+    return _bulk_result(results)
+
+# Per-transaction staging table for imports, filled with COPY and merged into entitlements
+_import_staging = Table(
+    "entitlements_import_staging",
+    MetaData(),
+    Column("line_no", Integer, nullable=False),
+    *[Column(name, models.Entitlement.__table__.c[name].type) for name in schemas.EntitlementCreate.model_fields],
+    prefixes=["TEMPORARY"],
+    postgresql_on_commit="DROP",
+)
+
+@track_operation
+async def import_entitlements_batch(
+    db: AsyncSession,
+    rows: Sequence[Tuple[int, schemas.EntitlementCreate]],
+    mode: str = "upsert"
+) -> Dict[str, int]:
+    # Loads one batch of validated (line_no, entitlement) rows with COPY and merges it into
+    # entitlements in a single transaction. Within the batch the last line for a key wins.
+    # mode='insert' leaves existing entitlements untouched and counts them as skipped.
+    staging = _import_staging
+    columns = [column.name for column in staging.columns]
+    await db.execute(CreateTable(staging))
+    raw_connection = await (await db.connection()).get_raw_connection()
+    await raw_connection.driver_connection.copy_records_to_table(
+        staging.name,
+        columns=columns,
+        records=[(line_no, *entitlement.model_dump().values()) for line_no, entitlement in rows],
+    )
+
+    fields = list(schemas.EntitlementCreate.model_fields)
+    keys = [staging.c.user_id, staging.c.resource_type, staging.c.resource_id]
+    source = (
+        select(func.gen_random_uuid(), *[staging.c[name] for name in fields])
+        .distinct(*keys)
+        .order_by(*keys, staging.c.line_no.desc())
+    )
+    table = models.Entitlement.__table__
+    batch_keys = {_decision_key(e.user_id, e.resource_type, e.resource_id) for _, e in rows}
+    previous: Dict[tuple, Any] = {}
+    if mode == "insert":
+        stmt = insert(table).from_select(["id"] + fields, source)
+        stmt = stmt.on_conflict_do_nothing(constraint="uq_entitlements_user_resource").returning(table)
+        written = {
+            _decision_key(row.user_id, row.resource_type, row.resource_id): row
+            for row in (await db.execute(stmt)).all()
+        }
+    else:
+        def build(pending):
+            if len(pending) == len(batch_keys):
+                return insert(table).from_select(["id"] + fields, source)
+            # A retry round only merges the keys still pending
+            requested = _unnest_keys(pending, "pending")
+            retry = source.join(requested, and_(
+                staging.c.user_id == requested.c.user_id,
+                staging.c.resource_type == requested.c.resource_type,
+                staging.c.resource_id == requested.c.resource_id,
+            ))
+            return insert(table).from_select(["id"] + fields, retry)
+
+        written, previous = await _upsert_locked(db, list(batch_keys), build)
+    await _count_upserts(db, written, previous)
+    await _record_changes(db, written)
+    await db.commit()
+    _invalidate_decisions(written)
+    _audit_upserts(written, previous)
+
+    updated = sum(1 for key in written if key in previous)
+    return {"inserted": len(written) - updated, "updated": updated, "skipped": len(rows) - len(written)}
+
+@track_operation
+@coalesce(key=_write_generation)
 async def get_entitlements_count(
     db: AsyncSession,
     user_id: Optional[str] = None,
@@ -73,26 +959,712 @@ async def get_entitlements_count(
     resource_id: Optional[str] = None,
     is_active: Optional[bool] = None
 ) -> int:
-    # This is a simplified count. For more complex queries, consider count(Entitlement.id)
-    # or a more specific count query if performance becomes an issue.
-    query = select(models.Entitlement.id) # Select only ID for counting
-    if user_id:
-        query = query.filter(models.Entitlement.user_id == user_id)
-    if resource_type:
-        query = query.filter(models.Entitlement.resource_type == resource_type)
-    if resource_id:
-        query = query.filter(models.Entitlement.resource_id == resource_id)
-    if is_active is not None:
-        query = query.filter(models.Entitlement.is_active == is_active)
-
-    # Execute the query and count the results
-    # Note: For a large number of rows, this might not be the most performant way to count.
-    # A dedicated count query (e.g., using func.count) might be better.
-    # from sqlalchemy import func
-    # query = select(func.count(models.Entitlement.id))
-    # ... add filters ...
-    # result = await db.execute(query)
-    # return result.scalar_one()
-    
-    all_ids = await db.execute(query)
-    return len(all_ids.scalars().all()) # This fetches all IDs then counts, can be inefficient
+    query = _filter_entitlements(select(func.count()).select_from(models.Entitlement), user_id, resource_type, resource_id, is_active)
+    result = await db.execute(query)
+    return result.scalar_one()
+
+@track_operation
+async def get_entitlements_count_estimate(
+    db: AsyncSession,
+    user_id: Optional[str] = None,
+    resource_type: Optional[str] = None,
+    resource_id: Optional[str] = None,
+    is_active: Optional[bool] = None
+) -> int:
+    # Row estimate from the planner (EXPLAIN), which costs about as much as planning the
+    # query and stays constant however many rows match. Accuracy depends on table statistics.
+    query = _filter_entitlements(select(models.Entitlement.id), user_id, resource_type, resource_id, is_active)
+    conn = await db.connection()
+    compiled = query.compile(dialect=conn.dialect)
+    params = tuple(compiled.params[name] for name in compiled.positiontup or ())
+    result = await conn.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {compiled.string}", params)
+    plan = result.scalar_one()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+STATS_DIMENSIONS = ["resource_type", "access_level", "is_active"]
+
+def _actual_counts(*dimensions: str):
+    # The counts entitlement_counters should hold, grouped like its rows
+    table = models.Entitlement.__table__
+    columns = {
+        "resource_type": table.c.resource_type,
+        "access_level": func.coalesce(table.c.access_level, ""),
+        "is_active": func.coalesce(table.c.is_active, False),
+    }
+    selected = [columns[name].label(name) for name in dimensions]
+    return select(*selected, func.count().label("count")).group_by(*selected)
+
+def _stats_group(row, dimensions: Sequence[str]) -> Dict[str, Any]:
+    group = {name: getattr(row, name) for name in dimensions}
+    if group.get("access_level") == "":
+        group["access_level"] = None
+    return group
+
+@track_operation
+async def get_entitlement_stats(db: AsyncSession, group_by: Sequence[str] = ()) -> Tuple[int, List[Dict[str, Any]]]:
+    # Entitlement counts from entitlement_counters, grouped by any of STATS_DIMENSIONS;
+    # reads a few rows per group however many entitlements there are. Returns the total
+    # and the non-empty groups, each a dict of its dimensions plus "count".
+    counters = models.EntitlementCounter.__table__
+    dimensions = [name for name in STATS_DIMENSIONS if name in group_by]
+    total = func.sum(counters.c.count)
+    query = (
+        select(*[counters.c[name] for name in dimensions], total.label("count"))
+        .group_by(*[counters.c[name] for name in dimensions])
+        .having(total != 0)
+        .order_by(*[counters.c[name] for name in dimensions])
+    )
+    groups = [{**_stats_group(row, dimensions), "count": int(row.count)} for row in (await db.execute(query)).all()]
+    return sum(group["count"] for group in groups), groups
+
+@track_operation
+async def rebuild_counters(db: AsyncSession) -> int:
+    # Recounts entitlement_counters from the entitlements table in one transaction; writes
+    # wait for it on the counter lock, so no change falls between the count and the swap.
+    # Returns the number of groups written.
+    counters = models.EntitlementCounter.__table__
+    await db.execute(text(f"LOCK TABLE {counters.name} IN SHARE MODE"))
+    await db.execute(delete(counters))
+    actual = _actual_counts(*STATS_DIMENSIONS).subquery("actual")
+    result = await db.execute(insert(counters).from_select(
+        _COUNTER_COLUMNS,
+        select(literal(0, Integer), *[actual.c[name] for name in STATS_DIMENSIONS], actual.c.count),
+    ))
+    await db.commit()
+    return result.rowcount
+
+@track_operation
+async def counter_drift(db: AsyncSession) -> List[Dict[str, Any]]:
+    # Groups whose counter total differs from the rows actually stored, compared within
+    # one snapshot; an empty list means the counters are exact
+    await db.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+    counters = models.EntitlementCounter.__table__
+    actual = {
+        _counter_group(row.resource_type, row.access_level, row.is_active): row.count
+        for row in (await db.execute(_actual_counts(*STATS_DIMENSIONS))).all()
+    }
+    counted = {
+        _counter_group(row.resource_type, row.access_level, row.is_active): int(row.count)
+        for row in (await db.execute(
+            select(*[counters.c[name] for name in STATS_DIMENSIONS], func.sum(counters.c.count).label("count"))
+            .group_by(*[counters.c[name] for name in STATS_DIMENSIONS])
+        )).all()
+    }
+    await db.commit()
+    drift = []
+    for group in sorted(actual.keys() | counted.keys()):
+        if actual.get(group, 0) != counted.get(group, 0):
+            drift.append({
+                "resource_type": group[0],
+                "access_level": group[1] or None,
+                "is_active": group[2],
+                "counted": counted.get(group, 0),
+                "actual": actual.get(group, 0),
+            })
+    return drift
+
+# Columns of the unique (user_id, resource_type, resource_id) key
+_KEY_COLUMNS = ["user_id", "resource_type", "resource_id"]
+
+@track_operation
+async def duplicate_entitlement_keys(db: AsyncSession, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    # Keys held by more than one row, with their number of rows. Only databases created
+    # before uq_entitlements_user_resource existed can have any; migration 2 refuses to
+    # add the constraint until they are merged.
+    table = models.Entitlement.__table__
+    keys = [table.c[name] for name in _KEY_COLUMNS]
+    query = select(*keys, func.count().label("rows")).group_by(*keys).having(func.count() > 1).order_by(*keys)
+    if limit is not None:
+        query = query.limit(limit)
+    return [dict(row._mapping) for row in (await db.execute(query)).all()]
+
+@track_operation
+async def merge_duplicate_entitlements(db: AsyncSession) -> List[Dict[str, Any]]:
+    # Keeps one row per duplicated key and deletes the others, in one transaction; returns
+    # the deleted rows. The row kept is the one a check would honor: in effect first, then
+    # the strongest access level, then the most recently written. Counters, the change
+    # log and the audit trail record the deletes like any other.
+    table = models.Entitlement.__table__
+    ranked = select(
+        table.c.id,
+        func.row_number().over(
+            partition_by=[table.c[name] for name in _KEY_COLUMNS],
+            order_by=[
+                _grants_access().desc().nulls_last(),
+                _access_rank(table.c.access_level).desc(),
+                func.coalesce(table.c.updated_at, table.c.created_at).desc(),
+                table.c.id,
+            ],
+        ).label("position"),
+    ).subquery("ranked")
+    deleted = await _delete_entitlements(db, table.c.id == ranked.c.id, ranked.c.position > 1)
+    return [entitlement_state(row._mapping) for row in deleted]
+
+@track_operation
+async def delete_entitlements_granted_by(db: AsyncSession, granted_by: str) -> int:
+    # Deletes every entitlement granted by granted_by, such as the rows a benchmark run
+    # wrote; returns how many
+    return len(await _delete_entitlements(db, models.Entitlement.granted_by == granted_by))
+
+async def _delete_entitlements(db: AsyncSession, *criteria) -> list:
+    # Deletes the matching rows in one transaction, through the counters, the change log,
+    # the decision cache and the audit trail; returns the deleted rows
+    table = models.Entitlement.__table__
+    deleted = (await db.execute(delete(table).where(*criteria).returning(table))).all()
+    await _count_changes(db, removed=[_counter_group(row.resource_type, row.access_level, row.is_active) for row in deleted])
+    await _record_changes(db, [_decision_key(row.user_id, row.resource_type, row.resource_id) for row in deleted])
+    await db.commit()
+    _invalidate_decisions(_decision_key(row.user_id, row.resource_type, row.resource_id) for row in deleted)
+    for row in deleted:
+        audit_log.record("delete", before=entitlement_state(row._mapping))
+    return deleted
+
+@track_operation
+async def copy_entitlements(db: AsyncSession, rows: Sequence[Dict[str, Any]]) -> int:
+    # Loads complete rows (ids included) with COPY, for bulk loads of keys known to be
+    # new, such as a synthetic dataset; a key that exists fails the whole call. Counters
+    # and the change log cover the rows, the audit trail does not. Returns the row count.
+    if not rows:
+        return 0
+    columns = list(rows[0])
+    raw_connection = await (await db.connection()).get_raw_connection()
+    await raw_connection.driver_connection.copy_records_to_table(
+        models.Entitlement.__tablename__,
+        columns=columns,
+        records=[tuple(row[name] for name in columns) for row in rows],
+    )
+    await _count_changes(db, added=[_counter_group(row["resource_type"], row.get("access_level"), row.get("is_active")) for row in rows])
+    await _record_changes(db, [_decision_key(row["user_id"], row["resource_type"], row["resource_id"]) for row in rows])
+    await db.commit()
+    _invalidate_decisions(_decision_key(row["user_id"], row["resource_type"], row["resource_id"]) for row in rows)
+    return len(rows)
+
+# Snapshots and change pages for clients that evaluate checks locally. Both describe
+# grants in the same compact rows, [user_id, resource_type, resource_id, access_level,
+# expires_at, created_at] with epoch-second timestamps, and ancestors as [resource_type,
+# resource_id, ancestor_type, ancestor_id, depth]. Grants are the active, unexpired ones
+# of both direct entitlements and the group expansion, as used by check_entitlement.
+CHANGES_PAGE_SIZE = 1000
+
+class ChangesPrunedError(Exception):
+    """Changes after the requested position are no longer in the change log."""
+
+def _epoch(column):
+    return cast(func.extract("epoch", column), Float)
+
+def _snapshot_grants(resource_types: Optional[Sequence[str]], keys=None):
+    parts = []
+    for entity in (models.Entitlement, models.GroupGrantExpansion):
+        query = select(
+            entity.user_id, entity.resource_type, entity.resource_id, entity.access_level,
+            _epoch(entity.expires_at), _epoch(entity.created_at),
+        ).filter(_grants_access(entity))
+        if keys is not None:
+            query = query.join(keys, and_(
+                entity.user_id == keys.c.user_id,
+                entity.resource_type == keys.c.resource_type,
+                entity.resource_id == keys.c.resource_id,
+            ))
+        if resource_types:
+            query = query.filter(entity.resource_type.in_(resource_types))
+        parts.append(query)
+    return union_all(*parts)
+
+def _snapshot_ancestors(resource_types: Optional[Sequence[str]], resources: Optional[Sequence[tuple]] = None):
+    ancestors = models.ResourceAncestor
+    query = select(ancestors.resource_type, ancestors.resource_id, ancestors.ancestor_type, ancestors.ancestor_id, ancestors.depth)
+    if resources is not None:
+        query = query.filter(tuple_(ancestors.resource_type, ancestors.resource_id).in_(resources))
+    if resource_types:
+        query = query.filter(ancestors.resource_type.in_(resource_types))
+    return query
+
+async def _change_head(db: AsyncSession) -> Tuple[int, int]:
+    # (settled position, pruned through): every transaction up to the first has finished,
+    # so its changes are all visible and no later commit can add one at or below it
+    counter = models.ChangeSequence
+    pruned_through = select(counter.pruned_through).filter(counter.id == 1).scalar_subquery()
+    row = (await db.execute(select(_SETTLED_XACT, func.coalesce(pruned_through, 0)))).one()
+    return tuple(row)
+
+@track_operation
+async def stream_snapshot(
+    db: AsyncSession,
+    resource_types: Optional[Sequence[str]] = None,
+    batch_size: int = EXPORT_BATCH_SIZE
+) -> AsyncIterator[Dict[str, Any]]:
+    # Yields {"seq", "resource_types"} and then {"grants": [...]} and {"ancestors": [...]}
+    # batches. Everything is read from one REPEATABLE READ snapshot, which holds every
+    # change up to seq; changes after seq apply on top of it. The snapshot may already
+    # hold some of those too, which is harmless: a change page carries current state.
+    await db.connection(execution_options={"isolation_level": "REPEATABLE READ"})
+    seq, _ = await _change_head(db)
+    yield {"seq": seq, "resource_types": list(resource_types) if resource_types else None}
+    for name, query in (("grants", _snapshot_grants(resource_types)), ("ancestors", _snapshot_ancestors(resource_types))):
+        result = await db.stream(query.execution_options(yield_per=batch_size))
+        async for rows in result.partitions():
+            yield {name: [tuple(row) for row in rows]}
+
+@track_operation
+async def get_changes(
+    db: AsyncSession,
+    since: int,
+    resource_types: Optional[Sequence[str]] = None,
+    limit: int = CHANGES_PAGE_SIZE
+) -> Dict[str, Any]:
+    # Keys changed after `since`, up to seq, with their current grants (a key without
+    # grants lost them all) and resources whose ancestors changed, with their current
+    # ancestors. A page ends after about `limit` changes but never splits a transaction,
+    # and never goes past the settled position of _change_head: a transaction still
+    # running there could commit changes the client would otherwise skip.
+    head, pruned_through = await _change_head(db)
+    if since < pruned_through:
+        raise ChangesPrunedError(since)
+    changes = models.EntitlementChange
+    upto = (await db.execute(
+        select(changes.seq).filter(changes.seq > since, changes.seq <= head).order_by(changes.seq).offset(limit - 1).limit(1)
+    )).scalar()
+    upto = max(head, since) if upto is None else upto
+    window = select(changes.user_id, changes.resource_type, changes.resource_id).filter(changes.seq > since, changes.seq <= upto)
+    if resource_types:
+        window = window.filter(changes.resource_type.in_(resource_types))
+    changed = (await db.execute(window.distinct())).all()
+
+    keys = [tuple(row) for row in changed if row.user_id is not None]
+    resources = [(row.resource_type, row.resource_id) for row in changed if row.user_id is None]
+    grants, ancestors = [], []
+    if keys:
+        grants = (await db.execute(_snapshot_grants(resource_types, _unnest_keys(keys, "changed")))).all()
+    if resources:
+        ancestors = (await db.execute(_snapshot_ancestors(resource_types, resources))).all()
+    return {
+        "since": since,
+        "seq": upto,
+        "more": upto < head,
+        "keys": keys,
+        "grants": [tuple(row) for row in grants],
+        "resources": resources,
+        "ancestors": [tuple(row) for row in ancestors],
+    }
+
+@track_operation
+async def prune_changes(db: AsyncSession, before: datetime) -> int:
+    # Drops change log entries recorded before `before`; clients that have not synced
+    # past them get ChangesPrunedError and reload a snapshot
+    changes = models.EntitlementChange
+    head, _ = await _change_head(db)
+    through = (await db.execute(
+        select(func.max(changes.seq)).filter(changes.changed_at < before, changes.seq <= head)
+    )).scalar()
+    if through is None:
+        return 0
+    deleted = (await db.execute(delete(changes).where(changes.seq <= through))).rowcount
+    counter = models.ChangeSequence
+    stmt = insert(counter).values(id=1, seq=0, pruned_through=through)
+    await db.execute(stmt.on_conflict_do_update(
+        index_elements=[counter.id], set_={"pruned_through": func.greatest(counter.pruned_through, through)},
+    ))
+    await db.commit()
+    return deleted
+
+# Expiry sweeping. Reads already treat expired grants as inactive; deactivating them
+# afterwards keeps them out of the partial indexes of in-effect grants and records the
+# expiry in the change log. Batches are small single-statement updates that skip rows
+# another transaction holds, so the sweeper never waits on, or blocks, a writer for long.
+
+def _deactivate_expired(table: Table, batch_size: int, *returning, **values):
+    # UPDATE of at most batch_size expired active rows of `table`, earliest expiry first
+    pk = list(table.primary_key.columns)
+    batch = (
+        select(*pk)
+        .where(table.c.is_active, table.c.expires_at <= func.now()) # Matches the partial expiry indexes
+        .order_by(table.c.expires_at)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    )
+    return update(table).where(tuple_(*pk).in_(batch)).values(is_active=False, **values).returning(*returning)
+
+@track_operation
+async def sweep_expired(db: AsyncSession, batch_size: int) -> Tuple[int, bool]:
+    # Deactivates up to batch_size expired entitlements, group grants and group expansion
+    # rows each, in one transaction. Returns the number of rows deactivated and whether
+    # any of the three tables filled its batch, i.e. may have more to sweep.
+    entitlements = models.Entitlement.__table__
+    expired = (await db.execute(_deactivate_expired(
+        entitlements, batch_size, entitlements, updated_at=func.now(), version=entitlements.c.version + 1,
+    ))).all()
+    grants = models.GroupGrant.__table__
+    expired_grants = (await db.execute(_deactivate_expired(grants, batch_size, grants.c.group_id, updated_at=func.now()))).all()
+    expansion = models.GroupGrantExpansion.__table__
+    expired_members = (await db.execute(_deactivate_expired(
+        expansion, batch_size, expansion.c.user_id, expansion.c.resource_type, expansion.c.resource_id,
+    ))).all()
+    keys = [_decision_key(row.user_id, row.resource_type, row.resource_id) for row in expired + expired_members]
+    await _count_changes(
+        db,
+        added=[_counter_group(row.resource_type, row.access_level, False) for row in expired],
+        removed=[_counter_group(row.resource_type, row.access_level, True) for row in expired],
+    )
+    await _record_changes(db, keys)
+    await db.commit()
+    _invalidate_decisions(keys)
+    for row in expired:
+        audit_log.record("expire", after=entitlement_state(row._mapping))
+    full = max(len(expired), len(expired_grants), len(expired_members)) >= batch_size
+    return len(keys) + len(expired_grants), full
+
+class ResourceCycleError(Exception):
+    """The link would make a resource its own ancestor."""
+
+# Advisory lock key serializing hierarchy changes, so two concurrent links cannot
+# form a cycle that neither would on its own
+_RESOURCE_LINK_LOCK = 0x656e746c
+
+def _resource_and_descendants(resource_type: str, resource_id: str):
+    ancestors = models.ResourceAncestor
+    return union_all(
+        select(
+            literal(resource_type, String).label("resource_type"),
+            literal(resource_id, String).label("resource_id"),
+            literal(0, Integer).label("depth"),
+        ),
+        select(ancestors.resource_type, ancestors.resource_id, ancestors.depth).filter(
+            ancestors.ancestor_type == resource_type, ancestors.ancestor_id == resource_id
+        ),
+    ).subquery("subtree")
+
+async def _unlink_resource(db: AsyncSession, resource_type: str, resource_id: str) -> Optional[models.ResourceLink]:
+    link = models.ResourceLink
+    removed = (await db.execute(
+        delete(link)
+        .where(link.resource_type == resource_type, link.resource_id == resource_id)
+        .returning(link)
+        .execution_options(synchronize_session=False, populate_existing=True)
+    )).scalars().first()
+    if removed is None:
+        return None
+    # Detach the subtree: drop closure rows from it to everything above the removed link.
+    # Both subqueries read the closure as it was before this statement.
+    ancestors = models.ResourceAncestor
+    subtree = _resource_and_descendants(resource_type, resource_id)
+    above = select(ancestors.ancestor_type, ancestors.ancestor_id).filter(
+        ancestors.resource_type == resource_type, ancestors.resource_id == resource_id
+    )
+    await db.execute(
+        delete(ancestors)
+        .where(
+            tuple_(ancestors.resource_type, ancestors.resource_id).in_(select(subtree.c.resource_type, subtree.c.resource_id)),
+            tuple_(ancestors.ancestor_type, ancestors.ancestor_id).in_(above),
+        )
+        .execution_options(synchronize_session=False)
+    )
+    db.expunge(removed)
+    return removed
+
+async def _record_subtree_changes(db: AsyncSession, resource_type: str, resource_id: str) -> None:
+    # A link change moves the ancestors of the resource and everything below it
+    subtree = _resource_and_descendants(resource_type, resource_id)
+    resources = (await db.execute(select(subtree.c.resource_type, subtree.c.resource_id))).all()
+    await _record_changes(db, ((None, row.resource_type, row.resource_id) for row in resources))
+
+@track_operation
+async def get_resource_parent(db: AsyncSession, resource_type: str, resource_id: str) -> Optional[models.ResourceLink]:
+    link = models.ResourceLink
+    result = await db.execute(select(link).filter(link.resource_type == resource_type, link.resource_id == resource_id))
+    return result.scalars().first()
+
+@track_operation
+async def get_resource_ancestors(db: AsyncSession, resource_type: str, resource_id: str) -> List[models.ResourceAncestor]:
+    ancestors = models.ResourceAncestor
+    query = (
+        select(ancestors)
+        .filter(ancestors.resource_type == resource_type, ancestors.resource_id == resource_id)
+        .order_by(ancestors.depth)
+    )
+    result = await db.execute(query)
+    return result.scalars().all()
+
+@track_operation
+async def set_resource_parent(
+    db: AsyncSession,
+    resource_type: str,
+    resource_id: str,
+    parent_type: str,
+    parent_id: str
+) -> models.ResourceLink:
+    # Replaces any previous parent. The closure gains one row for every pair of
+    # (resource or one of its descendants, new parent or one of its ancestors).
+    await db.execute(select(func.pg_advisory_xact_lock(_RESOURCE_LINK_LOCK)))
+    ancestors = models.ResourceAncestor
+    if (parent_type, parent_id) == (resource_type, resource_id):
+        raise ResourceCycleError(resource_type, resource_id)
+    below = await db.execute(
+        select(ancestors.depth).filter(
+            ancestors.resource_type == parent_type, ancestors.resource_id == parent_id,
+            ancestors.ancestor_type == resource_type, ancestors.ancestor_id == resource_id,
+        )
+    )
+    if below.first() is not None:
+        raise ResourceCycleError(resource_type, resource_id)
+
+    await _unlink_resource(db, resource_type, resource_id)
+    subtree = _resource_and_descendants(resource_type, resource_id)
+    above = union_all(
+        select(
+            literal(parent_type, String).label("ancestor_type"),
+            literal(parent_id, String).label("ancestor_id"),
+            literal(0, Integer).label("depth"),
+        ),
+        select(ancestors.ancestor_type, ancestors.ancestor_id, ancestors.depth).filter(
+            ancestors.resource_type == parent_type, ancestors.resource_id == parent_id
+        ),
+    ).subquery("above")
+    await db.execute(
+        insert(ancestors).from_select(
+            ["resource_type", "resource_id", "ancestor_type", "ancestor_id", "depth"],
+            select(
+                subtree.c.resource_type, subtree.c.resource_id,
+                above.c.ancestor_type, above.c.ancestor_id,
+                subtree.c.depth + above.c.depth + 1,
+            ).select_from(subtree.join(above, true())),
+        )
+    )
+    db_link = models.ResourceLink(
+        resource_type=resource_type, resource_id=resource_id, parent_type=parent_type, parent_id=parent_id
+    )
+    db.add(db_link)
+    await _record_subtree_changes(db, resource_type, resource_id)
+    await db.commit()
+    await db.refresh(db_link)
+    # Any user's decision below the moved subtree may change
+    decision_cache.clear()
+    return db_link
+
+@track_operation
+async def remove_resource_parent(db: AsyncSession, resource_type: str, resource_id: str) -> Optional[models.ResourceLink]:
+    await db.execute(select(func.pg_advisory_xact_lock(_RESOURCE_LINK_LOCK)))
+    removed = await _unlink_resource(db, resource_type, resource_id)
+    if removed is None:
+        return None
+    await _record_subtree_changes(db, resource_type, resource_id)
+    await db.commit()
+    decision_cache.clear()
+    return removed
+
+# Group membership and group grants. Every change locks the group row, then updates the
+# group_grant_expansion rows it affects in the same transaction: adding a member copies
+# that group's grants, granting the group copies the grant to its members. Concurrent
+# changes to one group are serialized by the lock, so the expansion cannot miss a row.
+
+_EXPANSION_COLUMNS = ["user_id", "resource_type", "resource_id", "group_id", "access_level", "is_active", "expires_at", "created_at"]
+
+async def _lock_group(db: AsyncSession, group_id: str) -> Optional[models.Group]:
+    result = await db.execute(select(models.Group).filter(models.Group.group_id == group_id).with_for_update())
+    return result.scalars().first()
+
+@track_operation
+async def get_group(db: AsyncSession, group_id: str) -> Optional[models.Group]:
+    result = await db.execute(select(models.Group).filter(models.Group.group_id == group_id))
+    return result.scalars().first()
+
+@track_operation
+async def create_group(db: AsyncSession, group: schemas.GroupCreate) -> models.Group:
+    db_group = models.Group(**group.model_dump())
+    db.add(db_group)
+    await db.commit()
+    await db.refresh(db_group)
+    return db_group
+
+@track_operation
+async def delete_group(db: AsyncSession, group_id: str) -> Optional[models.Group]:
+    if await _lock_group(db, group_id) is None:
+        return None
+    members = (await db.execute(
+        select(models.GroupMember.user_id).filter(models.GroupMember.group_id == group_id)
+    )).scalars().all()
+    expanded = models.GroupGrantExpansion
+    changed = (await db.execute(
+        select(expanded.user_id, expanded.resource_type, expanded.resource_id).filter(expanded.group_id == group_id)
+    )).all()
+    # Members, grants and expansion rows go with the group (ON DELETE CASCADE)
+    db_group = (await db.execute(
+        delete(models.Group)
+        .where(models.Group.group_id == group_id)
+        .returning(models.Group)
+        .execution_options(synchronize_session=False, populate_existing=True)
+    )).scalars().first()
+    db.expunge(db_group)
+    await _record_changes(db, (tuple(row) for row in changed))
+    await db.commit()
+    _invalidate_decisions((user_id,) for user_id in members)
+    return db_group
+
+@track_operation
+async def get_group_members(db: AsyncSession, group_id: str, skip: int = 0, limit: int = 100) -> List[models.GroupMember]:
+    query = (
+        select(models.GroupMember)
+        .filter(models.GroupMember.group_id == group_id)
+        .order_by(models.GroupMember.user_id)
+        .offset(skip)
+        .limit(limit)
+    )
+    result = await db.execute(query)
+    return result.scalars().all()
+
+@track_operation
+async def add_group_member(db: AsyncSession, group_id: str, user_id: str) -> Optional[models.GroupMember]:
+    # Idempotent; the new member gets one expansion row per grant of the group
+    if await _lock_group(db, group_id) is None:
+        return None
+    member = models.GroupMember
+    added = (await db.execute(
+        insert(member)
+        .values(group_id=group_id, user_id=user_id)
+        .on_conflict_do_nothing()
+        .returning(member)
+        .execution_options(populate_existing=True)
+    )).scalars().first()
+    if added is None:
+        await db.rollback()
+        result = await db.execute(select(member).filter(member.group_id == group_id, member.user_id == user_id))
+        return result.scalars().first()
+
+    grants = models.GroupGrant
+    expanded = models.GroupGrantExpansion
+    changed = (await db.execute(
+        insert(expanded).from_select(
+            _EXPANSION_COLUMNS,
+            select(
+                literal(user_id, String), grants.resource_type, grants.resource_id, grants.group_id,
+                grants.access_level, grants.is_active, grants.expires_at, grants.created_at,
+            ).filter(grants.group_id == group_id),
+        ).returning(expanded.user_id, expanded.resource_type, expanded.resource_id)
+    )).all()
+    db.expunge(added)
+    await _record_changes(db, (tuple(row) for row in changed))
+    await db.commit()
+    decision_cache.invalidate_user(user_id)
+    return added
+
+@track_operation
+async def remove_group_member(db: AsyncSession, group_id: str, user_id: str) -> Optional[models.GroupMember]:
+    if await _lock_group(db, group_id) is None:
+        return None
+    member = models.GroupMember
+    removed = (await db.execute(
+        delete(member)
+        .where(member.group_id == group_id, member.user_id == user_id)
+        .returning(member)
+        .execution_options(synchronize_session=False, populate_existing=True)
+    )).scalars().first()
+    if removed is None:
+        return None
+    expanded = models.GroupGrantExpansion
+    changed = (await db.execute(
+        delete(expanded)
+        .where(expanded.user_id == user_id, expanded.group_id == group_id)
+        .returning(expanded.user_id, expanded.resource_type, expanded.resource_id)
+        .execution_options(synchronize_session=False)
+    )).all()
+    db.expunge(removed)
+    await _record_changes(db, (tuple(row) for row in changed))
+    await db.commit()
+    decision_cache.invalidate_user(user_id)
+    return removed
+
+@track_operation
+async def get_group_grants(db: AsyncSession, group_id: str) -> List[models.GroupGrant]:
+    grants = models.GroupGrant
+    query = (
+        select(grants, _grants_access(grants).label("active"))
+        .filter(grants.group_id == group_id)
+        .order_by(grants.resource_type, grants.resource_id)
+    )
+    result = await db.execute(query)
+    return _with_effective_state(result.all())
+
+@track_operation
+async def set_group_grant(db: AsyncSession, group_id: str, grant: schemas.GroupGrantCreate) -> Optional[models.GroupGrant]:
+    # Creates or overwrites the group's grant on a resource, then upserts one expansion
+    # row per member
+    if await _lock_group(db, group_id) is None:
+        return None
+    grants = models.GroupGrant
+    stmt = insert(grants).values(group_id=group_id, **grant.model_dump())
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[grants.group_id, grants.resource_type, grants.resource_id],
+        set_={
+            "access_level": stmt.excluded.access_level,
+            "is_active": stmt.excluded.is_active,
+            "expires_at": stmt.excluded.expires_at,
+            "description": stmt.excluded.description,
+            "granted_by": stmt.excluded.granted_by,
+            "updated_at": func.now(),
+        },
+    )
+    db_grant = (await db.execute(
+        stmt.returning(grants).execution_options(populate_existing=True)
+    )).scalars().first()
+
+    members = models.GroupMember
+    expansion = insert(models.GroupGrantExpansion).from_select(
+        _EXPANSION_COLUMNS,
+        select(
+            members.user_id, grants.resource_type, grants.resource_id, grants.group_id,
+            grants.access_level, grants.is_active, grants.expires_at, grants.created_at,
+        )
+        .join(grants, grants.group_id == members.group_id)
+        .filter(
+            members.group_id == group_id,
+            grants.resource_type == grant.resource_type,
+            grants.resource_id == grant.resource_id,
+        ),
+    )
+    expansion = expansion.on_conflict_do_update(
+        index_elements=[models.GroupGrantExpansion.user_id, models.GroupGrantExpansion.resource_type,
+                        models.GroupGrantExpansion.resource_id, models.GroupGrantExpansion.group_id],
+        set_={
+            "access_level": expansion.excluded.access_level,
+            "is_active": expansion.excluded.is_active,
+            "expires_at": expansion.excluded.expires_at,
+        },
+    )
+    affected = (await db.execute(expansion.returning(models.GroupGrantExpansion.user_id))).scalars().all()
+    db.expunge(db_grant)
+    await _record_changes(db, (_decision_key(user_id, grant.resource_type, grant.resource_id) for user_id in affected))
+    await db.commit()
+    _invalidate_decisions((user_id,) for user_id in affected)
+    return db_grant
+
+@track_operation
+async def delete_group_grant(
+    db: AsyncSession,
+    group_id: str,
+    resource_type: str,
+    resource_id: str
+) -> Optional[models.GroupGrant]:
+    if await _lock_group(db, group_id) is None:
+        return None
+    grants = models.GroupGrant
+    removed = (await db.execute(
+        delete(grants)
+        .where(grants.group_id == group_id, grants.resource_type == resource_type, grants.resource_id == resource_id)
+        .returning(grants)
+        .execution_options(synchronize_session=False, populate_existing=True)
+    )).scalars().first()
+    if removed is None:
+        return None
+    expanded = models.GroupGrantExpansion
+    affected = (await db.execute(
+        delete(expanded)
+        .where(expanded.group_id == group_id, expanded.resource_type == resource_type, expanded.resource_id == resource_id)
+        .returning(expanded.user_id)
+        .execution_options(synchronize_session=False)
+    )).scalars().all()
+    db.expunge(removed)
+    await _record_changes(db, (_decision_key(user_id, resource_type, resource_id) for user_id in affected))
+    await db.commit()
+    _invalidate_decisions((user_id,) for user_id in affected)
+    return removed
@@ -1,8 +1,11 @@
 import os
+import time
 
 from dotenv import load_dotenv
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 
 load_dotenv()
 
@@ -13,30 +16,136 @@ DB_HOST = os.getenv("DB_HOST")
 DB_PORT = os.getenv("DB_PORT")
 DB_NAME = os.getenv("POSTGRES_DB")
 
-if not all([DB_USER, DB_PASSWORD, DB_HOST, DB_PORT, DB_NAME]):
-    raise ValueError("One or more database connection environment variables are not set (POSTGRES_USER, POSTGRES_PASSWORD, DB_HOST, DB_PORT, POSTGRES_DB)")
+def database_url() -> str:
+    # DATABASE_URL if set, else built from the variables above. Checked when the engine is
+    # first created rather than on import, so importing the app needs no database settings.
+    url = os.getenv("DATABASE_URL")
+    if url:
+        return url
+    if not all([DB_USER, DB_PASSWORD, DB_HOST, DB_PORT, DB_NAME]):
+        raise ValueError("One or more database connection environment variables are not set (POSTGRES_USER, POSTGRES_PASSWORD, DB_HOST, DB_PORT, POSTGRES_DB)")
+    return f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 
-# Construct the DATABASE_URL
-DATABASE_URL = f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+def _env_flag(name: str, default: str) -> bool:
+    return os.getenv(name, default).strip().lower() in ("1", "true", "yes", "on")
 
-# Async engine for FastAPI
-engine = create_async_engine(DATABASE_URL, echo=True) # echo=True for logging SQL queries, remove in prod
+# Engine profile. Defaults suit production; set DB_ECHO=true to log every SQL statement.
+DB_ECHO = _env_flag("DB_ECHO", "false")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10")) # Connections kept open per worker
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10")) # Extra connections opened under load, closed when returned
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30")) # Seconds to wait for a free connection before failing
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800")) # Reconnect connections older than this many seconds; -1 disables
+DB_POOL_PRE_PING = _env_flag("DB_POOL_PRE_PING", "false") # Test connections on checkout (one extra round trip)
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "500")) # Prepared statements cached per connection; 0 disables
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0")) # Server-side statement_timeout; 0 disables
 
-# Async session
-AsyncSessionLocal = sessionmaker(
-    autocommit=False,
-    autoflush=False,
-    bind=engine,
-    class_=AsyncSession
-)
+
+class InstrumentedQueuePool(AsyncAdaptedQueuePool):
+    # Queue pool that also records how long checkouts wait for a free connection
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkouts = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.timeouts = 0
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            self.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - start
+            self.checkouts += 1
+            self.wait_seconds_total += waited
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+
+
+def _connect_args() -> dict:
+    connect_args = {"prepared_statement_cache_size": DB_STATEMENT_CACHE_SIZE}
+    if DB_STATEMENT_TIMEOUT_MS > 0:
+        connect_args["server_settings"] = {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)}
+    return connect_args
+
+def build_engine(url: str, **connect_args):
+    # Engine with the configured pool profile; the primary and any read replicas share it
+    return create_async_engine(
+        url,
+        echo=DB_ECHO,
+        poolclass=InstrumentedQueuePool,
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_pre_ping=DB_POOL_PRE_PING,
+        connect_args={**_connect_args(), **connect_args},
+    )
+
+# Async engine and sessions for FastAPI, created on first use (normally in the app
+# lifespan) so that importing the app does no work per worker
+_engine = None
+_sessionmaker = None
+
+def get_engine():
+    global _engine
+    if _engine is None:
+        _engine = build_engine(database_url())
+    return _engine
+
+async def dispose_engine() -> None:
+    # Closes the pool; the next get_engine() creates a fresh engine
+    global _engine, _sessionmaker
+    if _engine is not None:
+        await _engine.dispose()
+    _engine = _sessionmaker = None
+
+def __getattr__(name: str):
+    # The module-level engine, AsyncSessionLocal and DATABASE_URL of earlier releases
+    if name == "engine":
+        return get_engine()
+    if name == "AsyncSessionLocal":
+        return get_sessionmaker()
+    if name == "DATABASE_URL":
+        return database_url()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 Base = declarative_base()
 
 # Dependency to get DB session
 async def get_db():
-    async with AsyncSessionLocal() as session:
+    async with get_sessionmaker()() as session:
         yield session
 
+# Dependency for streaming endpoints. Sessions from get_db are closed before a
+# StreamingResponse body is sent, so streaming code opens its own from this factory.
+def get_sessionmaker():
+    global _sessionmaker
+    if _sessionmaker is None:
+        _sessionmaker = sessionmaker(autocommit=False, autoflush=False, bind=get_engine(), class_=AsyncSession)
+    return _sessionmaker
+
+def pool_status(pool=None) -> dict:
+    # Live counters of the connection pool, for sizing DB_POOL_SIZE/DB_MAX_OVERFLOW
+    pool = pool if pool is not None else get_engine().sync_engine.pool
+    status = {
+        "size": pool.size(),
+        "max_overflow": pool._max_overflow,
+        "checked_in": pool.checkedin(),
+        "checked_out": pool.checkedout(),
+        "overflow": max(pool.overflow(), 0),
+    }
+    if isinstance(pool, InstrumentedQueuePool):
+        status.update(
+            checkouts=pool.checkouts,
+            timeouts=pool.timeouts,
+            wait_seconds_total=round(pool.wait_seconds_total, 6),
+            wait_seconds_avg=round(pool.wait_seconds_total / pool.checkouts, 6) if pool.checkouts else 0.0,
+            wait_seconds_max=round(pool.wait_seconds_max, 6),
+        )
+    return status
+
 # For Alembic, it typically uses a synchronous engine for migrations.
 # If you need a synchronous engine for Alembic or other tools:
 # from sqlalchemy import create_engine
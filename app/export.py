@@ -0,0 +1,73 @@
+import csv
+import io
+from datetime import datetime
+from typing import AsyncIterator, Optional, Sequence
+from uuid import UUID
+
+import orjson
+
+# Encoders for streamed exports and list pages. Each batch of rows fetched from the
+# server-side cursor becomes one chunk of the response body; rows are plain SQLAlchemy
+# Row tuples, never ORM objects or Pydantic models. Values come straight from typed
+# columns, so they are encoded without being validated again.
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, UUID):
+        return str(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def _csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return value
+
+
+async def ndjson_chunks(columns: Sequence[str], batches: AsyncIterator[Sequence]) -> AsyncIterator[bytes]:
+    async for rows in batches:
+        yield b"".join(
+            orjson.dumps(dict(zip(columns, row)), default=_json_default, option=orjson.OPT_APPEND_NEWLINE)
+            for row in rows
+        )
+
+
+def page_json(columns: Sequence[str], rows: Sequence, total: Optional[int], next_cursor: Optional[str]) -> bytes:
+    # Same bytes FastAPI renders for an EntitlementList built from these rows: pydantic
+    # writes UTC datetimes with a trailing "Z", hence OPT_UTC_Z
+    items = [dict(zip(columns, row)) for row in rows]
+    return orjson.dumps(
+        {"items": items, "total": total, "next_cursor": next_cursor},
+        default=_json_default, option=orjson.OPT_UTC_Z,
+    )
+
+
+async def snapshot_chunks(parts: AsyncIterator[dict]) -> AsyncIterator[bytes]:
+    # One NDJSON line per header or batch of snapshot rows; rows stay positional arrays
+    async for part in parts:
+        yield orjson.dumps(part, default=_json_default, option=orjson.OPT_APPEND_NEWLINE)
+
+
+async def csv_chunks(columns: Sequence[str], batches: AsyncIterator[Sequence]) -> AsyncIterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    async for rows in batches:
+        writer.writerows([_csv_value(value) for value in row] for row in rows)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode() # Header only, when nothing matched
+
+
+EXPORT_FORMATS = {
+    "ndjson": (ndjson_chunks, "application/x-ndjson"),
+    "csv": (csv_chunks, "text/csv"),
+}
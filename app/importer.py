@@ -0,0 +1,229 @@
+import argparse
+import asyncio
+import codecs
+import csv
+import json
+import os
+import sys
+from typing import AsyncIterator, Callable, List, Optional, Tuple
+
+import asyncpg
+from pydantic import ValidationError
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import crud, schemas
+
+# Streaming import of NDJSON/CSV files. A parser task decodes and validates the input
+# incrementally and hands batches to the loader through a small bounded queue: while
+# one batch is being COPYed and merged the parser prepares at most IMPORT_QUEUE_BATCHES
+# more, then stops reading input until the loader catches up. Memory therefore stays
+# bounded by the batch size, not the file size.
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "5000"))
+IMPORT_QUEUE_BATCHES = int(os.getenv("IMPORT_QUEUE_BATCHES", "2"))
+IMPORT_MAX_REPORTED_ERRORS = int(os.getenv("IMPORT_MAX_REPORTED_ERRORS", "1000"))
+
+IMPORT_FORMATS = ("ndjson", "csv")
+_REQUIRED_FIELDS = ("user_id", "resource_type", "resource_id")
+
+Batch = List[Tuple[int, schemas.EntitlementCreate]]
+
+
+class ImportFormatError(ValueError):
+    """The input cannot be parsed at all, as opposed to a single bad row."""
+
+
+async def _lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    pending = ""
+    try:
+        async for chunk in chunks:
+            pending += decoder.decode(chunk)
+            *complete, pending = pending.split("\n")
+            for line in complete:
+                yield line
+        pending += decoder.decode(b"", final=True)
+    except UnicodeDecodeError as exc:
+        raise ImportFormatError(f"Input is not valid UTF-8: {exc}") from exc
+    if pending:
+        yield pending
+
+
+async def _ndjson_records(chunks: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, object]]:
+    line_no = 0
+    async for line in _lines(chunks):
+        line_no += 1
+        if not line.strip():
+            continue
+        try:
+            yield line_no, json.loads(line)
+        except json.JSONDecodeError as exc:
+            yield line_no, exc
+
+
+async def _csv_records(chunks: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, object]]:
+    header = None
+    line_no = 0
+    record_start = 0
+    record = ""
+    async for line in _lines(chunks):
+        line_no += 1
+        if not record:
+            record_start = line_no
+        record += line
+        # A quoted field may contain newlines; keep reading until the quotes balance
+        if record.count('"') % 2:
+            record += "\n"
+            continue
+        values = next(csv.reader([record.rstrip("\r")]), [])
+        record = ""
+        if header is None:
+            header = values
+            missing = [name for name in _REQUIRED_FIELDS if name not in header]
+            if missing:
+                raise ImportFormatError(f"CSV header is missing columns: {', '.join(missing)}")
+            continue
+        if not any(values):
+            continue
+        if len(values) != len(header):
+            yield record_start, ValueError(f"Expected {len(header)} columns, got {len(values)}")
+            continue
+        # Empty cells mean "not set", so optional columns fall back to their defaults
+        yield record_start, {name: value for name, value in zip(header, values) if value != ""}
+    if record:
+        yield record_start, ValueError("Unterminated quoted field")
+
+
+def _validate(record: object) -> schemas.EntitlementCreate:
+    if isinstance(record, Exception):
+        raise ValueError(str(record))
+    if not isinstance(record, dict):
+        raise ValueError("Expected a JSON object")
+    try:
+        entitlement = schemas.EntitlementCreate.model_validate(record)
+    except ValidationError as exc:
+        error = exc.errors()[0]
+        location = ".".join(str(part) for part in error["loc"])
+        raise ValueError(f"{location}: {error['msg']}" if location else error["msg"])
+    if not all([entitlement.user_id, entitlement.resource_type, entitlement.resource_id]):
+        raise ValueError("user_id, resource_type, and resource_id are required")
+    for name, value in entitlement:
+        if isinstance(value, str) and "\x00" in value:
+            raise ValueError(f"{name}: NUL characters are not allowed") # Postgres text cannot hold them
+    return entitlement
+
+
+def _reject(report: schemas.ImportReport, line: int, error: str, max_errors: int) -> None:
+    report.rejected += 1
+    if len(report.errors) < max_errors:
+        report.errors.append(schemas.ImportRowError(line=line, error=error))
+
+
+async def import_entitlements(
+    db: AsyncSession,
+    chunks: AsyncIterator[bytes],
+    format: str = "ndjson",
+    mode: str = "upsert",
+    batch_size: int = IMPORT_BATCH_SIZE,
+    max_errors: int = IMPORT_MAX_REPORTED_ERRORS,
+    on_progress: Optional[Callable[[schemas.ImportReport], None]] = None,
+) -> schemas.ImportReport:
+    if format not in IMPORT_FORMATS:
+        raise ImportFormatError(f"Unsupported format: {format}")
+    records = _ndjson_records(chunks) if format == "ndjson" else _csv_records(chunks)
+    report = schemas.ImportReport()
+    queue: "asyncio.Queue[Optional[Batch]]" = asyncio.Queue(maxsize=IMPORT_QUEUE_BATCHES)
+
+    async def parse():
+        batch: Batch = []
+        try:
+            async for line, record in records:
+                report.processed += 1
+                try:
+                    batch.append((line, _validate(record)))
+                except ValueError as exc:
+                    _reject(report, line, str(exc), max_errors)
+                    continue
+                if len(batch) >= batch_size:
+                    await queue.put(batch)
+                    batch = []
+            if batch:
+                await queue.put(batch)
+        except Exception:
+            await queue.put(None) # Wake the loader so it can surface the error
+            raise
+        await queue.put(None)
+
+    parser = asyncio.create_task(parse())
+    try:
+        while (batch := await queue.get()) is not None:
+            try:
+                counts = await crud.import_entitlements_batch(db, batch, mode=mode)
+            except (SQLAlchemyError, asyncpg.PostgresError) as exc:
+                # Only this batch is lost; the rest of the file still gets imported. The COPY
+                # runs on the driver connection, so its errors are not wrapped by SQLAlchemy.
+                await db.rollback()
+                for line, _ in batch:
+                    _reject(report, line, f"Batch failed: {getattr(exc, 'orig', None) or exc}", max_errors)
+                counts = {}
+            report.inserted += counts.get("inserted", 0)
+            report.updated += counts.get("updated", 0)
+            report.skipped += counts.get("skipped", 0)
+            report.batches += 1
+            if on_progress is not None:
+                on_progress(report)
+        await parser # Surface file-level errors raised while parsing
+    finally:
+        if not parser.done():
+            parser.cancel()
+    return report
+
+
+async def _read_file(path: str, chunk_size: int = 1 << 16) -> AsyncIterator[bytes]:
+    with open(path, "rb") as file:
+        while chunk := await asyncio.to_thread(file.read, chunk_size):
+            yield chunk
+
+
+async def _main(args: argparse.Namespace) -> int:
+    from .audit import audit_log
+    from .database import dispose_engine, get_sessionmaker
+
+    def progress(report: schemas.ImportReport) -> None:
+        print(
+            f"batch {report.batches}: processed={report.processed} inserted={report.inserted} "
+            f"updated={report.updated} skipped={report.skipped} rejected={report.rejected}",
+            file=sys.stderr,
+        )
+
+    audit_log.start() # Imported rows are audited as they would be through the API
+    try:
+        async with get_sessionmaker()() as session:
+            report = await import_entitlements(
+                session, _read_file(args.path), format=args.format, mode=args.mode,
+                batch_size=args.batch_size, on_progress=progress,
+            )
+    except ImportFormatError as exc:
+        print(f"error: {exc}", file=sys.stderr)
+        return 2
+    finally:
+        await audit_log.stop()
+        await dispose_engine()
+    print(report.model_dump_json(indent=2))
+    return 1 if report.rejected else 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Import entitlements from an NDJSON or CSV file.")
+    parser.add_argument("path", help="File to import")
+    parser.add_argument("--format", choices=IMPORT_FORMATS, help="Input format (default: from the file extension)")
+    parser.add_argument("--mode", choices=("upsert", "insert"), default="upsert", help="'insert' skips entitlements that already exist")
+    parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE, help="Rows per COPY batch")
+    args = parser.parse_args(argv)
+    if args.format is None:
+        args.format = "csv" if args.path.lower().endswith(".csv") else "ndjson"
+    return asyncio.run(_main(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
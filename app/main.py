@@ -1,31 +1,66 @@
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
 from dotenv import load_dotenv
 import os
 
-from app.routers import entitlements
-from app.database import engine, Base # Make sure Base is imported
+from app import metrics, migrations, replicas
+from app.audit import audit_log
+from app.cache import decision_cache
+from app.singleflight import SingleFlightTimeout, singleflight
+from app.sweeper import SWEEPER_ENABLED, sweeper
+from app.routers import entitlements, groups, resources
+from app.database import dispose_engine, get_engine, pool_status
 
 # Load environment variables from .env file
 load_dotenv()
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The engines, primary and replicas, are created here rather than on import. With the schema current, startup
+    # costs a schema version check; see app/migrations.py for SCHEMA_ON_STARTUP.
+    engine = get_engine()
+    metrics.instrument_engine(engine)
+    for replica in replicas.get_replica_set().replicas:
+        metrics.instrument_engine(replica.engine)
+    await migrations.prepare_schema(engine)
+    audit_log.start()
+    if SWEEPER_ENABLED:
+        sweeper.start()
+    yield
+    await sweeper.stop()
+    await audit_log.stop() # Drains events still queued, including the sweeper's
+    await replicas.dispose_replica_set()
+    await dispose_engine()
+
 app = FastAPI(
     title=os.getenv("APP_NAME", "Entitlements Service"),
     version="0.1.0",
-    description="API for managing entitlements."
+    description="API for managing entitlements.",
+    lifespan=lifespan
 )
 
 API_V1_STR = os.getenv("API_V1_STR", "/api/v1")
 
+# Per-route request latency and status counts, plus per-statement query timing
+app.add_middleware(replicas.WriteLSNMiddleware)
+app.add_middleware(metrics.MetricsMiddleware)
+metrics.register_gauges("db_replicas", "Read replica routing statistic.", lambda: replicas.get_replica_set().stats())
+metrics.register_gauges("decision_cache", "Decision cache counter.", decision_cache.stats)
+metrics.register_gauges("db_pool", "Connection pool statistic.", pool_status)
+metrics.register_gauges("singleflight", "Coalesced read counter.", singleflight.stats)
+metrics.register_gauges("expiry_sweeper", "Expiry sweeper counter.", sweeper.stats)
+metrics.register_gauges("audit", "Audit writer counter.", audit_log.stats)
+
 app.include_router(entitlements.router, prefix=API_V1_STR + "/entitlements", tags=["entitlements"])
+app.include_router(groups.router, prefix=API_V1_STR + "/groups", tags=["groups"])
+app.include_router(resources.router, prefix=API_V1_STR + "/resources", tags=["resources"])
 
-@app.on_event("startup")
-async def startup_event():
-    # This will create tables based on your SQLAlchemy models.
-    # Suitable for development. For production, consider a more robust migration strategy
-    # if you anticipate schema changes.
-    async with engine.begin() as conn:
-        # await conn.run_sync(Base.metadata.drop_all) # Optional: drop tables for a clean start during dev
-        await conn.run_sync(Base.metadata.create_all)
+@app.exception_handler(SingleFlightTimeout)
+async def singleflight_timeout_handler(request: Request, exc: SingleFlightTimeout):
+    # The database did not answer a (possibly shared) read in time; the client may retry
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": "1"})
 
 @app.get("/", tags=["Root"])
 async def read_root():
@@ -34,3 +69,27 @@ async def read_root():
 @app.get("/health", tags=["Health"])
 async def health_check():
     return {"status": "healthy"}
+
+@app.get("/health/pool", tags=["Health"])
+async def pool_health():
+    return pool_status()
+
+@app.get("/health/replicas", tags=["Health"])
+async def replica_health():
+    return replicas.get_replica_set().stats()
+
+@app.get("/health/singleflight", tags=["Health"])
+async def singleflight_health():
+    return singleflight.stats()
+
+@app.get("/health/sweeper", tags=["Health"])
+async def sweeper_health():
+    return sweeper.stats()
+
+@app.get("/health/audit", tags=["Health"])
+async def audit_health():
+    return audit_log.stats()
+
+@app.get("/metrics", tags=["Health"], response_class=PlainTextResponse)
+async def read_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,214 @@
+import functools
+import inspect
+import logging
+import os
+import random
+import time
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+
+# Minimal in-process metrics registry rendered in the Prometheus text format.
+# Request and query latencies are recorded for a METRICS_SAMPLE_RATE fraction of
+# observations; counters are always exact. With sampling turned down the hooks
+# cost two clock reads and a random() call per request or statement.
+METRICS_SAMPLE_RATE = float(os.getenv("METRICS_SAMPLE_RATE", "1.0"))
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv("SLOW_QUERY_THRESHOLD_MS", "500")) # 0 disables the slow query log
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+logger = logging.getLogger("app.slow_queries")
+
+# The ASGI scope of the request being served, and the crud function currently running.
+# The scope is read lazily because the route is only known once routing has happened.
+_request_scope: ContextVar[Optional[dict]] = ContextVar("request_scope", default=None)
+_operation: ContextVar[Optional[str]] = ContextVar("operation", default=None)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, labels)} {value:g}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts..., +Inf count, sum]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        series = self._values.get(labels)
+        if series is None:
+            series = self._values[labels] = [0.0] * (len(self.buckets) + 2)
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[index] += 1
+                break
+        else:
+            series[len(self.buckets)] += 1
+        series[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for labels, series in sorted(self._values.items()):
+            cumulative = 0.0
+            for bound, count in zip(self.buckets + (float("inf"),), series):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                bucket_label = f'le="{le}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, bucket_label)} {cumulative:g}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {series[-1]:.6f}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative:g}")
+        return lines
+
+
+REQUESTS = Counter("http_requests_total", "HTTP requests by route and status code.", ("method", "route", "status"))
+REQUEST_LATENCY = Histogram("http_request_duration_seconds", "HTTP request latency (sampled).", ("method", "route"))
+QUERIES = Counter("db_queries_total", "SQL statements by route and crud function.", ("route", "operation"))
+QUERY_LATENCY = Histogram("db_query_duration_seconds", "SQL statement latency (sampled).", ("route", "operation"))
+SLOW_QUERIES = Counter("db_slow_queries_total", "SQL statements slower than SLOW_QUERY_THRESHOLD_MS.", ("route", "operation"))
+
+_METRICS = [REQUESTS, REQUEST_LATENCY, QUERIES, QUERY_LATENCY, SLOW_QUERIES]
+_gauges: List[Tuple[str, str, Callable[[], Dict[str, float]]]] = []
+
+
+def register_gauges(prefix: str, help: str, collect: Callable[[], Dict[str, float]]) -> None:
+    # Exposes every numeric value of collect() as the gauge <prefix>_<key> at scrape time
+    _gauges.append((prefix, help, collect))
+
+
+def render() -> str:
+    lines: List[str] = []
+    for metric in _METRICS:
+        lines.extend(metric.render())
+    for prefix, help, collect in _gauges:
+        for key, value in collect().items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                lines.append(f"# HELP {prefix}_{key} {help}")
+                lines.append(f"# TYPE {prefix}_{key} gauge")
+                lines.append(f"{prefix}_{key} {value:g}")
+    return "\n".join(lines) + "\n"
+
+
+def _sampled() -> bool:
+    return METRICS_SAMPLE_RATE >= 1.0 or random.random() < METRICS_SAMPLE_RATE
+
+
+def _route_label(scope: Optional[dict]) -> str:
+    if scope is None:
+        return "none" # Outside of a request, e.g. a CLI or background task
+    route = scope.get("route")
+    # The route template, never the raw path, to keep label cardinality bounded
+    return getattr(route, "path", None) or "unmatched"
+
+
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        token = _request_scope.set(scope)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _request_scope.reset(token)
+            # Measured until the last body chunk was sent, so streamed responses count in full
+            route = _route_label(scope)
+            REQUESTS.inc(scope["method"], route, str(status))
+            if _sampled():
+                REQUEST_LATENCY.observe(time.perf_counter() - start, scope["method"], route)
+
+
+def track_operation(func):
+    # Attributes SQL issued while func runs to it, so query metrics show which crud call made them
+    name = func.__name__
+
+    if inspect.isasyncgenfunction(func):
+        @functools.wraps(func)
+        async def generator_wrapper(*args, **kwargs):
+            # Async generators run in their consumer's context; restore rather than reset the token
+            previous = _operation.get()
+            _operation.set(name)
+            try:
+                async for item in func(*args, **kwargs):
+                    yield item
+            finally:
+                _operation.set(previous)
+        return generator_wrapper
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        token = _operation.set(name)
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            _operation.reset(token)
+    return wrapper
+
+
+def instrument_engine(engine) -> None:
+    sync_engine = getattr(engine, "sync_engine", engine)
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context._metrics_start = time.perf_counter()
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start = getattr(context, "_metrics_start", None)
+        if start is None:
+            return
+        elapsed = time.perf_counter() - start
+        route = _route_label(_request_scope.get())
+        operation = _operation.get() or "other"
+        QUERIES.inc(route, operation)
+        if _sampled():
+            QUERY_LATENCY.observe(elapsed, route, operation)
+        if SLOW_QUERY_THRESHOLD_MS > 0 and elapsed * 1000 >= SLOW_QUERY_THRESHOLD_MS:
+            SLOW_QUERIES.inc(route, operation)
+            # Parameter values may hold user or resource ids; only their count is logged
+            count = len(parameters) if isinstance(parameters, (list, tuple, dict)) else 0
+            logger.warning(
+                "Slow query (%.1f ms) route=%s operation=%s parameters=<%d redacted>: %s",
+                elapsed * 1000, route, operation, count, " ".join(statement.split()),
+            )
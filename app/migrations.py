@@ -0,0 +1,397 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+from typing import Awaitable, Callable, List, NamedTuple, Optional
+
+from sqlalchemy import func, insert, select, text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, AsyncSession
+
+from app import crud, models
+from app.partitioning import LEGACY_INDEXES
+
+# Versioned schema changes. Each migration runs once per database, in its own
+# transaction, and is recorded in schema_version. A Postgres advisory lock serializes
+# runners, so any number of workers can start at once: one applies what is pending
+# while the others wait, then find nothing left to do.
+#
+#   python -m app.migrations upgrade             # apply pending migrations
+#   python -m app.migrations status              # exit status 1 if any are pending
+#   python -m app.migrations duplicates [--merge]
+#       list entitlements sharing a (user_id, resource_type, resource_id) key, which
+#       block migration 2, or keep one row per key and print the deleted ones
+#
+# SCHEMA_ON_STARTUP picks what the app lifespan does:
+#   migrate  apply pending migrations (the default; a single version read when current)
+#   check    only read the version and refuse to start if migrations are pending, for
+#            deployments that run `upgrade` as a separate step
+#   off      nothing
+# A schema newer than this release is accepted, so older workers keep running during a
+# rolling upgrade. Append a Migration below for every schema change.
+SCHEMA_ON_STARTUP = os.getenv("SCHEMA_ON_STARTUP", "migrate").strip().lower()
+
+# Advisory lock key held while migrating
+_MIGRATION_LOCK = 0x656e7473
+
+# Duplicate keys quoted in a DuplicateKeysError
+_DUPLICATE_EXAMPLES = 5
+
+logger = logging.getLogger(__name__)
+
+
+class SchemaVersionError(Exception):
+    """The database schema is older than this release."""
+
+
+class DuplicateKeysError(Exception):
+    """Existing rows would violate a unique constraint a migration adds."""
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    apply: Callable[[AsyncConnection], Awaitable[None]]
+
+
+# The DDL of each migration is fixed once released: a later schema change is a new
+# migration, never an edit of an earlier one, so every database passes through the same
+# schemas whatever release it was created by. The statements are idempotent because
+# databases created before migrations existed already hold some of these objects.
+
+def _entitlements_table() -> List[str]:
+    # The partition layout is deployment configuration (ENTITLEMENTS_PARTITION_BY), not
+    # part of a version; the partition key has to be in the primary key
+    partition_by = models.ENTITLEMENTS_PARTITION_BY
+    primary_key = "id" if partition_by == "none" else f"id, {partition_by}"
+    partitioning = f" PARTITION BY {models.PARTITION_METHODS[partition_by]}" if partition_by != "none" else ""
+    return [f"""CREATE TABLE IF NOT EXISTS entitlements (
+        id UUID NOT NULL,
+        user_id VARCHAR NOT NULL,
+        resource_type VARCHAR NOT NULL,
+        resource_id VARCHAR NOT NULL,
+        access_level VARCHAR,
+        is_active BOOLEAN,
+        created_at TIMESTAMP WITH TIME ZONE DEFAULT now(),
+        updated_at TIMESTAMP WITH TIME ZONE,
+        expires_at TIMESTAMP WITH TIME ZONE,
+        description TEXT,
+        granted_by VARCHAR,
+        version INTEGER DEFAULT 1 NOT NULL,
+        PRIMARY KEY ({primary_key}),
+        CONSTRAINT uq_entitlements_user_resource UNIQUE (user_id, resource_type, resource_id)
+    ){partitioning}"""]
+
+
+_V1_TABLES = [
+    """CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER NOT NULL,
+        description VARCHAR NOT NULL,
+        applied_at TIMESTAMP WITH TIME ZONE DEFAULT now() NOT NULL,
+        PRIMARY KEY (version)
+    )""",
+    """CREATE TABLE IF NOT EXISTS resource_links (
+        resource_type VARCHAR NOT NULL,
+        resource_id VARCHAR NOT NULL,
+        parent_type VARCHAR NOT NULL,
+        parent_id VARCHAR NOT NULL,
+        created_at TIMESTAMP WITH TIME ZONE DEFAULT now(),
+        PRIMARY KEY (resource_type, resource_id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS resource_ancestors (
+        resource_type VARCHAR NOT NULL,
+        resource_id VARCHAR NOT NULL,
+        ancestor_type VARCHAR NOT NULL,
+        ancestor_id VARCHAR NOT NULL,
+        depth INTEGER NOT NULL,
+        PRIMARY KEY (resource_type, resource_id, ancestor_type, ancestor_id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS groups (
+        group_id VARCHAR NOT NULL,
+        description TEXT,
+        created_at TIMESTAMP WITH TIME ZONE DEFAULT now(),
+        PRIMARY KEY (group_id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS group_members (
+        group_id VARCHAR NOT NULL REFERENCES groups (group_id) ON DELETE CASCADE,
+        user_id VARCHAR NOT NULL,
+        created_at TIMESTAMP WITH TIME ZONE DEFAULT now(),
+        PRIMARY KEY (group_id, user_id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS group_grants (
+        group_id VARCHAR NOT NULL REFERENCES groups (group_id) ON DELETE CASCADE,
+        resource_type VARCHAR NOT NULL,
+        resource_id VARCHAR NOT NULL,
+        access_level VARCHAR,
+        is_active BOOLEAN,
+        expires_at TIMESTAMP WITH TIME ZONE,
+        description TEXT,
+        granted_by VARCHAR,
+        created_at TIMESTAMP WITH TIME ZONE DEFAULT now(),
+        updated_at TIMESTAMP WITH TIME ZONE,
+        PRIMARY KEY (group_id, resource_type, resource_id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS group_grant_expansion (
+        user_id VARCHAR NOT NULL,
+        resource_type VARCHAR NOT NULL,
+        resource_id VARCHAR NOT NULL,
+        group_id VARCHAR NOT NULL REFERENCES groups (group_id) ON DELETE CASCADE,
+        access_level VARCHAR,
+        is_active BOOLEAN,
+        expires_at TIMESTAMP WITH TIME ZONE,
+        created_at TIMESTAMP WITH TIME ZONE DEFAULT now(),
+        PRIMARY KEY (user_id, resource_type, resource_id, group_id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS change_sequence (
+        id SERIAL NOT NULL,
+        seq BIGINT NOT NULL,
+        pruned_through BIGINT DEFAULT '0' NOT NULL,
+        PRIMARY KEY (id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS entitlement_changes (
+        id BIGSERIAL NOT NULL,
+        seq BIGINT NOT NULL,
+        user_id VARCHAR,
+        resource_type VARCHAR NOT NULL,
+        resource_id VARCHAR NOT NULL,
+        changed_at TIMESTAMP WITH TIME ZONE DEFAULT now(),
+        PRIMARY KEY (id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS entitlement_audit (
+        id BIGSERIAL NOT NULL,
+        occurred_at TIMESTAMP WITH TIME ZONE NOT NULL,
+        action VARCHAR NOT NULL,
+        entitlement_id UUID NOT NULL,
+        user_id VARCHAR NOT NULL,
+        resource_type VARCHAR NOT NULL,
+        resource_id VARCHAR NOT NULL,
+        actor VARCHAR,
+        before JSONB,
+        after JSONB,
+        PRIMARY KEY (id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS entitlement_counters (
+        slot INTEGER NOT NULL,
+        resource_type VARCHAR NOT NULL,
+        access_level VARCHAR NOT NULL,
+        is_active BOOLEAN NOT NULL,
+        count BIGINT NOT NULL,
+        PRIMARY KEY (slot, resource_type, access_level, is_active)
+    )""",
+]
+
+# Indexes of version 1; migration 2 adds them to tables of earlier releases
+_V1_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS ix_entitlements_created_at_id ON entitlements (created_at, id)",
+    "CREATE INDEX IF NOT EXISTS ix_entitlements_user_created_at ON entitlements (user_id, created_at, id)",
+    "CREATE INDEX IF NOT EXISTS ix_entitlements_resource_created_at ON entitlements (resource_type, resource_id, created_at, id)",
+    "CREATE INDEX IF NOT EXISTS ix_entitlements_active_grants ON entitlements (user_id, resource_type, resource_id) "
+    "INCLUDE (access_level, expires_at, created_at) WHERE is_active",
+    "CREATE INDEX IF NOT EXISTS ix_entitlements_active_expires_at ON entitlements (expires_at) WHERE is_active AND expires_at IS NOT NULL",
+    "CREATE INDEX IF NOT EXISTS ix_resource_ancestors_ancestor ON resource_ancestors (ancestor_type, ancestor_id)",
+    "CREATE INDEX IF NOT EXISTS ix_group_members_user_id ON group_members (user_id)",
+    "CREATE INDEX IF NOT EXISTS ix_group_grant_expansion_active_expires_at ON group_grant_expansion (expires_at) "
+    "WHERE is_active AND expires_at IS NOT NULL",
+    "CREATE INDEX IF NOT EXISTS ix_entitlement_changes_seq ON entitlement_changes (seq)",
+    "CREATE INDEX IF NOT EXISTS ix_entitlement_audit_user_occurred_at ON entitlement_audit (user_id, occurred_at, id)",
+    "CREATE INDEX IF NOT EXISTS ix_entitlement_audit_resource_occurred_at ON entitlement_audit (resource_type, resource_id, occurred_at, id)",
+]
+
+_V4_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS ix_entitlements_active_by_resource ON entitlements (resource_type, resource_id, user_id) "
+    "INCLUDE (access_level, expires_at) WHERE is_active",
+    "CREATE INDEX IF NOT EXISTS ix_group_grant_expansion_active_grants ON group_grant_expansion (user_id, resource_type, resource_id) "
+    "INCLUDE (access_level, expires_at, created_at) WHERE is_active",
+    "CREATE INDEX IF NOT EXISTS ix_group_grant_expansion_active_by_resource ON group_grant_expansion (resource_type, resource_id, user_id) "
+    "INCLUDE (access_level, expires_at) WHERE is_active",
+]
+
+# Key added by migration 2 to entitlements tables of earlier releases
+_ENTITLEMENTS_KEY = ("uq_entitlements_user_resource", ["user_id", "resource_type", "resource_id"])
+
+
+async def _execute(conn: AsyncConnection, statements: List[str]) -> None:
+    for statement in statements:
+        await conn.execute(text(statement))
+
+
+async def _create_tables(conn: AsyncConnection) -> None:
+    created = not await _relation_exists(conn, models.Entitlement.__tablename__)
+    await _execute(conn, _V1_TABLES + _entitlements_table())
+    if created:
+        await _execute(conn, models.partition_statements(models.Entitlement.__tablename__))
+    await _execute(conn, _V1_INDEXES)
+
+
+async def _upgrade_tables(conn: AsyncConnection) -> None:
+    # CREATE TABLE IF NOT EXISTS skips tables that exist, so the key, column and indexes
+    # version 1 added to tables of earlier releases are added here. On a large
+    # entitlements table, build its indexes with `python -m app.partitioning indexes`
+    # first: that does not block writes, this does.
+    await conn.execute(text("ALTER TABLE entitlements ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1"))
+    name, columns = _ENTITLEMENTS_KEY
+    if not await _relation_exists(conn, name):
+        await _check_duplicates(conn, models.Entitlement.__tablename__, name, columns)
+        await conn.execute(text(f"ALTER TABLE entitlements ADD CONSTRAINT {name} UNIQUE ({', '.join(columns)})"))
+    await _execute(conn, _V1_INDEXES)
+
+
+async def _check_duplicates(conn: AsyncConnection, table: str, constraint: str, columns: List[str]) -> None:
+    # Fails before the ALTER, which would otherwise abort with a bare IntegrityError,
+    # naming a few of the keys to fix. Rows are never merged implicitly.
+    key = ", ".join(columns)
+    duplicates = f"SELECT {key}, count(*) AS rows FROM {table} GROUP BY {key} HAVING count(*) > 1"
+    total = (await conn.execute(text(f"SELECT count(*) FROM ({duplicates}) AS duplicates"))).scalar_one()
+    if not total:
+        return
+    examples = (await conn.execute(text(f"{duplicates} LIMIT {_DUPLICATE_EXAMPLES}"))).mappings().all()
+    merge = " Run python -m app.migrations duplicates --merge to keep one row per key." if table == models.Entitlement.__tablename__ else ""
+    raise DuplicateKeysError(
+        f"Cannot add {constraint}: {total} keys of {table} are held by several rows, "
+        f"e.g. {', '.join(json.dumps(dict(row), default=str) for row in examples)}.{merge}"
+    )
+
+
+async def _create_lookup_indexes(conn: AsyncConnection) -> None:
+    await _execute(conn, _V4_INDEXES)
+
+
+async def _drop_legacy_indexes(conn: AsyncConnection) -> None:
+    # The single-column indexes of releases before the composite ones, which only cost
+    # writes now. `python -m app.partitioning indexes` drops them without blocking writes.
+    await _execute(conn, [f"DROP INDEX IF EXISTS {name}" for name in LEGACY_INDEXES])
+
+
+async def _count_entitlements(conn: AsyncConnection) -> None:
+    # The counters table is new to databases that already hold entitlements
+    async with AsyncSession(bind=conn) as session:
+        await crud.rebuild_counters(session)
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, "Create missing tables", _create_tables),
+    Migration(2, "Add keys and indexes to tables created by earlier releases", _upgrade_tables),
+    Migration(3, "Count existing entitlements into entitlement_counters", _count_entitlements),
+    Migration(4, "Add covering indexes for lookups by resource and of group grants", _create_lookup_indexes),
+    Migration(5, "Drop single-column entitlements indexes replaced by composite ones", _drop_legacy_indexes),
+]
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+async def _relation_exists(conn: AsyncConnection, name: str) -> bool:
+    return (await conn.execute(text("SELECT to_regclass(:name) IS NOT NULL"), {"name": name})).scalar_one()
+
+
+async def current_version(conn: AsyncConnection) -> int:
+    # 0 for a database no migration has run against
+    if not await _relation_exists(conn, models.SchemaVersion.__tablename__):
+        return 0
+    return (await conn.execute(select(func.coalesce(func.max(models.SchemaVersion.version), 0)))).scalar_one()
+
+
+async def check_schema(engine: AsyncEngine) -> int:
+    # Returns the database's schema version; raises SchemaVersionError if it is behind
+    async with engine.connect() as conn:
+        version = await current_version(conn)
+    if version < LATEST_VERSION:
+        raise SchemaVersionError(
+            f"Database schema is at version {version}, this release needs {LATEST_VERSION}; run python -m app.migrations upgrade"
+        )
+    return version
+
+
+async def migrate(engine: AsyncEngine) -> List[int]:
+    # Applies pending migrations; returns the versions applied by this call
+    async with engine.connect() as conn:
+        # AUTOCOMMIT, so the session-level lock is not tied to a transaction of this connection
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        if await current_version(conn) >= LATEST_VERSION:
+            return []
+        await conn.execute(text("SELECT pg_advisory_lock(:key)"), {"key": _MIGRATION_LOCK})
+        try:
+            # Read again: another runner may have migrated while this one waited for the lock
+            version = await current_version(conn)
+            applied = []
+            for migration in MIGRATIONS:
+                if migration.version <= version:
+                    continue
+                async with engine.begin() as migration_conn:
+                    await migration.apply(migration_conn)
+                    await migration_conn.execute(insert(models.SchemaVersion).values(
+                        version=migration.version, description=migration.description,
+                    ))
+                logger.info("Applied migration %d: %s", migration.version, migration.description)
+                applied.append(migration.version)
+            return applied
+        finally:
+            await conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": _MIGRATION_LOCK})
+
+
+async def prepare_schema(engine: AsyncEngine, mode: str = SCHEMA_ON_STARTUP) -> None:
+    # Startup step of the app lifespan, per SCHEMA_ON_STARTUP
+    if mode == "migrate":
+        await migrate(engine)
+    elif mode == "check":
+        await check_schema(engine)
+    elif mode != "off":
+        raise ValueError(f"SCHEMA_ON_STARTUP must be migrate, check or off, not {mode!r}")
+
+
+async def _duplicates(merge: bool) -> int:
+    from .audit import audit_log
+    from .database import get_sessionmaker
+
+    audit_log.start() # Merged rows are audited as deletes through the API would be
+    try:
+        async with get_sessionmaker()() as session:
+            rows = await (crud.merge_duplicate_entitlements(session) if merge else crud.duplicate_entitlement_keys(session))
+    finally:
+        await audit_log.stop()
+    for row in rows:
+        print(json.dumps(row))
+    if merge:
+        print(f"deleted {len(rows)} duplicate entitlements", file=sys.stderr)
+        return 0
+    print(f"{len(rows)} keys have duplicate entitlements", file=sys.stderr)
+    return 1 if rows else 0
+
+
+async def _main(args: argparse.Namespace) -> int:
+    from .database import dispose_engine, get_engine
+
+    if args.command == "duplicates":
+        try:
+            return await _duplicates(args.merge)
+        finally:
+            await dispose_engine()
+    engine = get_engine()
+    try:
+        if args.command == "upgrade":
+            applied = await migrate(engine)
+            print(f"applied {len(applied)} migrations; schema is at version {LATEST_VERSION}" if applied
+                  else f"schema is up to date (version {LATEST_VERSION})", file=sys.stderr)
+            return 0
+        async with engine.connect() as conn:
+            version = await current_version(conn)
+    finally:
+        await dispose_engine()
+    for migration in MIGRATIONS:
+        print(f"{migration.version:>4}  {'applied' if migration.version <= version else 'pending'}  {migration.description}")
+    return 1 if version < LATEST_VERSION else 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    logging.basicConfig(format="%(message)s")
+    logger.setLevel(logging.INFO) # Report each migration applied, without the engine's own logs
+    parser = argparse.ArgumentParser(description="Apply or inspect versioned schema migrations.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("upgrade", help="Apply pending migrations")
+    commands.add_parser("status", help="List migrations; exit status 1 if any are pending")
+    duplicates = commands.add_parser("duplicates", help="List keys held by several entitlements; exit status 1 if any")
+    duplicates.add_argument("--merge", action="store_true", help="Keep the row a check would honor per key and delete the others")
+    return asyncio.run(_main(parser.parse_args(argv)))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,20 +1,93 @@
+import os
+import re
 import uuid
+from typing import List, Sequence
 
-from sqlalchemy import Boolean, Column, DateTime, ForeignKey, String, Text
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy import (BigInteger, Boolean, Column, DateTime, ForeignKey,
+                        Index, Integer, String, Text, UniqueConstraint, event,
+                        text)
+from sqlalchemy.dialects.postgresql import JSONB, UUID
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 
 from app.database import Base
 
+# Optional declarative partitioning of the entitlements table, for deployments where a
+# single table and its indexes have grown too large to vacuum comfortably:
+#   user_id        HASH (user_id) into ENTITLEMENTS_HASH_PARTITIONS partitions
+#   resource_type  LIST (resource_type), one partition per ENTITLEMENTS_LIST_PARTITIONS
+#                  value plus a default partition for any other type
+# The partition key has to be part of the primary key, so it becomes (id, <key>).
+# Partitions are created together with the table; app/partitioning.py migrates an
+# existing unpartitioned table.
+ENTITLEMENTS_PARTITION_BY = os.getenv("ENTITLEMENTS_PARTITION_BY", "none").strip().lower() # none, user_id or resource_type
+ENTITLEMENTS_HASH_PARTITIONS = int(os.getenv("ENTITLEMENTS_HASH_PARTITIONS", "16"))
+ENTITLEMENTS_LIST_PARTITIONS = [value.strip() for value in os.getenv("ENTITLEMENTS_LIST_PARTITIONS", "document,collection,tool_feature").split(",") if value.strip()]
+
+PARTITION_METHODS = {"user_id": "HASH (user_id)", "resource_type": "LIST (resource_type)"}
+
+if ENTITLEMENTS_PARTITION_BY not in ("none", *PARTITION_METHODS):
+    raise ValueError(f"ENTITLEMENTS_PARTITION_BY must be one of none, {', '.join(PARTITION_METHODS)}")
+
+
+def partition_statements(
+    table: str,
+    partition_by: str = ENTITLEMENTS_PARTITION_BY,
+    hash_partitions: int = ENTITLEMENTS_HASH_PARTITIONS,
+    list_partitions: Sequence[str] = ENTITLEMENTS_LIST_PARTITIONS
+) -> List[str]:
+    # CREATE TABLE ... PARTITION OF statements for every partition of `table`
+    if partition_by == "user_id":
+        return [
+            f"CREATE TABLE {table}_p{remainder} PARTITION OF {table} FOR VALUES WITH (MODULUS {hash_partitions}, REMAINDER {remainder})"
+            for remainder in range(hash_partitions)
+        ]
+    if partition_by == "resource_type":
+        statements = []
+        for value in list_partitions:
+            suffix = re.sub(r"[^a-z0-9]+", "_", value.lower()).strip("_")
+            literal = value.replace("'", "''")
+            statements.append(f"CREATE TABLE {table}_{suffix} PARTITION OF {table} FOR VALUES IN ('{literal}')")
+        statements.append(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT")
+        return statements
+    return []
+
 
 class Entitlement(Base):
     __tablename__ = "entitlements"
+    __table_args__ = (
+        # One entitlement per user and resource; also the conflict target for bulk upserts.
+        # Its index serves lookups by user, user and type, and user, type and id.
+        UniqueConstraint("user_id", "resource_type", "resource_id", name="uq_entitlements_user_resource"),
+        # Keyset pagination order of the list endpoint, unfiltered and per user or resource,
+        # so a filtered page is one index range scan with no sort
+        Index("ix_entitlements_created_at_id", "created_at", "id"),
+        Index("ix_entitlements_user_created_at", "user_id", "created_at", "id"),
+        Index("ix_entitlements_resource_created_at", "resource_type", "resource_id", "created_at", "id"),
+        # Grants that can be in effect, with the columns a check reads, so checks are
+        # index-only scans that skip revoked rows. A predicate cannot use now(), so rows
+        # past expires_at stay in it until the sweeper deactivates them.
+        Index(
+            "ix_entitlements_active_grants", "user_id", "resource_type", "resource_id",
+            postgresql_include=["access_level", "expires_at", "created_at"],
+            postgresql_where=text("is_active"),
+        ),
+        # The same grants by resource, for reverse lookups of the users who can access a
+        # set of resources
+        Index(
+            "ix_entitlements_active_by_resource", "resource_type", "resource_id", "user_id",
+            postgresql_include=["access_level", "expires_at"],
+            postgresql_where=text("is_active"),
+        ),
+        # Pending expiries, in the order the sweeper deactivates them
+        Index("ix_entitlements_active_expires_at", "expires_at", postgresql_where=text("is_active AND expires_at IS NOT NULL")),
+        {"postgresql_partition_by": PARTITION_METHODS[ENTITLEMENTS_PARTITION_BY]} if ENTITLEMENTS_PARTITION_BY != "none" else {},
+    )
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    user_id = Column(String, nullable=False, index=True) # ID of the user from an external system
-    resource_type = Column(String, nullable=False, index=True) # e.g., 'collection', 'document', 'tool_feature'
-    resource_id = Column(String, nullable=False, index=True) # ID of the resource being entitled
+    user_id = Column(String, nullable=False, primary_key=ENTITLEMENTS_PARTITION_BY == "user_id") # ID of the user from an external system
+    resource_type = Column(String, nullable=False, primary_key=ENTITLEMENTS_PARTITION_BY == "resource_type") # e.g., 'collection', 'document', 'tool_feature'
+    resource_id = Column(String, nullable=False) # ID of the resource being entitled
     access_level = Column(String, nullable=True) # e.g., 'read', 'write', 'admin', 'use'
     is_active = Column(Boolean, default=True)
     # You can add more specific permission flags as boolean columns if needed
@@ -31,9 +104,141 @@ class Entitlement(Base):
     # Who granted this entitlement (e.g., system, admin_user_id)
     granted_by = Column(String, nullable=True)
 
+    # Incremented by every write; exposed as the ETag for optimistic concurrency
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+
     def __repr__(self):
         return f"<Entitlement(id={self.id}, user_id='{self.user_id}', resource='{self.resource_type}:{self.resource_id}')>"
 
+
+@event.listens_for(Entitlement.__table__, "after_create")
+def _create_partitions(table, connection, **kw):
+    for statement in partition_statements(table.name):
+        connection.exec_driver_sql(statement)
+
+
+class ResourceLink(Base):
+    # Parent of a resource, e.g. the collection a document belongs to. A resource has at
+    # most one parent, so the hierarchy is a forest.
+    __tablename__ = "resource_links"
+
+    resource_type = Column(String, primary_key=True)
+    resource_id = Column(String, primary_key=True)
+    parent_type = Column(String, nullable=False)
+    parent_id = Column(String, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class ResourceAncestor(Base):
+    # Transitive closure of resource_links, maintained on every link change: one row per
+    # (resource, ancestor) pair, so a check finds all of a resource's ancestors in one
+    # index range scan instead of walking the hierarchy.
+    __tablename__ = "resource_ancestors"
+    __table_args__ = (
+        # Descendants of a resource, needed to re-link a whole subtree
+        Index("ix_resource_ancestors_ancestor", "ancestor_type", "ancestor_id"),
+    )
+
+    resource_type = Column(String, primary_key=True)
+    resource_id = Column(String, primary_key=True)
+    ancestor_type = Column(String, primary_key=True)
+    ancestor_id = Column(String, primary_key=True)
+    depth = Column(Integer, nullable=False) # 1 for the parent, 2 for the grandparent, ...
+
+
+class Group(Base):
+    # A team or role. Grants to the group apply to every member.
+    __tablename__ = "groups"
+
+    group_id = Column(String, primary_key=True) # ID of the group from an external system
+    description = Column(Text, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class GroupMember(Base):
+    __tablename__ = "group_members"
+    __table_args__ = (
+        Index("ix_group_members_user_id", "user_id"),
+    )
+
+    group_id = Column(String, ForeignKey("groups.group_id", ondelete="CASCADE"), primary_key=True)
+    user_id = Column(String, primary_key=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class GroupGrant(Base):
+    __tablename__ = "group_grants"
+
+    group_id = Column(String, ForeignKey("groups.group_id", ondelete="CASCADE"), primary_key=True)
+    resource_type = Column(String, primary_key=True)
+    resource_id = Column(String, primary_key=True)
+    access_level = Column(String, nullable=True)
+    is_active = Column(Boolean, default=True)
+    expires_at = Column(DateTime(timezone=True), nullable=True)
+    description = Column(Text, nullable=True)
+    granted_by = Column(String, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+
+
+class GroupGrantExpansion(Base):
+    # Materialized (member x group grant) rows, kept in sync in the same transaction as
+    # every membership or group grant change. Checks read it like the entitlements table
+    # and never join through group_members.
+    __tablename__ = "group_grant_expansion"
+    __table_args__ = (
+        # Covering indexes of grants that can be in effect, by user and by resource, as on entitlements
+        Index(
+            "ix_group_grant_expansion_active_grants", "user_id", "resource_type", "resource_id",
+            postgresql_include=["access_level", "expires_at", "created_at"],
+            postgresql_where=text("is_active"),
+        ),
+        Index(
+            "ix_group_grant_expansion_active_by_resource", "resource_type", "resource_id", "user_id",
+            postgresql_include=["access_level", "expires_at"],
+            postgresql_where=text("is_active"),
+        ),
+        Index("ix_group_grant_expansion_active_expires_at", "expires_at", postgresql_where=text("is_active AND expires_at IS NOT NULL")),
+    )
+
+    user_id = Column(String, primary_key=True)
+    resource_type = Column(String, primary_key=True)
+    resource_id = Column(String, primary_key=True)
+    group_id = Column(String, ForeignKey("groups.group_id", ondelete="CASCADE"), primary_key=True)
+    access_level = Column(String, nullable=True)
+    is_active = Column(Boolean, default=True)
+    expires_at = Column(DateTime(timezone=True), nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class ChangeSequence(Base):
+    # Single row of change log bookkeeping. Changes are positioned by transaction id (see
+    # crud._record_changes), so writers no longer lock this row.
+    __tablename__ = "change_sequence"
+
+    id = Column(Integer, primary_key=True) # Always 1
+    seq = Column(BigInteger, nullable=False) # Counter of releases before transaction ids; unused
+    # Changes up to here have been pruned; clients behind it have to reload a snapshot
+    pruned_through = Column(BigInteger, nullable=False, default=0, server_default="0")
+
+
+class EntitlementChange(Base):
+    # Which decisions a committed write may have changed: a (user, resource) key whose
+    # grants changed, or with user_id NULL a resource whose ancestors changed. Rows only
+    # name keys; readers of the log look up the current state.
+    __tablename__ = "entitlement_changes"
+    __table_args__ = (
+        Index("ix_entitlement_changes_seq", "seq"),
+    )
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    seq = Column(BigInteger, nullable=False)
+    user_id = Column(String, nullable=True)
+    resource_type = Column(String, nullable=False)
+    resource_id = Column(String, nullable=False)
+    changed_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
 # If you have other related models, define them here. For example:
 # class User(Base):
 #     __tablename__ = "users"
@@ -48,3 +253,47 @@ class Entitlement(Base):
 #     name = Column(String, index=True)
 #     type = Column(String) # 'collection', 'document'
 #     # entitlements = relationship("Entitlement", back_populates="resource")
+
+class EntitlementAudit(Base):
+    # Append-only history of entitlement writes, filled by app.audit in batches after the
+    # writes commit. before/after hold the whole row; before is NULL for a create, after
+    # for a delete.
+    __tablename__ = "entitlement_audit"
+    __table_args__ = (
+        Index("ix_entitlement_audit_user_occurred_at", "user_id", "occurred_at", "id"),
+        Index("ix_entitlement_audit_resource_occurred_at", "resource_type", "resource_id", "occurred_at", "id"),
+    )
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    occurred_at = Column(DateTime(timezone=True), nullable=False)
+    action = Column(String, nullable=False) # create, update, delete, revoke or expire
+    entitlement_id = Column(UUID(as_uuid=True), nullable=False)
+    user_id = Column(String, nullable=False)
+    resource_type = Column(String, nullable=False)
+    resource_id = Column(String, nullable=False)
+    actor = Column(String, nullable=True) # granted_by of the written entitlement
+    before = Column(JSONB, nullable=True)
+    after = Column(JSONB, nullable=True)
+
+
+class EntitlementCounter(Base):
+    # Entitlement counts by resource type, access level and stored is_active, kept up to
+    # date by every write in the same transaction. Each group is spread over slots that
+    # writers pick at random, so concurrent writes to one group rarely wait on the same
+    # row; a group's count is the sum over its slots. A NULL access level is stored as ''.
+    __tablename__ = "entitlement_counters"
+
+    slot = Column(Integer, primary_key=True)
+    resource_type = Column(String, primary_key=True)
+    access_level = Column(String, primary_key=True)
+    is_active = Column(Boolean, primary_key=True)
+    count = Column(BigInteger, nullable=False)
+
+
+class SchemaVersion(Base):
+    # One row per migration applied by app.migrations
+    __tablename__ = "schema_version"
+
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    description = Column(String, nullable=False)
+    applied_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
@@ -0,0 +1,229 @@
+import argparse
+import asyncio
+import sys
+from typing import Callable, List, Optional, Sequence
+from uuid import UUID
+
+from sqlalchemy import UniqueConstraint, text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from . import models
+
+# Online migration of an existing, unpartitioned entitlements table to the partitioned
+# layout in app/models.py:
+#   create  builds entitlements_partitioned with its partitions and indexes
+#   copy    copies rows over in id order, one committed batch at a time; resumable
+#   swap    locks entitlements against writes (reads continue), applies the writes made
+#           since the copy, and renames entitlements_partitioned into place. The old
+#           table is kept as entitlements_previous until you drop it.
+# Every write bumps an entitlement's version, so (id, version) is enough to find the
+# rows that changed during the copy. Start the service with a matching
+# ENTITLEMENTS_PARTITION_BY after the swap; until then it works against either table.
+# An already partitioned table can be migrated the same way, e.g. to more partitions.
+#
+# `indexes` instead moves an unpartitioned table to the composite indexes, building
+# them CONCURRENTLY before dropping the single-column indexes they replace.
+SOURCE = models.Entitlement.__tablename__
+TARGET = f"{SOURCE}_partitioned"
+RETIRED = f"{SOURCE}_previous"
+COPY_BATCH_SIZE = 50000
+# The swap gives up rather than queue every other query behind it while it waits for
+# long-running transactions on the table; run it again when traffic is quieter
+SWAP_LOCK_TIMEOUT = "10s"
+
+# Indexes of earlier releases, covered by the composite indexes
+LEGACY_INDEXES = ("ix_entitlements_user_id", "ix_entitlements_resource_type", "ix_entitlements_resource_id")
+
+_COLUMNS = ", ".join(column.name for column in models.Entitlement.__table__.columns)
+_UNIQUE_CONSTRAINTS = [constraint for constraint in models.Entitlement.__table__.constraints if isinstance(constraint, UniqueConstraint)]
+
+
+class PartitioningError(Exception):
+    """The tables are not in the state the requested step expects."""
+
+
+def _columns(element) -> str:
+    return ", ".join(column.name for column in element.columns)
+
+
+def _index_definition(index) -> str:
+    # Column list plus the INCLUDE columns and partial index predicate, if any
+    options = index.dialect_options["postgresql"]
+    definition = f"({_columns(index)})"
+    if options["include"]:
+        definition += f" INCLUDE ({', '.join(options['include'])})"
+    if options["where"] is not None:
+        definition += f" WHERE {options['where']}"
+    return definition
+
+
+def _indexes():
+    return sorted(models.Entitlement.__table__.indexes, key=lambda index: index.name)
+
+
+async def _table_exists(conn, name: str) -> bool:
+    return (await conn.execute(text("SELECT to_regclass(:name) IS NOT NULL"), {"name": name})).scalar_one()
+
+
+async def _partitions(conn, table: str) -> List[str]:
+    return (await conn.execute(text(
+        "SELECT child.relname FROM pg_inherits JOIN pg_class AS child ON child.oid = pg_inherits.inhrelid "
+        "WHERE pg_inherits.inhparent = CAST(:table AS regclass)"
+    ), {"table": table})).scalars().all()
+
+
+async def create_partitioned_table(
+    engine: AsyncEngine,
+    partition_by: str,
+    hash_partitions: int = models.ENTITLEMENTS_HASH_PARTITIONS,
+    list_partitions: Sequence[str] = models.ENTITLEMENTS_LIST_PARTITIONS
+) -> bool:
+    # Returns False if the table already exists from an earlier run
+    if partition_by not in models.PARTITION_METHODS:
+        raise PartitioningError(f"Cannot partition by {partition_by!r}")
+    async with engine.begin() as conn:
+        if await _table_exists(conn, TARGET):
+            return False
+        # Index and constraint names get a suffix until the swap, as the originals are taken
+        statements = [
+            f"CREATE TABLE {TARGET} (LIKE {SOURCE} INCLUDING DEFAULTS) PARTITION BY {models.PARTITION_METHODS[partition_by]}",
+            f"ALTER TABLE {TARGET} ADD CONSTRAINT {TARGET}_pkey PRIMARY KEY (id, {partition_by})",
+        ]
+        statements += [
+            f"ALTER TABLE {TARGET} ADD CONSTRAINT {constraint.name}_partitioned UNIQUE ({_columns(constraint)})"
+            for constraint in _UNIQUE_CONSTRAINTS
+        ]
+        statements += [f"CREATE INDEX {index.name}_partitioned ON {TARGET} {_index_definition(index)}" for index in _indexes()]
+        statements += models.partition_statements(TARGET, partition_by, hash_partitions, list_partitions)
+        for statement in statements:
+            await conn.execute(text(statement))
+    return True
+
+
+async def copy_batch(engine: AsyncEngine, after: Optional[UUID], batch_size: int = COPY_BATCH_SIZE) -> Optional[UUID]:
+    # Copies the next batch of rows with id > after; returns the last id copied, or None
+    # once the source has no rows left
+    async with engine.begin() as conn:
+        params = {"after": after or UUID(int=0), "batch_size": batch_size}
+        upto = (await conn.execute(text(
+            f"SELECT id FROM (SELECT id FROM {SOURCE} WHERE id > :after ORDER BY id LIMIT :batch_size) AS batch "
+            "ORDER BY id DESC LIMIT 1"
+        ), params)).scalar()
+        if upto is None:
+            return None
+        await conn.execute(text(
+            f"INSERT INTO {TARGET} ({_COLUMNS}) SELECT {_COLUMNS} FROM {SOURCE} "
+            "WHERE id > :after AND id <= :upto ON CONFLICT DO NOTHING"
+        ), {**params, "upto": upto})
+    return upto
+
+
+async def copy_rows(
+    engine: AsyncEngine,
+    batch_size: int = COPY_BATCH_SIZE,
+    on_progress: Optional[Callable[[UUID], None]] = None
+) -> None:
+    async with engine.connect() as conn:
+        if not await _table_exists(conn, TARGET):
+            raise PartitioningError(f"{TARGET} does not exist; run the create step first")
+        # Resume after the last row copied by an earlier run
+        last = (await conn.execute(text(f"SELECT id FROM {TARGET} ORDER BY id DESC LIMIT 1"))).scalar()
+    while (last := await copy_batch(engine, last, batch_size)) is not None:
+        if on_progress:
+            on_progress(last)
+
+
+async def swap_tables(engine: AsyncEngine) -> dict:
+    async with engine.begin() as conn:
+        if not await _table_exists(conn, TARGET):
+            raise PartitioningError(f"{TARGET} does not exist; run the create and copy steps first")
+        if await _table_exists(conn, RETIRED):
+            raise PartitioningError(f"{RETIRED} already exists; drop it before swapping again")
+        await conn.execute(text(f"SET LOCAL lock_timeout = '{SWAP_LOCK_TIMEOUT}'"))
+        # EXCLUSIVE blocks writes but not reads; only the renames at the end block reads
+        await conn.execute(text(f"LOCK TABLE {SOURCE} IN EXCLUSIVE MODE"))
+        # Rows deleted or changed since they were copied, then rows not copied yet
+        deleted = (await conn.execute(text(
+            f"DELETE FROM {TARGET} AS target WHERE NOT EXISTS "
+            f"(SELECT 1 FROM {SOURCE} AS source WHERE source.id = target.id AND source.version = target.version)"
+        ))).rowcount
+        inserted = (await conn.execute(text(
+            f"INSERT INTO {TARGET} ({_COLUMNS}) SELECT {_COLUMNS} FROM {SOURCE} AS source "
+            f"WHERE NOT EXISTS (SELECT 1 FROM {TARGET} AS target WHERE target.id = source.id)"
+        ))).rowcount
+
+        old_indexes = (await conn.execute(
+            text("SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() AND tablename = :table"),
+            {"table": SOURCE},
+        )).scalars().all()
+        old_partitions = await _partitions(conn, SOURCE)
+        partitions = await _partitions(conn, TARGET)
+
+        # Renaming an index also renames the constraint it backs
+        statements = [f"ALTER INDEX {name} RENAME TO {name}_previous" for name in old_indexes]
+        statements += [f"ALTER TABLE {name} RENAME TO {RETIRED}{name[len(SOURCE):]}" for name in old_partitions]
+        statements.append(f"ALTER TABLE {SOURCE} RENAME TO {RETIRED}")
+        statements.append(f"ALTER TABLE {TARGET} RENAME TO {SOURCE}")
+        statements.append(f"ALTER INDEX {TARGET}_pkey RENAME TO {SOURCE}_pkey")
+        statements += [f"ALTER INDEX {constraint.name}_partitioned RENAME TO {constraint.name}" for constraint in _UNIQUE_CONSTRAINTS]
+        statements += [f"ALTER INDEX {index.name}_partitioned RENAME TO {index.name}" for index in _indexes()]
+        statements += [f"ALTER TABLE {name} RENAME TO {SOURCE}{name[len(TARGET):]}" for name in partitions]
+        for statement in statements:
+            await conn.execute(text(statement))
+    return {"deleted": deleted, "inserted": inserted}
+
+
+async def create_composite_indexes(engine: AsyncEngine) -> None:
+    # CONCURRENTLY cannot run inside a transaction block
+    async with engine.connect() as conn:
+        conn = await conn.execution_options(isolation_level="AUTOCOMMIT")
+        for index in _indexes():
+            await conn.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {index.name} ON {SOURCE} {_index_definition(index)}"))
+        for name in LEGACY_INDEXES:
+            await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+
+
+async def _main(args: argparse.Namespace) -> int:
+    from .database import dispose_engine, get_engine
+
+    engine = get_engine()
+
+    def progress(last: UUID) -> None:
+        print(f"copied through id {last}", file=sys.stderr)
+
+    try:
+        if args.command == "indexes":
+            await create_composite_indexes(engine)
+            return 0
+        if args.step in ("create", "all"):
+            created = await create_partitioned_table(engine, args.by, args.partitions, args.types)
+            print(f"{TARGET} {'created' if created else 'already exists'}", file=sys.stderr)
+        if args.step in ("copy", "all"):
+            await copy_rows(engine, args.batch_size, on_progress=progress)
+        if args.step in ("swap", "all"):
+            counts = await swap_tables(engine)
+            print(f"swapped; applied {counts['deleted']} deletions and {counts['inserted']} insertions made during the copy", file=sys.stderr)
+    except PartitioningError as exc:
+        print(f"error: {exc}", file=sys.stderr)
+        return 2
+    finally:
+        await dispose_engine()
+    return 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Migrate the entitlements table to partitions or composite indexes.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    migrate = commands.add_parser("migrate", help="Move entitlements into a partitioned table")
+    migrate.add_argument("--by", choices=list(models.PARTITION_METHODS), required=True, help="Partition key")
+    migrate.add_argument("--step", choices=("create", "copy", "swap", "all"), default="all")
+    migrate.add_argument("--partitions", type=int, default=models.ENTITLEMENTS_HASH_PARTITIONS, help="Hash partitions (--by user_id)")
+    migrate.add_argument("--types", type=lambda value: [item.strip() for item in value.split(",") if item.strip()],
+                         default=models.ENTITLEMENTS_LIST_PARTITIONS, help="Comma-separated resource types (--by resource_type)")
+    migrate.add_argument("--batch-size", type=int, default=COPY_BATCH_SIZE, help="Rows per copy transaction")
+    commands.add_parser("indexes", help="Create missing indexes of an unpartitioned table and drop the single-column ones")
+    return asyncio.run(_main(parser.parse_args(argv)))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,223 @@
+import asyncio
+import itertools
+import os
+import re
+import time
+from contextvars import ContextVar
+from typing import Iterator, List, Optional
+
+from fastapi import Depends, HTTPException, Request, Response
+from sqlalchemy import String, bindparam, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from .database import build_engine, get_db, get_sessionmaker
+from .singleflight import SKIP_COALESCING
+
+# Optional read replicas for the read endpoints. Reads are spread round-robin over the
+# replicas in READ_REPLICA_URLS; a replica that fails to connect is ejected for
+# REPLICA_EJECT_SECONDS and then tried again. Without replicas every read goes to
+# the primary, exactly as before.
+#
+# Read-your-writes: every successful response of a request that changed entitlements
+# carries the primary's WAL position after the write (X-Write-LSN). A client that sends
+# it back as X-Min-LSN is only served by a replica that has replayed at least that far,
+# otherwise by the primary.
+READ_REPLICA_URLS = [url.strip() for url in os.getenv("READ_REPLICA_URLS", "").split(",") if url.strip()]
+REPLICA_EJECT_SECONDS = float(os.getenv("REPLICA_EJECT_SECONDS", "30"))
+REPLICA_CONNECT_TIMEOUT = float(os.getenv("REPLICA_CONNECT_TIMEOUT", "2")) # Seconds; keeps a dead replica from stalling reads
+
+WRITE_LSN_HEADER = "X-Write-LSN"
+MIN_LSN_HEADER = "X-Min-LSN"
+READ_SOURCE_HEADER = "X-Read-Source"
+
+_LSN = re.compile(r"^[0-9A-Fa-f]{1,8}/[0-9A-Fa-f]{1,8}$")
+_WRITE_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
+
+# True once the server has replayed (replica) or written (primary standing in as a
+# replica) WAL up to the given position
+_CAUGHT_UP = text(
+    "SELECT CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn() "
+    "ELSE pg_current_wal_lsn() END >= CAST(:lsn AS pg_lsn)"
+).bindparams(bindparam("lsn", type_=String))
+
+
+def _connection_failed(exc: BaseException) -> bool:
+    # Lost, refused or timed out connections eject a replica; query errors do not
+    if isinstance(exc, DBAPIError):
+        return exc.connection_invalidated
+    return isinstance(exc, (OSError, asyncio.TimeoutError))
+
+
+class Replica:
+    def __init__(self, name: str, url: str, eject_seconds: float):
+        self.name = name
+        self.engine = build_engine(url, timeout=REPLICA_CONNECT_TIMEOUT)
+        self.sessionmaker = sessionmaker(autocommit=False, autoflush=False, bind=self.engine, class_=AsyncSession)
+        self.eject_seconds = eject_seconds
+        self.ejected_until = 0.0
+        self.ejections = 0
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self.ejected_until
+
+    def eject(self) -> None:
+        if self.healthy:
+            self.ejections += 1
+        self.ejected_until = time.monotonic() + self.eject_seconds
+
+
+class ReplicaSet:
+    def __init__(self, urls: List[str], primary=None, eject_seconds: float = REPLICA_EJECT_SECONDS):
+        self.replicas = [Replica(f"replica-{index}", url, eject_seconds) for index, url in enumerate(urls, start=1)]
+        self.primary = primary # Session factory; None uses the app's
+        self._next = itertools.count()
+        self.replica_reads = 0
+        self.primary_reads = 0
+        self.lagging = 0
+
+    def __bool__(self) -> bool:
+        return bool(self.replicas)
+
+    def candidates(self) -> Iterator[Replica]:
+        # Healthy replicas, starting one further along on every call
+        start = next(self._next)
+        count = len(self.replicas)
+        for offset in range(count):
+            replica = self.replicas[(start + offset) % count]
+            if replica.healthy:
+                yield replica
+
+    async def primary_lsn(self) -> str:
+        async with (self.primary or get_sessionmaker())() as session:
+            return (await session.execute(text("SELECT pg_current_wal_lsn()::text"))).scalar_one()
+
+    async def dispose(self) -> None:
+        for replica in self.replicas:
+            await replica.engine.dispose()
+
+    def stats(self) -> dict:
+        return {
+            "replicas": len(self.replicas),
+            "healthy": sum(1 for replica in self.replicas if replica.healthy),
+            "ejections": sum(replica.ejections for replica in self.replicas),
+            "replica_reads": self.replica_reads,
+            "primary_reads": self.primary_reads,
+            "lagging": self.lagging,
+        }
+
+
+# Replica engines for the app, created on first use (normally in the app lifespan, which
+# also instruments them) like the primary engine in app.database
+_replica_set = None
+
+
+def get_replica_set() -> ReplicaSet:
+    global _replica_set
+    if _replica_set is None:
+        _replica_set = ReplicaSet(READ_REPLICA_URLS)
+    return _replica_set
+
+
+async def dispose_replica_set() -> None:
+    # Closes the replica pools; the next get_replica_set() creates fresh engines
+    global _replica_set
+    if _replica_set is not None:
+        await _replica_set.dispose()
+    _replica_set = None
+
+
+async def get_read_db(request: Request, response: Response, primary: AsyncSession = Depends(get_db)):
+    # Session for read-only endpoints: a healthy replica that is caught up with the
+    # client's X-Min-LSN, if any, else the primary session from get_db. Reads with
+    # X-Min-LSN never share another request's query (see app.singleflight).
+    min_lsn = request.headers.get(MIN_LSN_HEADER)
+    if min_lsn is not None and not _LSN.match(min_lsn):
+        raise HTTPException(status_code=400, detail=f"Invalid {MIN_LSN_HEADER} header")
+    if min_lsn is not None:
+        primary.info[SKIP_COALESCING] = True
+
+    replicas = get_replica_set()
+    if not replicas:
+        yield primary
+        return
+
+    chosen = None
+    for replica in replicas.candidates():
+        session = replica.sessionmaker()
+        try:
+            # Connecting up front lets an unreachable replica be skipped within this
+            # request. The LSN check runs in the transaction the endpoint then reads in,
+            # so the replica cannot fall behind the checked position in between.
+            await session.connection()
+            if min_lsn is None or (await session.execute(_CAUGHT_UP, {"lsn": min_lsn})).scalar():
+                chosen = replica, session
+                break
+            replicas.lagging += 1
+        except Exception as exc:
+            if not _connection_failed(exc):
+                await session.close()
+                raise
+            replica.eject()
+        await session.close()
+
+    if chosen is None:
+        replicas.primary_reads += 1
+        response.headers[READ_SOURCE_HEADER] = "primary"
+        yield primary
+        return
+
+    replica, session = chosen
+    if min_lsn is not None:
+        session.info[SKIP_COALESCING] = True
+    replicas.replica_reads += 1
+    response.headers[READ_SOURCE_HEADER] = replica.name
+    async with session:
+        try:
+            yield session
+        except Exception as exc:
+            if _connection_failed(exc):
+                replica.eject()
+            raise
+
+
+# Per-request flag of WriteLSNMiddleware, set by mark_written(). A mutable dict rather
+# than the value itself, so a flag set in a copied context still reaches the middleware.
+_request_writes: ContextVar[Optional[dict]] = ContextVar("request_writes", default=None)
+
+
+def mark_written() -> None:
+    # Called by crud for every write that changes entitlements, in the request's task
+    writes = _request_writes.get()
+    if writes is not None:
+        writes["written"] = True
+
+
+class WriteLSNMiddleware:
+    # Adds X-Write-LSN to successful responses of requests that wrote, when replicas are
+    # configured. Read-only POSTs such as /check/batch skip the primary round trip. The
+    # handler has committed by the time the response starts, so the position covers it.
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        replica_set = get_replica_set()
+        if scope["type"] != "http" or scope["method"] not in _WRITE_METHODS or not replica_set:
+            await self.app(scope, receive, send)
+            return
+
+        writes = {"written": False}
+        token = _request_writes.set(writes)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start" and message["status"] < 400 and writes["written"]:
+                lsn = await replica_set.primary_lsn()
+                message["headers"] = list(message.get("headers", [])) + [(WRITE_LSN_HEADER.lower().encode(), lsn.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _request_writes.reset(token)
@@ -1,77 +1,348 @@
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import (APIRouter, Depends, Header, HTTPException, Query, Request,
+                     Response)
+from fastapi.responses import StreamingResponse
+import orjson
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
+from datetime import datetime
 from typing import List, Optional
 from uuid import UUID
 
-from app import crud, models, schemas
-from app.database import get_db
+from app import crud, importer, models, schemas
+from app.cache import decision_cache
+from app.database import get_db, get_sessionmaker
+from app.export import EXPORT_FORMATS, ndjson_chunks, page_json, snapshot_chunks
+from app.replicas import get_read_db
 
 router = APIRouter()
 
+def _etag(entitlement: models.Entitlement) -> str:
+    return f'"{entitlement.version}"'
+
+def _parse_if_match(if_match: Optional[str]) -> Optional[List[int]]:
+    # None means unconditional ('*' or no header). Tags that are not versions issued by
+    # this service can never match, so they simply yield an empty list.
+    if if_match is None or if_match.strip() == "*":
+        return None
+    versions = []
+    for tag in if_match.split(","):
+        tag = tag.strip()
+        if tag.startswith('"') and tag.endswith('"') and tag[1:-1].isdigit():
+            versions.append(int(tag[1:-1]))
+    return versions
+
 @router.post("/", response_model=schemas.Entitlement, status_code=201)
 async def create_entitlement(
     entitlement: schemas.EntitlementCreate,
+    response: Response,
     db: AsyncSession = Depends(get_db)
 ):
     # Basic validation example: ensure user_id, resource_type, and resource_id are present
     if not all([entitlement.user_id, entitlement.resource_type, entitlement.resource_id]):
         raise HTTPException(status_code=400, detail="user_id, resource_type, and resource_id are required")
     
-    # Potentially check for existing identical entitlement if duplicates are not allowed
-    # existing = await crud.get_entitlements(db, user_id=entitlement.user_id, resource_type=entitlement.resource_type, resource_id=entitlement.resource_id, is_active=True)
-    # if existing:
-    #     raise HTTPException(status_code=409, detail="Active entitlement for this user and resource already exists")
+    # Duplicates are rejected by the uq_entitlements_user_resource constraint
+    try:
+        db_entitlement = await crud.create_entitlement(db=db, entitlement=entitlement)
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(status_code=409, detail="Entitlement for this user and resource already exists")
+    response.headers["ETag"] = _etag(db_entitlement)
+    return db_entitlement
+
+def _check_bulk_size(items: list):
+    if len(items) > crud.BULK_MAX_ITEMS:
+        raise HTTPException(status_code=413, detail=f"At most {crud.BULK_MAX_ITEMS} items are accepted per request")
+
+@router.post("/bulk", response_model=schemas.BulkResult)
+async def bulk_create_entitlements(
+    bulk: schemas.EntitlementBulkCreate,
+    chunk_size: int = Query(crud.BULK_CHUNK_SIZE, ge=1, le=crud.BULK_MAX_CHUNK_SIZE, description="Rows per INSERT statement"),
+    db: AsyncSession = Depends(get_db)
+):
+    # Items that already exist are reported as 'conflict' and left untouched
+    _check_bulk_size(bulk.items)
+    return await crud.bulk_create_entitlements(db, items=bulk.items, chunk_size=chunk_size)
 
-    return await crud.create_entitlement(db=db, entitlement=entitlement)
+@router.post("/bulk/upsert", response_model=schemas.BulkResult)
+async def bulk_upsert_entitlements(
+    bulk: schemas.EntitlementBulkCreate,
+    chunk_size: int = Query(crud.BULK_CHUNK_SIZE, ge=1, le=crud.BULK_MAX_CHUNK_SIZE, description="Rows per INSERT statement"),
+    db: AsyncSession = Depends(get_db)
+):
+    # Existing entitlements for the same user and resource are overwritten
+    _check_bulk_size(bulk.items)
+    return await crud.bulk_upsert_entitlements(db, items=bulk.items, chunk_size=chunk_size)
+
+@router.post("/bulk/revoke", response_model=schemas.BulkResult)
+async def bulk_revoke_entitlements(
+    bulk: schemas.EntitlementBulkRevoke,
+    chunk_size: int = Query(crud.BULK_CHUNK_SIZE, ge=1, le=crud.BULK_MAX_CHUNK_SIZE, description="Keys per UPDATE statement"),
+    db: AsyncSession = Depends(get_db)
+):
+    # Revoked entitlements are deactivated, not deleted
+    _check_bulk_size(bulk.items)
+    return await crud.bulk_revoke_entitlements(db, items=bulk.items, chunk_size=chunk_size)
 
 @router.get("/", response_model=schemas.EntitlementList)
 async def read_entitlements(
+    response: Response,
     skip: int = Query(0, ge=0),
     limit: int = Query(100, ge=1, le=200),
+    cursor: Optional[str] = Query(None, description="Opaque cursor from a previous page's next_cursor; replaces skip"),
+    count: str = Query("exact", pattern="^(exact|estimate|none)$", description="How to compute total: 'exact' (COUNT), 'estimate' (planner estimate) or 'none'"),
     user_id: Optional[str] = Query(None, description="Filter by User ID"),
     resource_type: Optional[str] = Query(None, description="Filter by Resource Type (e.g., 'collection', 'document')"),
     resource_id: Optional[str] = Query(None, description="Filter by Resource ID"),
     is_active: Optional[bool] = Query(None, description="Filter by active status"),
-    db: AsyncSession = Depends(get_db)
+    fast: bool = Query(True, description="Encode rows directly; false serializes through the response model (same output, slower)"),
+    db: AsyncSession = Depends(get_read_db)
 ):
+    try:
+        position = crud.decode_cursor(cursor) if cursor else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
     entitlements = await crud.get_entitlements(
         db, skip=skip, limit=limit, 
         user_id=user_id, resource_type=resource_type, 
-        resource_id=resource_id, is_active=is_active
+        resource_id=resource_id, is_active=is_active,
+        cursor=position, as_rows=fast
     )
-    total_count = await crud.get_entitlements_count(
-        db, user_id=user_id, resource_type=resource_type, 
-        resource_id=resource_id, is_active=is_active
-    )
-    return {"items": entitlements, "total": total_count}
+    total_count = None
+    if count == "exact":
+        total_count = await crud.get_entitlements_count(
+            db, user_id=user_id, resource_type=resource_type, 
+            resource_id=resource_id, is_active=is_active
+        )
+    elif count == "estimate":
+        total_count = await crud.get_entitlements_count_estimate(
+            db, user_id=user_id, resource_type=resource_type,
+            resource_id=resource_id, is_active=is_active
+        )
+    next_cursor = None
+    if len(entitlements) == limit:
+        last = entitlements[-1]
+        next_cursor = crud.encode_cursor(last.created_at, last.id)
+    if fast:
+        # Returning a Response skips response_model validation; the rows already match it.
+        # Headers set on the injected response (e.g. by get_read_db) are carried over.
+        body = page_json(crud.ENTITLEMENT_FIELDS, entitlements, total_count, next_cursor)
+        return Response(content=body, media_type="application/json", headers=response.headers)
+    return {"items": entitlements, "total": total_count, "next_cursor": next_cursor}
+
+@router.post("/import", response_model=schemas.ImportReport)
+async def import_entitlements(
+    request: Request,
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$", description="Input format: 'ndjson' or 'csv' with a header row"),
+    mode: str = Query("upsert", pattern="^(upsert|insert)$", description="'insert' skips entitlements that already exist"),
+    batch_size: int = Query(importer.IMPORT_BATCH_SIZE, ge=1, le=50000, description="Rows per COPY batch"),
+    db: AsyncSession = Depends(get_db)
+):
+    # The request body is the raw file; it is read incrementally as batches are loaded.
+    # Invalid rows are reported and skipped, each batch is committed on its own.
+    try:
+        return await importer.import_entitlements(
+            db, request.stream(), format=format, mode=mode, batch_size=batch_size
+        )
+    except importer.ImportFormatError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+
+@router.get("/export")
+async def export_entitlements(
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$", description="Output format: 'ndjson' or 'csv'"),
+    user_id: Optional[str] = Query(None, description="Filter by User ID"),
+    resource_type: Optional[str] = Query(None, description="Filter by Resource Type (e.g., 'collection', 'document')"),
+    resource_id: Optional[str] = Query(None, description="Filter by Resource ID"),
+    is_active: Optional[bool] = Query(None, description="Filter by active status"),
+    session_factory = Depends(get_sessionmaker)
+):
+    encode, media_type = EXPORT_FORMATS[format]
+
+    async def body():
+        # The session lives as long as the response body is being streamed
+        async with session_factory() as session:
+            batches = crud.stream_entitlements(
+                session, user_id=user_id, resource_type=resource_type,
+                resource_id=resource_id, is_active=is_active
+            )
+            async for chunk in encode(crud.EXPORT_COLUMNS, batches):
+                yield chunk
+
+    headers = {"Content-Disposition": f'attachment; filename="entitlements.{format}"'}
+    return StreamingResponse(body(), media_type=media_type, headers=headers)
+
+@router.get("/snapshot")
+async def read_snapshot(
+    resource_type: Optional[List[str]] = Query(None, description="Only grants and ancestors of these resource types; repeat for several"),
+    session_factory = Depends(get_sessionmaker)
+):
+    # Everything a client needs to evaluate checks locally, as of the returned seq
+    async def body():
+        async with session_factory() as session:
+            async for chunk in snapshot_chunks(crud.stream_snapshot(session, resource_types=resource_type)):
+                yield chunk
+
+    return StreamingResponse(body(), media_type="application/x-ndjson")
+
+@router.get("/changes")
+async def read_changes(
+    since: int = Query(..., ge=0, description="seq of the snapshot or of the previous page"),
+    resource_type: Optional[List[str]] = Query(None, description="Same filter as the snapshot"),
+    limit: int = Query(crud.CHANGES_PAGE_SIZE, ge=1, le=10000, description="Approximate number of changes per page"),
+    db: AsyncSession = Depends(get_db)
+):
+    try:
+        page = await crud.get_changes(db, since=since, resource_types=resource_type, limit=limit)
+    except crud.ChangesPrunedError:
+        raise HTTPException(status_code=410, detail="Changes since this position were pruned; reload the snapshot")
+    return Response(content=orjson.dumps(page), media_type="application/json")
+
+@router.get("/history")
+async def read_history(
+    user_id: Optional[str] = Query(None, description="Events of this user"),
+    resource_type: Optional[str] = Query(None, description="Events on this resource type; with resource_id, on one resource"),
+    resource_id: Optional[str] = Query(None, description="Events on this resource; requires resource_type"),
+    since: Optional[datetime] = Query(None, description="Only events at or after this time"),
+    until: Optional[datetime] = Query(None, description="Only events before this time"),
+    session_factory = Depends(get_sessionmaker)
+):
+    # Audit trail as NDJSON, oldest first; recent writes appear once the audit writer flushes
+    if not user_id and not (resource_type and resource_id):
+        raise HTTPException(status_code=422, detail="Pass user_id, or resource_type and resource_id")
+
+    async def body():
+        async with session_factory() as session:
+            batches = crud.stream_audit_history(
+                session, user_id=user_id, resource_type=resource_type, resource_id=resource_id, since=since, until=until
+            )
+            async for chunk in ndjson_chunks(crud.AUDIT_COLUMNS, batches):
+                yield chunk
+
+    return StreamingResponse(body(), media_type="application/x-ndjson")
+
+@router.get("/check", response_model=schemas.EntitlementCheck)
+async def check_entitlement(
+    user_id: str = Query(..., description="User ID to check"),
+    resource_type: str = Query(..., description="Resource Type (e.g., 'collection', 'document')"),
+    resource_id: str = Query(..., description="Resource ID"),
+    db: AsyncSession = Depends(get_db)
+):
+    # Active, unexpired grants only; decisions are served from the in-process cache when possible
+    return await crud.check_entitlement(db, user_id=user_id, resource_type=resource_type, resource_id=resource_id)
+
+@router.post("/check/batch", response_model=schemas.EntitlementCheckBatchResult)
+async def check_entitlements_batch(
+    batch: schemas.EntitlementCheckBatch,
+    db: AsyncSession = Depends(get_db)
+):
+    # All uncached pairs are resolved in a single query; results keep the request order
+    results = await crud.check_entitlements_batch(db, items=batch.items)
+    return {"results": results}
+
+@router.get("/check/cache", response_model=schemas.DecisionCacheStats)
+async def read_decision_cache_stats():
+    return decision_cache.stats()
+
+def _check_lookup_size(*id_lists: Optional[List[str]]):
+    if any(ids is not None and len(ids) > crud.LOOKUP_MAX_IDS for ids in id_lists):
+        raise HTTPException(status_code=413, detail=f"At most {crud.LOOKUP_MAX_IDS} IDs are accepted per list")
+
+@router.post("/lookup/users")
+async def lookup_resource_users(
+    lookup: schemas.ResourceUsersLookup,
+    session_factory = Depends(get_sessionmaker)
+):
+    # Who can access these resources: NDJSON lines of resource_id, user_id and access_level
+    _check_lookup_size(lookup.resource_ids, lookup.user_ids)
+
+    async def body():
+        async with session_factory() as session:
+            batches = crud.stream_resource_users(
+                session, resource_type=lookup.resource_type, resource_ids=lookup.resource_ids, user_ids=lookup.user_ids
+            )
+            async for chunk in ndjson_chunks(crud.LOOKUP_USER_COLUMNS, batches):
+                yield chunk
+
+    return StreamingResponse(body(), media_type="application/x-ndjson")
+
+@router.post("/lookup/resources")
+async def lookup_user_resources(
+    lookup: schemas.UserResourcesLookup,
+    session_factory = Depends(get_sessionmaker)
+):
+    # What this user can access: NDJSON lines of resource_id and access_level
+    _check_lookup_size(lookup.resource_ids)
+
+    async def body():
+        async with session_factory() as session:
+            batches = crud.stream_user_resources(
+                session, user_id=lookup.user_id, resource_type=lookup.resource_type, resource_ids=lookup.resource_ids
+            )
+            async for chunk in ndjson_chunks(crud.LOOKUP_RESOURCE_COLUMNS, batches):
+                yield chunk
+
+    return StreamingResponse(body(), media_type="application/x-ndjson")
+
+@router.get("/stats", response_model=schemas.EntitlementStats, response_model_exclude_unset=True)
+async def read_entitlement_stats(
+    group_by: List[str] = Query([], description="Dimensions to count by: resource_type, access_level or is_active; repeat for several"),
+    db: AsyncSession = Depends(get_read_db)
+):
+    # Served from the counters table, so it stays cheap however many entitlements there are
+    unknown = set(group_by) - set(crud.STATS_DIMENSIONS)
+    if unknown:
+        raise HTTPException(status_code=422, detail=f"Cannot group by {', '.join(sorted(unknown))}")
+    total, groups = await crud.get_entitlement_stats(db, group_by=group_by)
+    return {"total": total, "groups": groups}
 
 @router.get("/{entitlement_id}", response_model=schemas.Entitlement)
 async def read_entitlement(
     entitlement_id: UUID,
-    db: AsyncSession = Depends(get_db)
+    response: Response,
+    db: AsyncSession = Depends(get_read_db)
 ):
     db_entitlement = await crud.get_entitlement(db, entitlement_id=entitlement_id)
     if db_entitlement is None:
         raise HTTPException(status_code=404, detail="Entitlement not found")
+    response.headers["ETag"] = _etag(db_entitlement)
     return db_entitlement
 
 @router.put("/{entitlement_id}", response_model=schemas.Entitlement)
 async def update_entitlement(
     entitlement_id: UUID,
     entitlement_update: schemas.EntitlementUpdate,
+    response: Response,
+    if_match: Optional[str] = Header(None, description="ETag from a previous read; the update is rejected with 412 if the entitlement changed since"),
     db: AsyncSession = Depends(get_db)
 ):
-    updated_entitlement = await crud.update_entitlement(db, entitlement_id=entitlement_id, entitlement_update=entitlement_update)
+    try:
+        updated_entitlement = await crud.update_entitlement(
+            db, entitlement_id=entitlement_id, entitlement_update=entitlement_update,
+            expected_versions=_parse_if_match(if_match)
+        )
+    except crud.StaleEntitlementError:
+        raise HTTPException(status_code=412, detail="Entitlement was modified; fetch it again and retry")
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(status_code=409, detail="Entitlement for this user and resource already exists")
     if updated_entitlement is None:
         raise HTTPException(status_code=404, detail="Entitlement not found")
+    response.headers["ETag"] = _etag(updated_entitlement)
     return updated_entitlement
 
 @router.delete("/{entitlement_id}", response_model=schemas.Entitlement)
 async def delete_entitlement(
     entitlement_id: UUID,
+    if_match: Optional[str] = Header(None, description="ETag from a previous read; the delete is rejected with 412 if the entitlement changed since"),
     db: AsyncSession = Depends(get_db)
 ):
-    deleted_entitlement = await crud.delete_entitlement(db, entitlement_id=entitlement_id)
+    try:
+        deleted_entitlement = await crud.delete_entitlement(
+            db, entitlement_id=entitlement_id, expected_versions=_parse_if_match(if_match)
+        )
+    except crud.StaleEntitlementError:
+        raise HTTPException(status_code=412, detail="Entitlement was modified; fetch it again and retry")
     if deleted_entitlement is None:
         raise HTTPException(status_code=404, detail="Entitlement not found")
     return deleted_entitlement
@@ -0,0 +1,80 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List
+
+from app import crud, schemas
+from app.database import get_db
+
+router = APIRouter()
+
+GROUP_NOT_FOUND = "Group not found"
+
+@router.post("/", response_model=schemas.Group, status_code=201)
+async def create_group(group: schemas.GroupCreate, db: AsyncSession = Depends(get_db)):
+    try:
+        return await crud.create_group(db=db, group=group)
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(status_code=409, detail="Group already exists")
+
+@router.get("/{group_id}", response_model=schemas.Group)
+async def read_group(group_id: str, db: AsyncSession = Depends(get_db)):
+    db_group = await crud.get_group(db, group_id=group_id)
+    if db_group is None:
+        raise HTTPException(status_code=404, detail=GROUP_NOT_FOUND)
+    return db_group
+
+@router.delete("/{group_id}", response_model=schemas.Group)
+async def delete_group(group_id: str, db: AsyncSession = Depends(get_db)):
+    db_group = await crud.delete_group(db, group_id=group_id)
+    if db_group is None:
+        raise HTTPException(status_code=404, detail=GROUP_NOT_FOUND)
+    return db_group
+
+@router.get("/{group_id}/members", response_model=List[schemas.GroupMember])
+async def read_group_members(
+    group_id: str,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+    db: AsyncSession = Depends(get_db)
+):
+    if await crud.get_group(db, group_id=group_id) is None:
+        raise HTTPException(status_code=404, detail=GROUP_NOT_FOUND)
+    return await crud.get_group_members(db, group_id=group_id, skip=skip, limit=limit)
+
+@router.put("/{group_id}/members/{user_id}", response_model=schemas.GroupMember)
+async def add_group_member(group_id: str, user_id: str, db: AsyncSession = Depends(get_db)):
+    # The member's effective entitlements include the group's grants as soon as this returns
+    db_member = await crud.add_group_member(db, group_id=group_id, user_id=user_id)
+    if db_member is None:
+        raise HTTPException(status_code=404, detail=GROUP_NOT_FOUND)
+    return db_member
+
+@router.delete("/{group_id}/members/{user_id}", response_model=schemas.GroupMember)
+async def remove_group_member(group_id: str, user_id: str, db: AsyncSession = Depends(get_db)):
+    db_member = await crud.remove_group_member(db, group_id=group_id, user_id=user_id)
+    if db_member is None:
+        raise HTTPException(status_code=404, detail="Group or member not found")
+    return db_member
+
+@router.get("/{group_id}/grants", response_model=List[schemas.GroupGrant])
+async def read_group_grants(group_id: str, db: AsyncSession = Depends(get_db)):
+    if await crud.get_group(db, group_id=group_id) is None:
+        raise HTTPException(status_code=404, detail=GROUP_NOT_FOUND)
+    return await crud.get_group_grants(db, group_id=group_id)
+
+@router.put("/{group_id}/grants", response_model=schemas.GroupGrant)
+async def set_group_grant(group_id: str, grant: schemas.GroupGrantCreate, db: AsyncSession = Depends(get_db)):
+    # Creates or replaces the group's grant on grant.resource_type/resource_id
+    db_grant = await crud.set_group_grant(db, group_id=group_id, grant=grant)
+    if db_grant is None:
+        raise HTTPException(status_code=404, detail=GROUP_NOT_FOUND)
+    return db_grant
+
+@router.delete("/{group_id}/grants/{resource_type}/{resource_id}", response_model=schemas.GroupGrant)
+async def delete_group_grant(group_id: str, resource_type: str, resource_id: str, db: AsyncSession = Depends(get_db)):
+    db_grant = await crud.delete_group_grant(db, group_id=group_id, resource_type=resource_type, resource_id=resource_id)
+    if db_grant is None:
+        raise HTTPException(status_code=404, detail="Group or grant not found")
+    return db_grant
@@ -0,0 +1,44 @@
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
+from typing import List
+
+from app import crud, schemas
+from app.database import get_db
+
+router = APIRouter()
+
+@router.get("/{resource_type}/{resource_id}/parent", response_model=schemas.ResourceLink)
+async def read_resource_parent(resource_type: str, resource_id: str, db: AsyncSession = Depends(get_db)):
+    db_link = await crud.get_resource_parent(db, resource_type=resource_type, resource_id=resource_id)
+    if db_link is None:
+        raise HTTPException(status_code=404, detail="Resource has no parent")
+    return db_link
+
+@router.put("/{resource_type}/{resource_id}/parent", response_model=schemas.ResourceLink)
+async def set_resource_parent(
+    resource_type: str,
+    resource_id: str,
+    parent: schemas.ResourceParent,
+    db: AsyncSession = Depends(get_db)
+):
+    # Grants on the parent or any of its ancestors then apply to this resource and everything below it
+    if crud.WILDCARD in (resource_id, parent.parent_id):
+        raise HTTPException(status_code=400, detail="Wildcard resources cannot be linked")
+    try:
+        return await crud.set_resource_parent(
+            db, resource_type=resource_type, resource_id=resource_id,
+            parent_type=parent.parent_type, parent_id=parent.parent_id
+        )
+    except crud.ResourceCycleError:
+        raise HTTPException(status_code=409, detail="The parent is this resource or one of its descendants")
+
+@router.delete("/{resource_type}/{resource_id}/parent", response_model=schemas.ResourceLink)
+async def remove_resource_parent(resource_type: str, resource_id: str, db: AsyncSession = Depends(get_db)):
+    db_link = await crud.remove_resource_parent(db, resource_type=resource_type, resource_id=resource_id)
+    if db_link is None:
+        raise HTTPException(status_code=404, detail="Resource has no parent")
+    return db_link
+
+@router.get("/{resource_type}/{resource_id}/ancestors", response_model=List[schemas.ResourceAncestor])
+async def read_resource_ancestors(resource_type: str, resource_id: str, db: AsyncSession = Depends(get_db)):
+    return await crud.get_resource_ancestors(db, resource_type=resource_type, resource_id=resource_id)
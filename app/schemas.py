@@ -1,5 +1,5 @@
-from pydantic import BaseModel, UUID4
-from typing import Optional, List
+from pydantic import BaseModel, ConfigDict, Field, UUID4, field_validator
+from typing import Any, Dict, Optional, List
 from datetime import datetime
 
 # Base schema for Entitlement
@@ -28,19 +28,169 @@ class EntitlementUpdate(BaseModel):
     granted_by: Optional[str] = None
     expires_at: Optional[datetime] = None
 
+    # The key fields may be left out but not cleared: an explicit null is a 422, not a 409
+    # from the NOT NULL constraint
+    @field_validator("user_id", "resource_type", "resource_id")
+    @classmethod
+    def _not_null(cls, value: Optional[str]) -> str:
+        if value is None:
+            raise ValueError("may be omitted but not null")
+        return value
+
 # Schema for reading/returning an Entitlement (response)
 class Entitlement(EntitlementBase):
     id: UUID4
     created_at: datetime
     updated_at: Optional[datetime] = None
+    version: int
 
-    class Config:
-        orm_mode = True # Pydantic V1
-        # from_attributes = True # Pydantic V2
+    model_config = ConfigDict(from_attributes=True)
 
 # For paginated list response
 class EntitlementList(BaseModel):
     items: List[Entitlement]
-    total: int
+    total: Optional[int] = None # Exact, estimated or omitted depending on the `count` query parameter
+    next_cursor: Optional[str] = None # Pass as `cursor` to fetch the next page; None on the last page
     # page: int
     # size: int
+
+# Result of an authorization check for a single (user, resource) pair
+class EntitlementCheck(BaseModel):
+    user_id: str
+    resource_type: str
+    resource_id: str
+    allowed: bool
+    access_level: Optional[str] = None
+
+# A (user, resource) pair; identifies at most one entitlement
+class EntitlementKey(BaseModel):
+    user_id: str
+    resource_type: str
+    resource_id: str
+
+class EntitlementCheckBatch(BaseModel):
+    items: List[EntitlementKey] = Field(..., min_length=1, max_length=1000)
+
+# Decisions are returned in the same order as the request items
+class EntitlementCheckBatchResult(BaseModel):
+    results: List[EntitlementCheck]
+
+# Reverse lookups; lists are capped at LOOKUP_MAX_IDS by the endpoints
+class ResourceUsersLookup(BaseModel):
+    resource_type: str
+    resource_ids: List[str] = Field(..., min_length=1)
+    user_ids: Optional[List[str]] = Field(None, min_length=1) # Only report these users
+
+class UserResourcesLookup(BaseModel):
+    user_id: str
+    resource_type: str
+    resource_ids: Optional[List[str]] = Field(None, min_length=1) # Only check these resources, e.g. search hits
+
+# Counters of the in-process decision cache behind the check endpoint
+class DecisionCacheStats(BaseModel):
+    size: int
+    maxsize: int
+    ttl_seconds: float
+    hits: int
+    misses: int
+    evictions: int
+    expirations: int
+    invalidations: int
+
+# Bulk write requests. Items are validated one by one so a bad item is reported
+# in the per-item results instead of rejecting the whole request.
+class EntitlementBulkCreate(BaseModel):
+    items: List[Dict[str, Any]] = Field(..., min_length=1)
+
+class EntitlementBulkRevoke(BaseModel):
+    items: List[EntitlementKey] = Field(..., min_length=1)
+
+class BulkItemResult(BaseModel):
+    index: int
+    status: str # 'created', 'updated', 'revoked', 'conflict', 'duplicate', 'not_found' or 'invalid'
+    id: Optional[UUID4] = None
+    error: Optional[str] = None
+
+class BulkResult(BaseModel):
+    succeeded: int
+    failed: int
+    results: List[BulkItemResult]
+
+# Outcome of a streamed NDJSON/CSV import
+class ImportRowError(BaseModel):
+    line: int
+    error: str
+
+class ImportReport(BaseModel):
+    processed: int = 0 # Data rows read from the input
+    inserted: int = 0
+    updated: int = 0
+    skipped: int = 0 # Existing entitlements left untouched, or rows superseded by a later row for the same key
+    rejected: int = 0
+    batches: int = 0
+    errors: List[ImportRowError] = [] # The first IMPORT_MAX_REPORTED_ERRORS rejected rows
+
+# Entitlement counts from the counters table; each group only carries the dimensions
+# that were grouped by
+class EntitlementStatsGroup(BaseModel):
+    resource_type: Optional[str] = None
+    access_level: Optional[str] = None
+    is_active: Optional[bool] = None
+    count: int
+
+class EntitlementStats(BaseModel):
+    total: int
+    groups: List[EntitlementStatsGroup]
+
+# New parent of a resource, e.g. the collection a document belongs to
+class ResourceParent(BaseModel):
+    parent_type: str
+    parent_id: str
+
+class ResourceLink(ResourceParent):
+    resource_type: str
+    resource_id: str
+    created_at: Optional[datetime] = None
+
+    model_config = ConfigDict(from_attributes=True)
+
+# One ancestor of a resource; depth 1 is the parent
+class ResourceAncestor(BaseModel):
+    ancestor_type: str
+    ancestor_id: str
+    depth: int
+
+    model_config = ConfigDict(from_attributes=True)
+
+class GroupCreate(BaseModel):
+    group_id: str
+    description: Optional[str] = None
+
+class Group(GroupCreate):
+    created_at: Optional[datetime] = None
+
+    model_config = ConfigDict(from_attributes=True)
+
+class GroupMember(BaseModel):
+    group_id: str
+    user_id: str
+    created_at: Optional[datetime] = None
+
+    model_config = ConfigDict(from_attributes=True)
+
+# A grant to every member of a group; one per group and resource
+class GroupGrantCreate(BaseModel):
+    resource_type: str
+    resource_id: str
+    access_level: Optional[str] = None
+    is_active: Optional[bool] = True
+    expires_at: Optional[datetime] = None
+    description: Optional[str] = None
+    granted_by: Optional[str] = None
+
+class GroupGrant(GroupGrantCreate):
+    group_id: str
+    created_at: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+
+    model_config = ConfigDict(from_attributes=True)
@@ -0,0 +1,140 @@
+import asyncio
+import functools
+import inspect
+import os
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+# Request coalescing for identical concurrent reads. The first caller for a key (the
+# leader) runs the query; callers arriving while it is in flight wait for its result,
+# or its exception, instead of issuing the same query on their own sessions. Nothing is
+# kept once the flight lands, so this is not a cache: a caller sees data at least as
+# fresh as the moment the flight it joined started.
+#
+# Flights and waits can be bounded by a timeout, set per coalesced function or with
+# SINGLEFLIGHT_TIMEOUT_SECONDS; by default they are not, as the reads were not before
+# they were coalesced. A leader that is cancelled (e.g. its client disconnected) does not
+# fail its followers; the next one in line starts a new flight.
+#
+# Flights are split by the database the session is bound to, so a read never takes its
+# result from another server, e.g. a lagging replica. A session with
+# info[SKIP_COALESCING] set always runs its own query: get_read_db sets it for reads
+# that must see a given write (X-Min-LSN), which a flight started before that write
+# might not, whichever worker made it.
+SINGLEFLIGHT_ENABLED = os.getenv("SINGLEFLIGHT_ENABLED", "true").strip().lower() in ("1", "true", "yes", "on")
+SINGLEFLIGHT_TIMEOUT_SECONDS = float(os.environ["SINGLEFLIGHT_TIMEOUT_SECONDS"]) if os.getenv("SINGLEFLIGHT_TIMEOUT_SECONDS") else None
+
+SKIP_COALESCING = "skip_coalescing"
+
+
+class SingleFlightTimeout(TimeoutError):
+    """A coalesced lookup did not complete within its timeout."""
+
+
+class SingleFlight:
+    def __init__(self, timeout: Optional[float] = SINGLEFLIGHT_TIMEOUT_SECONDS, enabled: bool = SINGLEFLIGHT_ENABLED):
+        self.timeout = timeout
+        self.enabled = enabled
+        self._flights: Dict[Hashable, asyncio.Future] = {}
+        self.leaders = 0
+        self.coalesced = 0
+        self.errors = 0
+        self.timeouts = 0
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[Any]], timeout: Optional[float] = None) -> Any:
+        timeout = self.timeout if timeout is None else timeout
+        if not self.enabled:
+            return await func()
+        while True:
+            flight = self._flights.get(key)
+            if flight is None:
+                return await self._lead(key, func, timeout)
+            try:
+                result = await asyncio.wait_for(asyncio.shield(flight), timeout)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                raise SingleFlightTimeout(f"Timed out after {timeout}s waiting for a coalesced lookup")
+            except asyncio.CancelledError:
+                if flight.cancelled():
+                    continue # The leader went away, not this caller
+                raise
+            except Exception:
+                self.coalesced += 1
+                raise
+            self.coalesced += 1
+            return result
+
+    async def _lead(self, key: Hashable, func: Callable[[], Awaitable[Any]], timeout: Optional[float]) -> Any:
+        flight = asyncio.get_running_loop().create_future()
+        self._flights[key] = flight
+        self.leaders += 1
+        try:
+            result = await asyncio.wait_for(func(), timeout)
+        except asyncio.CancelledError:
+            flight.cancel()
+            raise
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            exc = SingleFlightTimeout(f"Timed out after {timeout}s running a coalesced lookup")
+            self._fail(flight, exc)
+            raise exc
+        except Exception as exc:
+            self.errors += 1
+            self._fail(flight, exc)
+            raise
+        else:
+            flight.set_result(result)
+            return result
+        finally:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    @staticmethod
+    def _fail(flight: asyncio.Future, exc: BaseException) -> None:
+        flight.set_exception(exc)
+        flight.exception() # Marks it retrieved, so a flight without followers logs nothing
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._flights),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+        }
+
+
+singleflight = SingleFlight()
+
+
+def coalesce(
+    timeout: Optional[float] = None,
+    key: Callable[[], Hashable] = lambda: None,
+    adopt: Optional[Callable[[Any, Any], Awaitable[Any]]] = None,
+):
+    # Decorates an `async def f(db, ...)` read so concurrent calls with equal arguments on
+    # sessions bound to the same database share one execution. key() is added to the
+    # flight key, so callers can split flights, e.g. by a generation that changes on every
+    # write. Followers get the leader's result through `await adopt(db, result)` if
+    # given, e.g. to copy ORM objects into their own session.
+    def decorator(func):
+        signature = inspect.signature(func)
+        name = func.__name__
+
+        @functools.wraps(func)
+        async def wrapper(db, *args, **kwargs):
+            if db.info.get(SKIP_COALESCING):
+                return await func(db, *args, **kwargs)
+            bound = signature.bind(db, *args, **kwargs)
+            bound.apply_defaults()
+            arguments = tuple(value for param, value in bound.arguments.items() if param != "db")
+            led = False
+
+            async def lead():
+                nonlocal led
+                led = True
+                return await func(db, *args, **kwargs)
+
+            result = await singleflight.do((name, arguments, db.bind, key()), lead, timeout)
+            return result if led or adopt is None else await adopt(db, result)
+        return wrapper
+    return decorator
@@ -0,0 +1,95 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Optional
+
+from app import crud
+from app.database import get_sessionmaker
+
+# Background deactivation of expired grants, run from the app lifespan. Every
+# SWEEPER_INTERVAL_SECONDS it sweeps in batches of SWEEPER_BATCH_SIZE rows per table, one
+# short transaction each, pausing SWEEPER_BATCH_PAUSE_SECONDS between batches and
+# stopping after SWEEPER_MAX_BATCHES; a backlog beyond that waits for the next pass.
+# Workers sweeping at the same time skip each other's locked rows.
+SWEEPER_ENABLED = os.getenv("SWEEPER_ENABLED", "true").strip().lower() in ("1", "true", "yes", "on")
+SWEEPER_INTERVAL_SECONDS = float(os.getenv("SWEEPER_INTERVAL_SECONDS", "60"))
+SWEEPER_BATCH_SIZE = int(os.getenv("SWEEPER_BATCH_SIZE", "500"))
+SWEEPER_BATCH_PAUSE_SECONDS = float(os.getenv("SWEEPER_BATCH_PAUSE_SECONDS", "0.1"))
+SWEEPER_MAX_BATCHES = int(os.getenv("SWEEPER_MAX_BATCHES", "100"))
+
+logger = logging.getLogger(__name__)
+
+
+class ExpirySweeper:
+    def __init__(
+        self,
+        session_factory=None,
+        interval: float = SWEEPER_INTERVAL_SECONDS,
+        batch_size: int = SWEEPER_BATCH_SIZE,
+        pause: float = SWEEPER_BATCH_PAUSE_SECONDS,
+        max_batches: int = SWEEPER_MAX_BATCHES,
+    ):
+        self.session_factory = session_factory # None uses the app's, looked up when needed
+        self.interval = interval
+        self.batch_size = batch_size
+        self.pause = pause
+        self.max_batches = max_batches
+        self._task: Optional[asyncio.Task] = None
+        self.passes = 0
+        self.batches = 0
+        self.swept = 0
+        self.errors = 0
+        self.last_pass_at = 0.0 # time.time() of the last completed pass
+
+    async def sweep(self) -> int:
+        # One pass; returns the number of rows deactivated
+        swept = 0
+        for batch in range(self.max_batches):
+            if batch:
+                await asyncio.sleep(self.pause)
+            async with (self.session_factory or get_sessionmaker())() as db:
+                count, full = await crud.sweep_expired(db, self.batch_size)
+            self.batches += 1
+            swept += count
+            if not full:
+                break
+        self.passes += 1
+        self.swept += swept
+        self.last_pass_at = time.time()
+        return swept
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.sweep()
+            except Exception:
+                self.errors += 1
+                logger.exception("Expiry sweep failed")
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="expiry-sweeper")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "running": self._task is not None,
+            "passes": self.passes,
+            "batches": self.batches,
+            "swept": self.swept,
+            "errors": self.errors,
+            "last_pass_at": self.last_pass_at,
+        }
+
+
+sweeper = ExpirySweeper()
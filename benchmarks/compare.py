@@ -0,0 +1,45 @@
+import argparse
+import json
+import sys
+from typing import List, Optional
+
+# Compares two benchmarks.run reports, e.g. from the base and head of a change.
+# Exits non-zero when any scenario's p99 regresses by more than --threshold percent.
+
+METRICS = ("throughput_rps", "p50_ms", "p95_ms", "p99_ms")
+
+
+def _change(before: float, after: float) -> float:
+    return (after - before) / before * 100 if before else 0.0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Compare two benchmark reports.")
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--threshold", type=float, default=10.0, help="Allowed p99 regression in percent")
+    args = parser.parse_args(argv)
+
+    with open(args.before) as file:
+        before = json.load(file)
+    with open(args.after) as file:
+        after = json.load(file)
+
+    regressions = []
+    print(f"{'scenario':<20}" + "".join(f"{metric:>24}" for metric in METRICS))
+    for name, result in after["scenarios"].items():
+        base = before["scenarios"].get(name)
+        if base is None:
+            continue
+        cells = [f"{base[metric]:>9g} -> {result[metric]:<9g}({_change(base[metric], result[metric]):+.0f}%)" for metric in METRICS]
+        print(f"{name:<20}" + "".join(f"{cell:>24}" for cell in cells))
+        if _change(base["p99_ms"], result["p99_ms"]) > args.threshold:
+            regressions.append(name)
+    if regressions:
+        print(f"p99 regressed by more than {args.threshold:g}%: {', '.join(regressions)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
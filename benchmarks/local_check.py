@@ -0,0 +1,121 @@
+import argparse
+import json
+import random
+import socket
+import threading
+import time
+from typing import List, Optional
+
+import uvicorn
+
+from entitlements_client import EntitlementsClient
+
+from .common import database_url, git_revision, make_engine, summarize
+
+# Throughput of checks evaluated locally by entitlements_client, next to the same checks
+# over HTTP. The app is served by uvicorn on a local port against a database seeded by
+# benchmarks.seed; the client loads a snapshot from it like any remote client would,
+# and a sample of local decisions is compared with the service's before timing.
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _serve(url: str, port: int) -> uvicorn.Server:
+    from app.database import get_db, get_sessionmaker
+    from app.main import app
+
+    # Created on first use, inside the server's event loop
+    engine, session_factory = make_engine(url)
+
+    async def override_get_db():
+        async with session_factory() as session:
+            yield session
+
+    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_sessionmaker] = lambda: session_factory
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", lifespan="off"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def _keys(client: EntitlementsClient, count: int, miss_ratio: float, rng: random.Random) -> List[tuple]:
+    granted = list(client.index._grants)
+    keys = []
+    for _ in range(count):
+        if rng.random() < miss_ratio:
+            keys.append((f"missing_{rng.getrandbits(32)}", "document", "none"))
+        else:
+            keys.append(rng.choice(granted))
+    return keys
+
+
+def run(args: argparse.Namespace) -> dict:
+    port = _free_port()
+    server = _serve(database_url(args.database_url), port)
+    rng = random.Random(args.seed)
+    try:
+        with EntitlementsClient(f"http://127.0.0.1:{port}", resource_types=args.resource_type) as client:
+            started = time.perf_counter()
+            client.sync()
+            snapshot_s = time.perf_counter() - started
+            keys = _keys(client, args.checks, args.miss_ratio, rng)
+
+            api = "/api/v1/entitlements/check"
+            http = client._http
+            for user_id, resource_type, resource_id in keys[:args.verify]:
+                expected = http.get(api, params={"user_id": user_id, "resource_type": resource_type, "resource_id": resource_id}).json()
+                local = client.check(user_id, resource_type, resource_id)
+                assert (local.allowed, local.access_level) == (expected["allowed"], expected["access_level"]), (user_id, resource_type, resource_id)
+
+            started = time.perf_counter()
+            for user_id, resource_type, resource_id in keys:
+                client.check(user_id, resource_type, resource_id)
+            local_s = time.perf_counter() - started
+
+            latencies = []
+            for user_id, resource_type, resource_id in keys[:args.http_checks]:
+                started = time.perf_counter()
+                http.get(api, params={"user_id": user_id, "resource_type": resource_type, "resource_id": resource_id})
+                latencies.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            client.sync()
+            poll_s = time.perf_counter() - started
+
+            return {
+                "git_revision": git_revision(),
+                "resource_types": args.resource_type,
+                "snapshot": {"keys": len(client.index), "seq": client.index.seq, "load_s": round(snapshot_s, 3)},
+                "local": {
+                    "checks": len(keys),
+                    "checks_per_s": round(len(keys) / local_s),
+                    "per_check_us": round(local_s / len(keys) * 1e6, 3),
+                },
+                "http": summarize(latencies, 0, sum(latencies)),
+                "empty_poll_ms": round(poll_s * 1000, 3),
+            }
+    finally:
+        server.should_exit = True
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Benchmark local checks of entitlements_client against HTTP checks.")
+    parser.add_argument("--database-url", help="Seeded database (default: BENCH_DATABASE_URL)")
+    parser.add_argument("--resource-type", action="append", help="Snapshot filter; repeat for several (default: all types)")
+    parser.add_argument("--checks", type=int, default=1000000, help="Local checks to time")
+    parser.add_argument("--http-checks", type=int, default=1000, help="Sequential HTTP checks to time for comparison")
+    parser.add_argument("--verify", type=int, default=500, help="Local decisions compared with the service first")
+    parser.add_argument("--miss-ratio", type=float, default=0.2, help="Fraction of checks for keys that have no grant")
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args(argv)
+    print(json.dumps(run(args), indent=2))
+
+
+if __name__ == "__main__":
+    main()
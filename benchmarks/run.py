@@ -0,0 +1,236 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import httpx
+from sqlalchemy import text
+
+from .common import database_url, git_revision, make_engine, summarize
+
+# Drives the entitlements endpoints in-process through the ASGI app (no network hop),
+# with a fixed number of concurrent workers per scenario, against a database seeded by
+# benchmarks.seed. Each scenario reports throughput and latency percentiles; the whole
+# run is printed (or written with --output) as one JSON document so runs on different
+# commits can be compared with benchmarks.compare.
+
+API = "/api/v1/entitlements"
+RUN_GRANTOR = "bench_run" # Rows written by write scenarios, removed after the run
+
+Scenario = Callable[[httpx.AsyncClient, random.Random], Awaitable[httpx.Response]]
+
+
+async def _sample_keys(session_factory, size: int) -> List[dict]:
+    # TABLESAMPLE keeps sampling cheap on tens of millions of rows, unlike ORDER BY random()
+    async with session_factory() as session:
+        estimate = (await session.execute(
+            text("SELECT reltuples FROM pg_class WHERE relname = 'entitlements'")
+        )).scalar() or 0
+        percent = min(100.0, max(0.01, size * 200.0 / estimate)) if estimate > 0 else 100.0
+        rows = (await session.execute(
+            text(
+                f"SELECT id, user_id, resource_type, resource_id FROM entitlements "
+                f"TABLESAMPLE SYSTEM ({percent:.4f}) LIMIT :size"
+            ),
+            {"size": size},
+        )).mappings().all()
+    if not rows:
+        raise SystemExit("The benchmark database is empty; run python -m benchmarks.seed first")
+    return [dict(row) for row in rows]
+
+
+def _scenarios(keys: List[dict], miss_ratio: float, batch_size: int) -> Dict[str, Scenario]:
+    def key(rng: random.Random) -> dict:
+        if rng.random() < miss_ratio:
+            return {"user_id": f"missing_{rng.getrandbits(32)}", "resource_type": "document", "resource_id": "none"}
+        sample = rng.choice(keys)
+        return {name: sample[name] for name in ("user_id", "resource_type", "resource_id")}
+
+    def new_key(rng: random.Random) -> dict:
+        return {"user_id": f"{RUN_GRANTOR}_{uuid.uuid4().hex}", "resource_type": "document", "resource_id": str(rng.getrandbits(48))}
+
+    async def check(client, rng):
+        return await client.get(f"{API}/check", params=key(rng))
+
+    async def check_batch(client, rng):
+        return await client.post(f"{API}/check/batch", json={"items": [key(rng) for _ in range(batch_size)]})
+
+    async def get(client, rng):
+        return await client.get(f"{API}/{rng.choice(keys)['id']}")
+
+    async def list_by_user(client, rng):
+        return await client.get(f"{API}/", params={"user_id": rng.choice(keys)["user_id"], "limit": 100})
+
+    async def list_by_resource(client, rng):
+        sample = rng.choice(keys)
+        params = {"resource_type": sample["resource_type"], "resource_id": sample["resource_id"], "count": "estimate"}
+        return await client.get(f"{API}/", params=params)
+
+    async def list_cursor_pages(client, rng):
+        # Walks a few pages of an unfiltered listing the way a sync job would
+        params = {"limit": 200, "count": "none"}
+        response = None
+        for _ in range(5):
+            response = await client.get(f"{API}/", params=params)
+            next_cursor = response.json().get("next_cursor") if response.status_code == 200 else None
+            if not next_cursor:
+                break
+            params["cursor"] = next_cursor
+        return response
+
+    async def export_user(client, rng):
+        params = {"user_id": rng.choice(keys)["user_id"], "format": "ndjson"}
+        return await client.get(f"{API}/export", params=params)
+
+    async def create(client, rng):
+        return await client.post(f"{API}/", json={**new_key(rng), "access_level": "read", "granted_by": RUN_GRANTOR})
+
+    async def update(client, rng):
+        created = await create(client, rng)
+        if created.status_code != 201:
+            return created
+        return await client.put(f"{API}/{created.json()['id']}", json={"access_level": "write"})
+
+    async def delete(client, rng):
+        created = await create(client, rng)
+        if created.status_code != 201:
+            return created
+        return await client.delete(f"{API}/{created.json()['id']}")
+
+    async def bulk_upsert(client, rng):
+        items = [{**new_key(rng), "access_level": "read", "granted_by": RUN_GRANTOR} for _ in range(batch_size)]
+        return await client.post(f"{API}/bulk/upsert", json={"items": items})
+
+    return {
+        "check": check,
+        "check_uncached": check,
+        "check_batch": check_batch,
+        "get": get,
+        "list_by_user": list_by_user,
+        "list_by_resource": list_by_resource,
+        "list_cursor_pages": list_cursor_pages,
+        "export_user": export_user,
+        "create": create,
+        "update": update,
+        "delete": delete,
+        "bulk_upsert": bulk_upsert,
+    }
+
+
+async def _run_scenario(client: httpx.AsyncClient, scenario: Scenario, requests: int, concurrency: int, seed: int) -> dict:
+    latencies: List[float] = []
+    errors = 0
+    remaining = requests
+
+    async def worker(index: int):
+        nonlocal remaining, errors
+        rng = random.Random(seed * 1000 + index) # Reproducible request mix per worker
+        while remaining > 0:
+            remaining -= 1
+            start = time.perf_counter()
+            try:
+                response = await scenario(client, rng)
+                ok = response.status_code < 400
+            except httpx.HTTPError:
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - start)
+            else:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(index) for index in range(concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+
+async def run(args: argparse.Namespace) -> dict:
+    from app import crud
+    from app.cache import decision_cache
+    from app.database import get_db, get_sessionmaker
+    from app.main import app
+
+    engine, session_factory = make_engine(database_url(args.database_url), pool_size=args.concurrency)
+
+    async def override_get_db():
+        async with session_factory() as session:
+            yield session
+
+    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_sessionmaker] = lambda: session_factory
+
+    keys = await _sample_keys(session_factory, args.sample_size)
+    scenarios = _scenarios(keys, args.miss_ratio, args.batch_size)
+    selected = args.scenario or list(scenarios)
+    unknown = [name for name in selected if name not in scenarios]
+    if unknown:
+        raise SystemExit(f"Unknown scenario(s): {', '.join(unknown)}; choose from {', '.join(scenarios)}")
+
+    async with session_factory() as session:
+        rows = (await session.execute(text("SELECT count(*) FROM entitlements"))).scalar()
+
+    results = {}
+    transport = httpx.ASGITransport(app=app)
+    original_maxsize = decision_cache.maxsize
+    try:
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            for name in selected:
+                decision_cache.clear()
+                decision_cache.maxsize = 0 if name == "check_uncached" else original_maxsize
+                if args.warmup:
+                    await _run_scenario(client, scenarios[name], args.warmup, args.concurrency, args.seed)
+                results[name] = await _run_scenario(client, scenarios[name], args.requests, args.concurrency, args.seed)
+                results[name]["concurrency"] = args.concurrency
+                print(f"{name}: {results[name]['throughput_rps']} req/s p99={results[name]['p99_ms']}ms", file=sys.stderr)
+    finally:
+        decision_cache.maxsize = original_maxsize
+        app.dependency_overrides.clear()
+        async with session_factory() as session:
+            await crud.delete_entitlements_granted_by(session, RUN_GRANTOR)
+        await engine.dispose()
+
+    return {
+        "started_at": datetime.now(timezone.utc).isoformat(),
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "dataset_rows": rows,
+        "settings": {
+            "requests": args.requests, "concurrency": args.concurrency, "warmup": args.warmup,
+            "miss_ratio": args.miss_ratio, "batch_size": args.batch_size, "seed": args.seed,
+        },
+        "scenarios": results,
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the entitlements endpoints against a seeded database.")
+    parser.add_argument("--database-url", help="Seeded database (default: BENCH_DATABASE_URL)")
+    parser.add_argument("--scenario", action="append", help="Scenario to run; repeat for several (default: all)")
+    parser.add_argument("--requests", type=int, default=2000, help="Requests per scenario")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--warmup", type=int, default=200, help="Unmeasured requests before each scenario")
+    parser.add_argument("--miss-ratio", type=float, default=0.2, help="Fraction of checks for keys that have no grant")
+    parser.add_argument("--batch-size", type=int, default=100, help="Items per batch check and bulk upsert")
+    parser.add_argument("--sample-size", type=int, default=10000, help="Existing rows sampled as request keys")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args(argv)
+
+    report = asyncio.run(run(args))
+    payload = json.dumps(report, indent=2)
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, "w") as file:
+            file.write(payload + "\n")
+    else:
+        print(payload)
+
+
+if __name__ == "__main__":
+    main()
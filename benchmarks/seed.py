@@ -0,0 +1,124 @@
+import argparse
+import asyncio
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import text
+
+from app import crud
+from app.database import Base
+
+from .common import database_url, make_engine
+
+# Seeds a synthetic entitlements dataset with realistic skew: a few users hold most of
+# the grants (Zipf-distributed grant counts), most grants are on documents, and some
+# resources are far more popular than others. Rows are generated on the fly and loaded
+# with COPY in batches, so memory does not depend on --rows; entitlement counters and
+# the change log are kept up to date as by the service.
+
+RESOURCE_TYPES = [("document", 0.70, 5_000_000), ("collection", 0.20, 200_000), ("tool_feature", 0.10, 500)]
+ACCESS_LEVELS = [("read", 0.70), ("write", 0.25), ("admin", 0.05)]
+COLUMNS = ["id", "user_id", "resource_type", "resource_id", "access_level", "is_active", "expires_at", "granted_by"]
+
+
+def _grant_counts(rows: int, users: int, skew: float, rng: random.Random):
+    # Zipf-like grant count per user, scaled so the counts add up to exactly `rows`
+    weights = [1.0 / (rank + 1) ** skew for rank in range(users)]
+    total = sum(weights)
+    counts = [max(1, int(rows * weight / total)) for weight in weights]
+    shortfall = rows - sum(counts)
+    for _ in range(abs(shortfall)):
+        position = rng.randrange(users)
+        if shortfall > 0:
+            counts[position] += 1
+        elif counts[position] > 1:
+            counts[position] -= 1
+    order = list(range(users))
+    rng.shuffle(order) # Popular users are not simply the first ids
+    return [(order[rank], count) for rank, count in enumerate(counts)]
+
+
+def _rows(rows: int, users: int, skew: float, seed: int):
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    type_names = [name for name, _, _ in RESOURCE_TYPES]
+    type_weights = [weight for _, weight, _ in RESOURCE_TYPES]
+    # Grow the resource id space with the dataset so heavy users still find distinct resources
+    scale = max(1, rows // 1_000_000)
+    type_sizes = {name: size * scale for name, _, size in RESOURCE_TYPES}
+    levels = [name for name, _ in ACCESS_LEVELS]
+    level_weights = [weight for _, weight in ACCESS_LEVELS]
+    for user_index, count in _grant_counts(rows, users, skew, rng):
+        user_id = f"user_{user_index}"
+        seen = set()
+        for _ in range(count):
+            while True:
+                resource_type = rng.choices(type_names, type_weights)[0]
+                # Skewed resource popularity: low ids are drawn much more often
+                resource_id = f"{resource_type}_{int(type_sizes[resource_type] * rng.random() ** 3)}"
+                if (resource_type, resource_id) not in seen:
+                    seen.add((resource_type, resource_id))
+                    break
+            roll = rng.random()
+            expires_at = None
+            if roll < 0.05:
+                expires_at = now - timedelta(days=rng.randint(1, 365))
+            elif roll < 0.10:
+                expires_at = now + timedelta(days=rng.randint(1, 365))
+            yield (
+                uuid.UUID(int=rng.getrandbits(128), version=4),
+                user_id,
+                resource_type,
+                resource_id,
+                rng.choices(levels, level_weights)[0],
+                rng.random() >= 0.05,
+                expires_at,
+                "bench_seed",
+            )
+
+
+async def seed(url: str, rows: int, users: int, skew: float, seed_value: int, batch_size: int, reset: bool) -> None:
+    engine, session_factory = make_engine(url, pool_size=1)
+    async with engine.begin() as conn:
+        if reset:
+            await conn.run_sync(Base.metadata.drop_all)
+        await conn.run_sync(Base.metadata.create_all)
+
+    started = time.perf_counter()
+    loaded = 0
+    async with session_factory() as session:
+        batch = []
+        for record in _rows(rows, users, skew, seed_value):
+            batch.append(dict(zip(COLUMNS, record)))
+            if len(batch) >= batch_size:
+                # One transaction per batch, counted and logged as a service write would be
+                loaded += await crud.copy_entitlements(session, batch)
+                batch = []
+                rate = loaded / (time.perf_counter() - started)
+                print(f"loaded {loaded}/{rows} rows ({rate:,.0f} rows/s)", file=sys.stderr)
+        loaded += await crud.copy_entitlements(session, batch)
+        await session.execute(text("ANALYZE entitlements"))
+        await session.commit()
+    await engine.dispose()
+    print(f"seeded {loaded} rows for {users} users in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Seed a synthetic entitlements dataset for benchmarks.")
+    parser.add_argument("--database-url", help="Scratch database (default: BENCH_DATABASE_URL)")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--users", type=int, default=None, help="Default: rows / 50")
+    parser.add_argument("--skew", type=float, default=1.1, help="Zipf exponent of grants per user")
+    parser.add_argument("--seed", type=int, default=42, help="Random seed; the same seed produces the same dataset")
+    parser.add_argument("--batch-size", type=int, default=50_000, help="Rows per COPY")
+    parser.add_argument("--reset", action="store_true", help="Drop and recreate the schema first")
+    args = parser.parse_args(argv)
+    users = args.users or max(1, args.rows // 50)
+    asyncio.run(seed(database_url(args.database_url), args.rows, users, args.skew, args.seed, args.batch_size, args.reset))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+import argparse
+import asyncio
+import json
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from sqlalchemy import Row
+
+from app import crud, models
+from app.export import page_json
+from app.routers import entitlements
+
+from .common import git_revision
+
+# Per-item cost of serializing a GET /entitlements/ page, without the database: the
+# model path (ORM objects validated and dumped through the route's response_model,
+# then rendered by JSONResponse, as FastAPI does) against the fast path (plain rows
+# encoded by export.page_json).
+
+
+def _values(index: int):
+    now = datetime.now(timezone.utc)
+    return {
+        "id": uuid.uuid4(),
+        "user_id": f"user_{index % 50}",
+        "resource_type": "document",
+        "resource_id": f"document_{index}",
+        "access_level": "read",
+        "is_active": True,
+        "description": "Synthetic entitlement" if index % 3 else None,
+        "granted_by": "bench_seed",
+        "expires_at": now + timedelta(days=30) if index % 10 == 0 else None,
+        "created_at": now,
+        "updated_at": None,
+        "version": 1,
+    }
+
+
+def _list_route():
+    return next(route for route in entitlements.router.routes if route.path == "/" and "GET" in route.methods)
+
+
+async def _model_path(field, objects) -> bytes:
+    content = {"items": objects, "total": len(objects), "next_cursor": None}
+    body = await serialize_response(field=field, response_content=content, is_coroutine=True)
+    return JSONResponse(body).body
+
+
+async def _fast_path(rows) -> bytes:
+    return page_json(crud.ENTITLEMENT_FIELDS, rows, len(rows), None)
+
+
+async def _time(func, repeat: int) -> float:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        await func()
+    return time.perf_counter() - started
+
+
+async def run(page_size: int, repeat: int) -> dict:
+    values = [_values(index) for index in range(page_size)]
+    objects = [models.Entitlement(**value) for value in values]
+    # Rows shaped like what crud.get_entitlements(as_rows=True) returns
+    keys = {name: index for index, name in enumerate(crud.ENTITLEMENT_FIELDS)}
+    rows = [Row(None, None, keys, tuple(value[name] for name in crud.ENTITLEMENT_FIELDS)) for value in values]
+    field = _list_route().response_field
+
+    model_body = await _model_path(field, objects)
+    fast_body = await _fast_path(rows)
+    assert json.loads(model_body) == json.loads(fast_body), "fast path output differs from the response model"
+
+    results = {}
+    for name, func in (("model", lambda: _model_path(field, objects)), ("fast", lambda: _fast_path(rows))):
+        await _time(func, max(1, repeat // 10)) # Warm up
+        elapsed = await _time(func, repeat)
+        results[name] = {
+            "per_page_us": round(elapsed / repeat * 1e6, 2),
+            "per_item_us": round(elapsed / repeat / page_size * 1e6, 3),
+        }
+    return {
+        "git_revision": git_revision(),
+        "page_size": page_size,
+        "repeat": repeat,
+        "results": results,
+        "speedup": round(results["model"]["per_item_us"] / results["fast"]["per_item_us"], 2),
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Measure per-item serialization cost of a list page.")
+    parser.add_argument("--page-size", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=500)
+    args = parser.parse_args(argv)
+    print(json.dumps(asyncio.run(run(args.page_size, args.repeat)), indent=2))
+
+
+if __name__ == "__main__":
+    main()
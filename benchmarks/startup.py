@@ -0,0 +1,116 @@
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import List, Optional
+
+from .common import database_url, git_revision
+
+# Cold start of the app: a fresh interpreter importing app.main, then running the
+# lifespan startup, as each uvicorn worker does. startup_ms counts from the end of the
+# import to the app being ready, including connect_ms (the first connection) and
+# schema_ms (the schema step). --workers starts that many at once against the same
+# database, like a multi-worker deploy. Modes:
+#   create_all  what every worker did before versioned migrations (SCHEMA_ON_STARTUP=off
+#               plus Base.metadata.create_all)
+#   migrate     the default: pending migrations under the advisory lock, else a version check
+#   check       version check only
+# The database should already be at the current schema version (run
+# `python -m app.migrations upgrade` against it first), as in a steady-state deploy.
+MODES = ("create_all", "migrate", "check")
+
+
+async def _boot(mode: str) -> dict:
+    from sqlalchemy import text
+
+    from app import migrations
+    from app.database import Base, get_engine
+    from app.main import app
+
+    timings = {}
+    started = time.perf_counter()
+    # Opened first, so schema_ms does not include the first connection
+    async with get_engine().connect() as conn:
+        await conn.execute(text("SELECT 1"))
+    timings["connect_ms"] = (time.perf_counter() - started) * 1000
+
+    prepare_schema = migrations.prepare_schema
+
+    async def timed_prepare_schema(*args, **kwargs):
+        schema_started = time.perf_counter()
+        await prepare_schema(*args, **kwargs)
+        timings["schema_ms"] = (time.perf_counter() - schema_started) * 1000
+
+    if mode == "create_all":
+        schema_started = time.perf_counter()
+        async with get_engine().begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        timings["schema_ms"] = (time.perf_counter() - schema_started) * 1000
+    else:
+        migrations.prepare_schema = timed_prepare_schema
+    async with app.router.lifespan_context(app):
+        timings["startup_ms"] = (time.perf_counter() - started) * 1000
+    return timings
+
+
+def _child(mode: str) -> None:
+    started = time.perf_counter()
+    import app.main  # noqa: F401
+    imported = time.perf_counter()
+    timings = asyncio.run(_boot(mode))
+    print(json.dumps({"import_ms": (imported - started) * 1000, **timings}))
+
+
+def _start_workers(url: str, mode: str, workers: int) -> List[dict]:
+    env = {
+        **os.environ,
+        "DATABASE_URL": url,
+        "SCHEMA_ON_STARTUP": "off" if mode == "create_all" else mode,
+        "SWEEPER_ENABLED": "false",
+    }
+    processes = [
+        subprocess.Popen([sys.executable, "-m", "benchmarks.startup", "--child", mode], env=env, stdout=subprocess.PIPE, text=True)
+        for _ in range(workers)
+    ]
+    results = []
+    for process in processes:
+        out, _ = process.communicate()
+        if process.returncode != 0:
+            raise SystemExit(f"{mode} worker failed with exit status {process.returncode}")
+        results.append(json.loads(out))
+    return results
+
+
+def run(args: argparse.Namespace) -> dict:
+    url = database_url(args.database_url)
+    report = {"git_revision": git_revision(), "workers": args.workers, "rounds": args.rounds, "modes": {}}
+    for mode in args.mode or MODES:
+        results = [result for _ in range(args.rounds) for result in _start_workers(url, mode, args.workers)]
+        report["modes"][mode] = {
+            f"{name}_median": round(statistics.median(result[name] for result in results), 1)
+            for name in ("import_ms", "connect_ms", "schema_ms", "startup_ms")
+        }
+        report["modes"][mode]["startup_ms_max"] = round(max(result["startup_ms"] for result in results), 1)
+    return report
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Measure cold start (import plus lifespan startup) of app workers.")
+    parser.add_argument("--database-url", help="Database at the current schema version (default: BENCH_DATABASE_URL)")
+    parser.add_argument("--mode", action="append", choices=MODES, help="Startup mode; repeat for several (default: all)")
+    parser.add_argument("--workers", type=int, default=4, help="Workers started at once")
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--child", choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    if args.child:
+        _child(args.child)
+        return
+    print(json.dumps(run(args), indent=2))
+
+
+if __name__ == "__main__":
+    main()
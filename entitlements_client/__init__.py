@@ -0,0 +1,4 @@
+from .client import EntitlementsClient
+from .index import Decision, LocalIndex
+
+__all__ = ["Decision", "EntitlementsClient", "LocalIndex"]
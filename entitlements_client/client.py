@@ -0,0 +1,98 @@
+import logging
+import threading
+import time
+from typing import Optional, Sequence
+
+import httpx
+
+from .index import Decision, LocalIndex
+
+# Keeps a LocalIndex in sync with an entitlements service: a snapshot first, then change
+# pages polled every poll_interval seconds from a background thread (start()), or on
+# demand (sync()). A position the service has pruned (410) triggers a fresh snapshot.
+
+logger = logging.getLogger(__name__)
+
+
+class EntitlementsClient:
+    def __init__(
+        self,
+        base_url: str,
+        resource_types: Optional[Sequence[str]] = None,
+        poll_interval: float = 1.0,
+        api_prefix: str = "/api/v1",
+        http: Optional[httpx.Client] = None,
+    ):
+        self.resource_types = list(resource_types) if resource_types else None
+        self.poll_interval = poll_interval
+        self.index = LocalIndex()
+        self._http = http or httpx.Client(base_url=base_url, timeout=30.0)
+        self._owns_http = http is None
+        self._path = f"{api_prefix}/entitlements"
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.last_synced: Optional[float] = None # time.monotonic() of the last successful sync
+
+    def __enter__(self) -> "EntitlementsClient":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def _params(self, **params) -> dict:
+        if self.resource_types:
+            params["resource_type"] = self.resource_types
+        return params
+
+    def load_snapshot(self) -> None:
+        with self._http.stream("GET", f"{self._path}/snapshot", params=self._params()) as response:
+            response.raise_for_status()
+            self.index.load_snapshot(response.iter_lines())
+
+    def sync(self) -> int:
+        # Brings the index up to date; returns the change sequence it is now current with
+        if self.index.seq is None:
+            self.load_snapshot()
+        while True:
+            response = self._http.get(f"{self._path}/changes", params=self._params(since=self.index.seq))
+            if response.status_code == 410:
+                self.load_snapshot()
+                continue
+            response.raise_for_status()
+            page = response.json()
+            self.index.apply_changes(page)
+            if not page["more"]:
+                break
+        self.last_synced = time.monotonic()
+        return self.index.seq
+
+    def check(self, user_id: str, resource_type: str, resource_id: str) -> Decision:
+        if self.index.seq is None:
+            raise RuntimeError("No snapshot loaded yet; call sync() or start() first")
+        return self.index.check(user_id, resource_type, resource_id)
+
+    def staleness(self) -> Optional[float]:
+        # Seconds since the index was last known to be current
+        return None if self.last_synced is None else time.monotonic() - self.last_synced
+
+    def start(self) -> None:
+        # Loads the snapshot in the caller's thread, so checks work as soon as this returns
+        self.sync()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._poll, name="entitlements-sync", daemon=True)
+        self._thread.start()
+
+    def _poll(self) -> None:
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.sync()
+            except (httpx.HTTPError, ValueError):
+                logger.warning("Entitlements sync failed; serving checks from the last synced state", exc_info=True)
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._owns_http:
+            self._http.close()
@@ -0,0 +1,120 @@
+import json
+import time
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+# In-memory copy of the service's grants and resource hierarchy, built from a snapshot
+# and kept current with change pages. check() gives the same answer as
+# GET /entitlements/check for the data it holds, without a network hop: the strongest
+# unexpired grant of the user on the resource, any of its ancestors, or a wildcard on
+# any of their types.
+#
+# Updates replace whole entries and never mutate one in place, so check() can run in
+# other threads while a change page is applied.
+
+# Must match app.crud.ACCESS_LEVELS and app.crud.WILDCARD
+ACCESS_LEVELS = ("read", "write", "admin")
+WILDCARD = "*"
+
+_RANKS = {level: rank for rank, level in enumerate(ACCESS_LEVELS, start=1)}
+
+Key = Tuple[str, str, str]
+Resource = Tuple[str, str]
+
+
+class Grant(NamedTuple):
+    rank: int
+    created_at: float
+    access_level: Optional[str]
+    expires_at: Optional[float]
+
+
+class Decision(NamedTuple):
+    allowed: bool
+    access_level: Optional[str] = None
+
+
+DENIED = Decision(False)
+
+
+def _grant(row: Sequence) -> Tuple[Key, Grant]:
+    user_id, resource_type, resource_id, access_level, expires_at, created_at = row
+    return (user_id, resource_type, resource_id), Grant(_RANKS.get(access_level, 0), created_at or 0.0, access_level, expires_at)
+
+
+def _group_grants(rows: Iterable[Sequence]) -> Dict[Key, Tuple[Grant, ...]]:
+    grouped: Dict[Key, List[Grant]] = {}
+    for row in rows:
+        key, grant = _grant(row)
+        grouped.setdefault(key, []).append(grant)
+    return {key: tuple(grants) for key, grants in grouped.items()}
+
+
+def _group_ancestors(rows: Iterable[Sequence]) -> Dict[Resource, Tuple[Resource, ...]]:
+    grouped: Dict[Resource, List[Tuple[int, Resource]]] = {}
+    for resource_type, resource_id, ancestor_type, ancestor_id, depth in rows:
+        grouped.setdefault((resource_type, resource_id), []).append((depth, (ancestor_type, ancestor_id)))
+    return {resource: tuple(ancestor for _, ancestor in sorted(ancestors)) for resource, ancestors in grouped.items()}
+
+
+class LocalIndex:
+    def __init__(self):
+        self.seq: Optional[int] = None # Change sequence the index is current with
+        self.resource_types: Optional[frozenset] = None # None: every type
+        self._grants: Dict[Key, Tuple[Grant, ...]] = {}
+        self._ancestors: Dict[Resource, Tuple[Resource, ...]] = {}
+
+    def __len__(self) -> int:
+        return len(self._grants)
+
+    def load_snapshot(self, lines: Iterable[Union[str, bytes]]) -> None:
+        # Replaces the whole index with a GET /entitlements/snapshot body, line by line
+        seq, resource_types = None, None
+        grant_rows: List[Sequence] = []
+        ancestor_rows: List[Sequence] = []
+        for line in lines:
+            if not line.strip():
+                continue
+            part = json.loads(line)
+            if "seq" in part:
+                seq, resource_types = part["seq"], part.get("resource_types")
+            grant_rows.extend(part.get("grants", ()))
+            ancestor_rows.extend(part.get("ancestors", ()))
+        if seq is None:
+            raise ValueError("Snapshot has no header line")
+        self._grants = _group_grants(grant_rows)
+        self._ancestors = _group_ancestors(ancestor_rows)
+        self.resource_types = frozenset(resource_types) if resource_types else None
+        self.seq = seq
+
+    def apply_changes(self, page: dict) -> None:
+        # Applies one GET /entitlements/changes page; listed keys and resources take the
+        # state in the page, which is empty when their grants or parent are gone
+        if self.seq is None or page["since"] != self.seq:
+            raise ValueError(f"Change page starts at {page['since']}, index is at {self.seq}")
+        grants = _group_grants(page["grants"])
+        for key in map(tuple, page["keys"]):
+            if key in grants:
+                self._grants[key] = grants[key]
+            else:
+                self._grants.pop(key, None)
+        ancestors = _group_ancestors(page["ancestors"])
+        for resource in map(tuple, page["resources"]):
+            if resource in ancestors:
+                self._ancestors[resource] = ancestors[resource]
+            else:
+                self._ancestors.pop(resource, None)
+        self.seq = page["seq"]
+
+    def check(self, user_id: str, resource_type: str, resource_id: str, now: Optional[float] = None) -> Decision:
+        if self.resource_types is not None and resource_type not in self.resource_types:
+            raise KeyError(f"Resource type {resource_type!r} is not in this index")
+        now = time.time() if now is None else now
+        grants = self._grants
+        best = None
+        for target_type, target_id in ((resource_type, resource_id),) + self._ancestors.get((resource_type, resource_id), ()):
+            for grant in grants.get((user_id, target_type, target_id), ()) + grants.get((user_id, target_type, WILDCARD), ()):
+                if grant.expires_at is not None and grant.expires_at <= now:
+                    continue
+                if best is None or (grant.rank, grant.created_at) > (best.rank, best.created_at):
+                    best = grant
+        return DENIED if best is None else Decision(True, best.access_level)
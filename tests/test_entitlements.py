@@ -1,10 +1,20 @@
+import asyncio
+import csv
+import io
+import json
 import os
+import re
+import subprocess
+import sys
+from datetime import datetime, timedelta, timezone
 from typing import AsyncGenerator  # Import AsyncGenerator
-from uuid import uuid4
+from uuid import UUID, uuid4
 
+import asyncpg
 import pytest
 from dotenv import load_dotenv
 from httpx import AsyncClient
+from sqlalchemy import inspect as sqlalchemy_inspect, text
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
 
@@ -16,8 +26,14 @@ TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL", os.getenv("DATABASE_URL", "po
 if "entitlements_db" in TEST_DATABASE_URL and "test_entitlements_db" not in TEST_DATABASE_URL:
     print(f"WARNING: Test database URL might be pointing to production DB: {TEST_DATABASE_URL}. Ensure this is intended.")
 
+from app import crud, metrics, migrations, partitioning, replicas
+from app.singleflight import SKIP_COALESCING, SingleFlight, SingleFlightTimeout, singleflight
+from app.sweeper import ExpirySweeper
+from app.audit import AuditWriter
+from entitlements_client import LocalIndex
+from app.cache import decision_cache
 from app.database import (  # Base for table creation, get_db for overriding
-    Base, get_db)
+    Base, get_db, get_sessionmaker)
 # Ensure the main app module can be imported
 # This might require adjusting PYTHONPATH or how tests are run
 from app.main import app  # FastAPI app instance
@@ -33,6 +49,7 @@ TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engin
 async def db_session() -> AsyncGenerator[AsyncSession, None]: # Corrected type hint
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+    decision_cache.clear() # Decisions cached by a previous test refer to dropped rows
     
     session = TestingSessionLocal()
     try:
@@ -51,8 +68,10 @@ async def override_get_db(db_session: AsyncSession):
         finally:
             pass # Session is managed by db_session fixture
     app.dependency_overrides[get_db] = _override_get_db
+    app.dependency_overrides[get_sessionmaker] = lambda: TestingSessionLocal # Streaming endpoints open their own sessions
     yield
     app.dependency_overrides.pop(get_db, None) # Clean up override
+    app.dependency_overrides.pop(get_sessionmaker, None)
 
 # Async client for making API requests
 @pytest.fixture(scope="function")
@@ -148,6 +167,11 @@ async def test_update_entitlement(client: AsyncClient, db_session: AsyncSession)
     assert data["description"] == "Updated access"
     assert data["user_id"] == ent_data["user_id"] # Unchanged field
 
+    # Key fields can be left out but not cleared
+    response = await client.put(f"/api/v1/entitlements/{ent_id}", json={"user_id": None})
+    assert response.status_code == 422
+    assert response.json()["detail"][0]["loc"] == ["body", "user_id"]
+
 @pytest.mark.asyncio
 async def test_update_entitlement_not_found(client: AsyncClient):
     random_uuid = str(uuid4())
@@ -217,3 +241,831 @@ async def test_read_entitlements_with_filters(client: AsyncClient, db_session: A
     assert response.status_code == 200
     assert data["total"] == 2 # user1/doc/doc1, user1/col/col1
     assert all(item["is_active"] == True for item in data["items"])
+
+@pytest.mark.asyncio
+async def test_check_entitlement(client: AsyncClient, db_session: AsyncSession):
+    await client.post("/api/v1/entitlements/", json={"user_id": "check_user", "resource_type": "doc", "resource_id": "doc1", "access_level": "read"})
+    await client.post("/api/v1/entitlements/", json={"user_id": "check_user", "resource_type": "doc", "resource_id": "doc2", "access_level": "read", "is_active": False})
+    await client.post("/api/v1/entitlements/", json={"user_id": "check_user", "resource_type": "doc", "resource_id": "doc3", "access_level": "read", "expires_at": "2000-01-01T00:00:00Z"})
+
+    response = await client.get("/api/v1/entitlements/check", params={"user_id": "check_user", "resource_type": "doc", "resource_id": "doc1"})
+    assert response.status_code == 200
+    data = response.json()
+    assert data["allowed"] == True
+    assert data["access_level"] == "read"
+
+    for resource_id in ["doc2", "doc3", "missing"]: # Inactive, expired, no grant at all
+        response = await client.get("/api/v1/entitlements/check", params={"user_id": "check_user", "resource_type": "doc", "resource_id": resource_id})
+        assert response.json()["allowed"] == False
+        assert response.json()["access_level"] is None
+
+@pytest.mark.asyncio
+async def test_check_entitlement_cache_invalidated_by_writes(client: AsyncClient, db_session: AsyncSession):
+    params = {"user_id": "cache_user", "resource_type": "doc", "resource_id": "doc1"}
+    before = (await client.get("/api/v1/entitlements/check/cache")).json()
+    assert (await client.get("/api/v1/entitlements/check", params=params)).json()["allowed"] == False
+
+    create_response = await client.post("/api/v1/entitlements/", json={**params, "access_level": "read"})
+    ent_id = create_response.json()["id"]
+    assert (await client.get("/api/v1/entitlements/check", params=params)).json()["access_level"] == "read"
+    assert (await client.get("/api/v1/entitlements/check", params=params)).json()["access_level"] == "read"
+
+    await client.put(f"/api/v1/entitlements/{ent_id}", json={"access_level": "write"})
+    assert (await client.get("/api/v1/entitlements/check", params=params)).json()["access_level"] == "write"
+
+    await client.delete(f"/api/v1/entitlements/{ent_id}")
+    assert (await client.get("/api/v1/entitlements/check", params=params)).json()["allowed"] == False
+
+    stats = (await client.get("/api/v1/entitlements/check/cache")).json()
+    assert stats["hits"] - before["hits"] == 1
+    assert stats["misses"] - before["misses"] == 4
+    assert stats["invalidations"] - before["invalidations"] >= 3
+
+@pytest.mark.asyncio
+async def test_check_entitlement_wildcard_returns_strongest_level(client: AsyncClient, db_session: AsyncSession):
+    check = {"user_id": "wild_user", "resource_type": "doc", "resource_id": "doc1"}
+    await client.post("/api/v1/entitlements/", json={**check, "access_level": "read"})
+    assert (await client.get("/api/v1/entitlements/check", params=check)).json()["access_level"] == "read"
+
+    # The new wildcard grant must evict the cached exact-match decision
+    await client.post("/api/v1/entitlements/", json={**check, "resource_id": "*", "access_level": "admin"})
+    assert (await client.get("/api/v1/entitlements/check", params=check)).json()["access_level"] == "admin"
+    other = (await client.get("/api/v1/entitlements/check", params={**check, "resource_id": "doc2"})).json()
+    assert other["allowed"] == True and other["access_level"] == "admin"
+    other_type = await client.get("/api/v1/entitlements/check", params={**check, "resource_type": "collection"})
+    assert other_type.json()["allowed"] == False
+
+@pytest.mark.asyncio
+async def test_check_entitlement_through_resource_hierarchy(client: AsyncClient, db_session: AsyncSession):
+    await client.put("/api/v1/resources/doc/doc1/parent", json={"parent_type": "folder", "parent_id": "f1"})
+    response = await client.put("/api/v1/resources/folder/f1/parent", json={"parent_type": "collection", "parent_id": "c1"})
+    assert response.status_code == 200
+    ancestors = (await client.get("/api/v1/resources/doc/doc1/ancestors")).json()
+    assert [(a["ancestor_id"], a["depth"]) for a in ancestors] == [("f1", 1), ("c1", 2)]
+
+    check = {"user_id": "tree_user", "resource_type": "doc", "resource_id": "doc1"}
+    assert (await client.get("/api/v1/entitlements/check", params=check)).json()["allowed"] == False
+    await client.post("/api/v1/entitlements/", json={"user_id": "tree_user", "resource_type": "collection", "resource_id": "c1", "access_level": "write"})
+    await client.post("/api/v1/entitlements/", json={**check, "access_level": "read"})
+    assert (await client.get("/api/v1/entitlements/check", params=check)).json()["access_level"] == "write"
+    batch = await client.post("/api/v1/entitlements/check/batch", json={"items": [check, {**check, "resource_id": "doc9"}]})
+    assert [result["access_level"] for result in batch.json()["results"]] == ["write", None]
+
+    response = await client.put("/api/v1/resources/collection/c1/parent", json={"parent_type": "doc", "parent_id": "doc1"})
+    assert response.status_code == 409
+    response = await client.put("/api/v1/resources/doc/*/parent", json={"parent_type": "folder", "parent_id": "f1"})
+    assert response.status_code == 400
+
+    # Detaching the folder takes the whole subtree out of the collection
+    assert (await client.delete("/api/v1/resources/folder/f1/parent")).status_code == 200
+    assert (await client.get("/api/v1/entitlements/check", params=check)).json()["access_level"] == "read"
+    ancestors = (await client.get("/api/v1/resources/doc/doc1/ancestors")).json()
+    assert [a["ancestor_id"] for a in ancestors] == ["f1"]
+    assert (await client.delete("/api/v1/resources/folder/f1/parent")).status_code == 404
+
+@pytest.mark.asyncio
+async def test_group_grants_apply_to_members(client: AsyncClient, db_session: AsyncSession):
+    assert (await client.post("/api/v1/groups/", json={"group_id": "team_a"})).status_code == 201
+    assert (await client.post("/api/v1/groups/", json={"group_id": "team_a"})).status_code == 409
+    assert (await client.put("/api/v1/groups/team_a/members/alice")).status_code == 200
+    check = {"user_id": "alice", "resource_type": "doc", "resource_id": "doc1"}
+    assert (await client.get("/api/v1/entitlements/check", params=check)).json()["allowed"] == False
+
+    # Granting the group reaches existing members; joining later picks up existing grants
+    grant = {"resource_type": "doc", "resource_id": "doc1", "access_level": "read"}
+    assert (await client.put("/api/v1/groups/team_a/grants", json=grant)).status_code == 200
+    assert (await client.get("/api/v1/entitlements/check", params=check)).json()["access_level"] == "read"
+    await client.put("/api/v1/groups/team_a/members/bob")
+    bob = await client.post("/api/v1/entitlements/check/batch", json={"items": [{**check, "user_id": "bob"}]})
+    assert bob.json()["results"][0]["access_level"] == "read"
+
+    await client.put("/api/v1/groups/team_a/grants", json={**grant, "access_level": "admin"})
+    assert (await client.get("/api/v1/entitlements/check", params=check)).json()["access_level"] == "admin"
+    assert [m["user_id"] for m in (await client.get("/api/v1/groups/team_a/members")).json()] == ["alice", "bob"]
+
+    assert (await client.delete("/api/v1/groups/team_a/members/alice")).status_code == 200
+    assert (await client.get("/api/v1/entitlements/check", params=check)).json()["allowed"] == False
+    assert (await client.delete("/api/v1/groups/team_a/grants/doc/doc1")).status_code == 200
+    assert (await client.get("/api/v1/entitlements/check", params={**check, "user_id": "bob"})).json()["allowed"] == False
+
+    assert (await client.put("/api/v1/groups/missing/members/alice")).status_code == 404
+    assert (await client.delete("/api/v1/groups/team_a")).status_code == 200
+    assert (await client.get("/api/v1/groups/team_a")).status_code == 404
+
+@pytest.mark.asyncio
+async def test_check_entitlements_batch(client: AsyncClient, db_session: AsyncSession):
+    await client.post("/api/v1/entitlements/", json={"user_id": "batch_user", "resource_type": "doc", "resource_id": "doc1", "access_level": "read"})
+    await client.post("/api/v1/entitlements/", json={"user_id": "batch_user", "resource_type": "doc", "resource_id": "doc2", "access_level": "write"})
+    await client.post("/api/v1/entitlements/", json={"user_id": "batch_user", "resource_type": "doc", "resource_id": "doc3", "is_active": False})
+
+    # Warm the cache for one pair so the batch mixes cached and uncached lookups
+    await client.get("/api/v1/entitlements/check", params={"user_id": "batch_user", "resource_type": "doc", "resource_id": "doc2"})
+
+    resource_ids = ["doc3", "doc2", "missing", "doc1", "doc2"]
+    items = [{"user_id": "batch_user", "resource_type": "doc", "resource_id": resource_id} for resource_id in resource_ids]
+    response = await client.post("/api/v1/entitlements/check/batch", json={"items": items})
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [result["resource_id"] for result in results] == resource_ids
+    assert [result["allowed"] for result in results] == [False, True, False, True, True]
+    assert [result["access_level"] for result in results] == [None, "write", None, "read", "write"]
+
+@pytest.mark.asyncio
+async def test_check_entitlements_batch_limits(client: AsyncClient):
+    response = await client.post("/api/v1/entitlements/check/batch", json={"items": []})
+    assert response.status_code == 422
+    items = [{"user_id": "u", "resource_type": "doc", "resource_id": str(i)} for i in range(1001)]
+    response = await client.post("/api/v1/entitlements/check/batch", json={"items": items})
+    assert response.status_code == 422
+
+@pytest.mark.asyncio
+async def test_create_entitlement_duplicate(client: AsyncClient, db_session: AsyncSession):
+    ent_data = {"user_id": "dup_user", "resource_type": "doc", "resource_id": "doc1"}
+    assert (await client.post("/api/v1/entitlements/", json=ent_data)).status_code == 201
+    response = await client.post("/api/v1/entitlements/", json=ent_data)
+    assert response.status_code == 409
+
+@pytest.mark.asyncio
+async def test_bulk_create_entitlements(client: AsyncClient, db_session: AsyncSession):
+    await client.post("/api/v1/entitlements/", json={"user_id": "bulk_user", "resource_type": "doc", "resource_id": "existing"})
+    items = [
+        {"user_id": "bulk_user", "resource_type": "doc", "resource_id": f"doc{i}", "access_level": "read"} for i in range(5)
+    ] + [
+        {"user_id": "bulk_user", "resource_type": "doc", "resource_id": "existing"},
+        {"user_id": "bulk_user", "resource_type": "doc"},
+        {"user_id": "bulk_user", "resource_type": "doc", "resource_id": "doc0"},
+    ]
+    response = await client.post("/api/v1/entitlements/bulk?chunk_size=2", json={"items": items})
+    assert response.status_code == 200
+    data = response.json()
+    assert data["succeeded"] == 5
+    assert data["failed"] == 3
+    assert [result["status"] for result in data["results"]] == ["created"] * 5 + ["conflict", "invalid", "duplicate"]
+    assert all(result["id"] for result in data["results"][:5])
+
+    response = await client.get("/api/v1/entitlements/?user_id=bulk_user")
+    assert response.json()["total"] == 6
+
+@pytest.mark.asyncio
+async def test_bulk_upsert_and_revoke_entitlements(client: AsyncClient, db_session: AsyncSession):
+    await client.post("/api/v1/entitlements/", json={"user_id": "upsert_user", "resource_type": "doc", "resource_id": "doc1", "access_level": "read"})
+    assert (await client.get("/api/v1/entitlements/check", params={"user_id": "upsert_user", "resource_type": "doc", "resource_id": "doc1"})).json()["access_level"] == "read"
+
+    items = [
+        {"user_id": "upsert_user", "resource_type": "doc", "resource_id": "doc1", "access_level": "write"},
+        {"user_id": "upsert_user", "resource_type": "doc", "resource_id": "doc2", "access_level": "read"},
+    ]
+    response = await client.post("/api/v1/entitlements/bulk/upsert", json={"items": items})
+    assert [result["status"] for result in response.json()["results"]] == ["updated", "created"]
+    assert (await client.get("/api/v1/entitlements/check", params={"user_id": "upsert_user", "resource_type": "doc", "resource_id": "doc1"})).json()["access_level"] == "write"
+
+    keys = [
+        {"user_id": "upsert_user", "resource_type": "doc", "resource_id": "doc2"},
+        {"user_id": "upsert_user", "resource_type": "doc", "resource_id": "missing"},
+    ]
+    response = await client.post("/api/v1/entitlements/bulk/revoke", json={"items": keys})
+    data = response.json()
+    assert [result["status"] for result in data["results"]] == ["revoked", "not_found"]
+    assert data["succeeded"] == 1 and data["failed"] == 1
+    response = await client.get("/api/v1/entitlements/?user_id=upsert_user&is_active=false")
+    assert [item["resource_id"] for item in response.json()["items"]] == ["doc2"]
+
+@pytest.mark.asyncio
+async def test_read_entitlements_cursor_pagination(client: AsyncClient, db_session: AsyncSession):
+    items = [{"user_id": "page_user", "resource_type": "doc", "resource_id": f"doc{i}"} for i in range(5)]
+    await client.post("/api/v1/entitlements/bulk", json={"items": items}) # Same created_at, ordered by id
+
+    seen = []
+    params = {"user_id": "page_user", "limit": 2, "count": "none"}
+    while True:
+        data = (await client.get("/api/v1/entitlements/", params=params)).json()
+        assert data["total"] is None
+        seen.extend(item["resource_id"] for item in data["items"])
+        if data["next_cursor"] is None:
+            break
+        params["cursor"] = data["next_cursor"]
+    assert sorted(seen) == [f"doc{i}" for i in range(5)]
+    assert len(seen) == 5
+
+    response = await client.get("/api/v1/entitlements/", params={"cursor": "not-a-cursor"})
+    assert response.status_code == 400
+
+@pytest.mark.asyncio
+async def test_read_entitlements_fast_matches_model_serialization(client: AsyncClient, db_session: AsyncSession):
+    items = [
+        {"user_id": "fast_user", "resource_type": "doc", "resource_id": "doc1", "access_level": "read", "description": "caf\u00e9"},
+        {"user_id": "fast_user", "resource_type": "doc", "resource_id": "doc2", "expires_at": "2099-01-01T00:00:00.000400Z"},
+    ]
+    await client.post("/api/v1/entitlements/bulk", json={"items": items})
+    params = {"user_id": "fast_user", "limit": 1}
+    fast = await client.get("/api/v1/entitlements/", params=params)
+    slow = await client.get("/api/v1/entitlements/", params={**params, "fast": "false"})
+    assert fast.status_code == slow.status_code == 200
+    assert fast.headers["content-type"] == slow.headers["content-type"]
+    assert fast.content == slow.content
+    assert fast.json()["total"] == 2 and fast.json()["next_cursor"] is not None
+
+@pytest.mark.asyncio
+async def test_read_entitlements_count_modes(client: AsyncClient, db_session: AsyncSession):
+    await client.post("/api/v1/entitlements/", json={"user_id": "count_user", "resource_type": "doc", "resource_id": "doc1"})
+    response = await client.get("/api/v1/entitlements/", params={"user_id": "count_user", "count": "estimate"})
+    assert response.status_code == 200
+    assert isinstance(response.json()["total"], int)
+    response = await client.get("/api/v1/entitlements/", params={"count": "bogus"})
+    assert response.status_code == 422
+
+@pytest.mark.asyncio
+async def test_export_entitlements(client: AsyncClient, db_session: AsyncSession):
+    items = [{"user_id": "export_user", "resource_type": "doc", "resource_id": f"doc{i}", "access_level": "read"} for i in range(3)]
+    items.append({"user_id": "other_user", "resource_type": "doc", "resource_id": "doc0", "description": "has, a comma"})
+    await client.post("/api/v1/entitlements/bulk", json={"items": items})
+
+    response = await client.get("/api/v1/entitlements/export", params={"user_id": "export_user"})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert sorted(row["resource_id"] for row in rows) == ["doc0", "doc1", "doc2"]
+    assert all(row["user_id"] == "export_user" and row["is_active"] == True for row in rows)
+
+    response = await client.get("/api/v1/entitlements/export", params={"format": "csv"})
+    assert response.status_code == 200
+    rows = list(csv.DictReader(io.StringIO(response.text)))
+    assert len(rows) == 4
+    assert [row["description"] for row in rows if row["user_id"] == "other_user"] == ["has, a comma"]
+
+    response = await client.get("/api/v1/entitlements/export", params={"format": "csv", "user_id": "nobody"})
+    assert response.text.strip() == ",".join(crud.EXPORT_COLUMNS)
+
+@pytest.mark.asyncio
+async def test_import_entitlements_ndjson(client: AsyncClient, db_session: AsyncSession, monkeypatch):
+    await client.post("/api/v1/entitlements/", json={"user_id": "import_user", "resource_type": "doc", "resource_id": "doc0", "access_level": "read"})
+    lines = [
+        json.dumps({"user_id": "import_user", "resource_type": "doc", "resource_id": "doc0", "access_level": "write"}),
+        json.dumps({"user_id": "import_user", "resource_type": "doc", "resource_id": "doc1"}),
+        "{not json",
+        "",
+        json.dumps({"user_id": "import_user", "resource_type": "doc"}),
+        json.dumps({"user_id": "import_user", "resource_type": "doc", "resource_id": "doc2", "expires_at": "2999-01-01T00:00:00Z"}),
+    ]
+    response = await client.post("/api/v1/entitlements/import?batch_size=2", content="\n".join(lines).encode())
+    assert response.status_code == 200
+    report = response.json()
+    assert report["processed"] == 5
+    assert report["inserted"] == 2
+    assert report["updated"] == 1
+    assert report["rejected"] == 2
+    assert [error["line"] for error in report["errors"]] == [3, 5]
+
+    response = await client.get("/api/v1/entitlements/check", params={"user_id": "import_user", "resource_type": "doc", "resource_id": "doc0"})
+    assert response.json()["access_level"] == "write"
+
+    # A NUL is rejected as a bad row; a driver error from the COPY only loses its batch
+    import_batch = crud.import_entitlements_batch
+    failures = iter([asyncpg.exceptions.CharacterNotInRepertoireError("invalid byte sequence")])
+
+    async def failing_batch(db, batch, mode):
+        for exc in failures:
+            raise exc
+        return await import_batch(db, batch, mode=mode)
+
+    monkeypatch.setattr(crud, "import_entitlements_batch", failing_batch)
+    lines = [json.dumps({"user_id": "import_user", "resource_type": "doc", "resource_id": f"doc{n}"}) for n in (3, 4, 5)]
+    lines.insert(1, json.dumps({"user_id": "import_user", "resource_type": "doc", "resource_id": "nul\u0000"}))
+    report = (await client.post("/api/v1/entitlements/import?batch_size=2", content="\n".join(lines).encode())).json()
+    assert (report["inserted"], report["rejected"]) == (1, 3)
+    assert report["errors"][0] == {"line": 2, "error": "resource_id: NUL characters are not allowed"}
+    assert [error["line"] for error in report["errors"][1:]] == [1, 3] and "invalid byte sequence" in report["errors"][1]["error"]
+
+@pytest.mark.asyncio
+async def test_import_entitlements_csv(client: AsyncClient, db_session: AsyncSession):
+    body = (
+        "user_id,resource_type,resource_id,access_level,is_active,description\n"
+        "csv_user,doc,doc1,read,true,\"multi\nline, description\"\n"
+        "csv_user,doc,doc2,,false,\n"
+        "csv_user,doc,doc2,write,,\n"
+        "csv_user,doc\n"
+    )
+    response = await client.post("/api/v1/entitlements/import?format=csv&mode=insert", content=body.encode())
+    assert response.status_code == 200
+    report = response.json()
+    assert (report["processed"], report["inserted"], report["skipped"], report["rejected"]) == (4, 2, 1, 1)
+    assert report["errors"][0]["line"] == 6 # Physical line; the quoted description spans two
+
+    data = (await client.get("/api/v1/entitlements/", params={"user_id": "csv_user"})).json()
+    by_resource = {item["resource_id"]: item for item in data["items"]}
+    assert by_resource["doc1"]["description"] == "multi\nline, description"
+    assert by_resource["doc2"]["access_level"] == "write" # Last row for a key wins
+    assert by_resource["doc2"]["is_active"] == True
+
+    response = await client.post("/api/v1/entitlements/import?format=csv", content=b"user_id,resource_type\nu,doc\n")
+    assert response.status_code == 400
+
+@pytest.mark.asyncio
+async def test_update_entitlement_if_match(client: AsyncClient, db_session: AsyncSession):
+    create_response = await client.post("/api/v1/entitlements/", json={"user_id": "etag_user", "resource_type": "doc", "resource_id": "doc1", "access_level": "read"})
+    ent_id = create_response.json()["id"]
+    etag = create_response.headers["etag"]
+    assert etag == '"1"'
+    assert (await client.get(f"/api/v1/entitlements/{ent_id}")).headers["etag"] == etag
+
+    response = await client.put(f"/api/v1/entitlements/{ent_id}", json={"access_level": "write"}, headers={"If-Match": etag})
+    assert response.status_code == 200
+    assert response.json()["version"] == 2
+    new_etag = response.headers["etag"]
+
+    # A second writer still holding the first ETag is rejected
+    response = await client.put(f"/api/v1/entitlements/{ent_id}", json={"access_level": "admin"}, headers={"If-Match": etag})
+    assert response.status_code == 412
+    response = await client.delete(f"/api/v1/entitlements/{ent_id}", headers={"If-Match": etag})
+    assert response.status_code == 412
+    assert (await client.get(f"/api/v1/entitlements/{ent_id}")).json()["access_level"] == "write"
+
+    response = await client.delete(f"/api/v1/entitlements/{ent_id}", headers={"If-Match": new_etag})
+    assert response.status_code == 200
+    response = await client.put(f"/api/v1/entitlements/{ent_id}", json={"access_level": "admin"}, headers={"If-Match": new_etag})
+    assert response.status_code == 404
+
+@pytest.mark.asyncio
+async def test_update_entitlement_key_invalidates_old_decision(client: AsyncClient, db_session: AsyncSession):
+    params = {"user_id": "move_user", "resource_type": "doc", "resource_id": "doc1"}
+    create_response = await client.post("/api/v1/entitlements/", json=params)
+    assert (await client.get("/api/v1/entitlements/check", params=params)).json()["allowed"] == True
+    await client.put(f"/api/v1/entitlements/{create_response.json()['id']}", json={"resource_id": "doc2"})
+    assert (await client.get("/api/v1/entitlements/check", params=params)).json()["allowed"] == False
+
+@pytest.mark.asyncio
+async def test_pool_health(client: AsyncClient):
+    response = await client.get("/health/pool")
+    assert response.status_code == 200
+    data = response.json()
+    for key in ["size", "checked_out", "overflow", "wait_seconds_avg", "wait_seconds_max", "timeouts"]:
+        assert key in data
+
+@pytest.mark.asyncio
+async def test_read_replica_routing_and_read_your_writes(client: AsyncClient, db_session: AsyncSession, monkeypatch):
+    # The test database stands in as a replica, behind one that refuses connections
+    replica_set = replicas.ReplicaSet(["postgresql+asyncpg://postgres:x@127.0.0.1:1/missing", TEST_DATABASE_URL], primary=TestingSessionLocal)
+    monkeypatch.setattr(replicas, "_replica_set", replica_set)
+    try:
+        create_response = await client.post("/api/v1/entitlements/", json={"user_id": "replica_user", "resource_type": "doc", "resource_id": "doc1"})
+        lsn = create_response.headers["X-Write-LSN"]
+        ent_id = create_response.json()["id"]
+        # Read-only POSTs and writes that changed nothing skip the primary round trip
+        response = await client.post("/api/v1/entitlements/check/batch", json={"items": [{"user_id": "replica_user", "resource_type": "doc", "resource_id": "doc1"}]})
+        assert response.status_code == 200 and "X-Write-LSN" not in response.headers
+        response = await client.post("/api/v1/entitlements/bulk/revoke", json={"items": [{"user_id": "nobody", "resource_type": "doc", "resource_id": "doc1"}]})
+        assert response.status_code == 200 and "X-Write-LSN" not in response.headers
+
+        for _ in range(2): # Round-robin reaches the dead replica, which gets ejected and skipped
+            response = await client.get(f"/api/v1/entitlements/{ent_id}")
+            assert response.status_code == 200
+            assert response.headers["X-Read-Source"] == "replica-2"
+        response = await client.get("/api/v1/entitlements/", params={"user_id": "replica_user"}, headers={"X-Min-LSN": lsn})
+        assert response.headers["X-Read-Source"] == "replica-2"
+        assert response.json()["total"] == 1
+
+        # No replica has replayed this far yet, so the primary serves the read
+        response = await client.get(f"/api/v1/entitlements/{ent_id}", headers={"X-Min-LSN": "FFFFFFFF/FFFFFFFF"})
+        assert response.status_code == 200
+        assert response.headers["X-Read-Source"] == "primary"
+        assert (await client.get(f"/api/v1/entitlements/{ent_id}", headers={"X-Min-LSN": "bogus"})).status_code == 400
+
+        stats = (await client.get("/health/replicas")).json()
+        assert stats["healthy"] == 1 and stats["ejections"] == 1
+        assert stats["lagging"] >= 1 and stats["primary_reads"] == 1
+    finally:
+        await replica_set.dispose()
+
+@pytest.mark.asyncio
+async def test_partitioning_migration(client: AsyncClient, db_session: AsyncSession):
+    ids = {}
+    for user in ("part_a", "part_b", "part_c"):
+        for doc in range(3):
+            response = await client.post("/api/v1/entitlements/", json={"user_id": user, "resource_type": "doc", "resource_id": f"doc{doc}"})
+            ids[user, doc] = response.json()["id"]
+
+    try:
+        assert await partitioning.create_partitioned_table(engine, "user_id", hash_partitions=4)
+        await partitioning.copy_rows(engine, batch_size=4)
+        # Writes during the copy are picked up by the swap
+        await client.put(f"/api/v1/entitlements/{ids['part_a', 0]}", json={"access_level": "admin"})
+        await client.delete(f"/api/v1/entitlements/{ids['part_b', 0]}")
+        await client.post("/api/v1/entitlements/", json={"user_id": "part_c", "resource_type": "doc", "resource_id": "late"})
+        await db_session.commit() # The renames wait for open transactions on the table
+        assert await partitioning.swap_tables(engine) == {"deleted": 2, "inserted": 2}
+
+        async with engine.connect() as conn:
+            assert (await conn.execute(text("SELECT count(*) FROM entitlements"))).scalar_one() == 9
+            assert (await conn.execute(text("SELECT count(*) FROM pg_inherits WHERE inhparent = 'entitlements'::regclass"))).scalar_one() == 4
+            plan = "\n".join((await conn.execute(text("EXPLAIN SELECT * FROM entitlements WHERE user_id = 'part_a'"))).scalars())
+            assert len(set(re.findall(r" on (entitlements_p\d+)\b", plan))) == 1, plan # Pruned to a single partition
+
+        assert (await client.get(f"/api/v1/entitlements/{ids['part_a', 0]}")).json()["access_level"] == "admin"
+        response = await client.post("/api/v1/entitlements/bulk/upsert", json={"items": [
+            {"user_id": "part_a", "resource_type": "doc", "resource_id": "doc1", "access_level": "write"},
+            {"user_id": "part_a", "resource_type": "doc", "resource_id": "doc9"},
+        ]})
+        assert [item["status"] for item in response.json()["results"]] == ["updated", "created"]
+    finally:
+        async with engine.begin() as conn:
+            await conn.execute(text(f"DROP TABLE IF EXISTS {partitioning.RETIRED}, {partitioning.TARGET}"))
+
+@pytest.mark.asyncio
+async def test_singleflight_coalesces_errors_and_timeouts():
+    flights = SingleFlight(timeout=1)
+    calls = []
+
+    async def lookup(value):
+        calls.append(value)
+        await asyncio.sleep(0.05)
+        if value == "boom":
+            raise ValueError(value)
+        return value
+
+    assert await asyncio.gather(*[flights.do("a", lambda: lookup("a")) for _ in range(10)]) == ["a"] * 10
+    assert calls == ["a"] and flights.stats()["coalesced"] == 9
+
+    results = await asyncio.gather(*[flights.do("b", lambda: lookup("boom")) for _ in range(3)], return_exceptions=True)
+    assert all(isinstance(result, ValueError) for result in results) and calls.count("boom") == 1
+
+    results = await asyncio.gather(*[flights.do("c", lambda: asyncio.sleep(1), timeout=0.01) for _ in range(3)], return_exceptions=True)
+    assert all(isinstance(result, SingleFlightTimeout) for result in results)
+
+    # A cancelled leader hands over to a follower instead of failing it
+    leader = asyncio.create_task(flights.do("d", lambda: lookup("d")))
+    await asyncio.sleep(0)
+    follower = asyncio.create_task(flights.do("d", lambda: lookup("d")))
+    await asyncio.sleep(0)
+    leader.cancel()
+    assert await follower == "d" and calls.count("d") == 2
+    assert flights.stats()["in_flight"] == 0
+
+@pytest.mark.asyncio
+async def test_concurrent_reads_share_one_query(client: AsyncClient, db_session: AsyncSession):
+    created = (await client.post("/api/v1/entitlements/", json={"user_id": "storm_user", "resource_type": "doc", "resource_id": "doc1"})).json()
+    before = singleflight.stats()
+    # All requests share the test session, which would reject concurrent queries
+    responses = await asyncio.gather(*[client.get(f"/api/v1/entitlements/{created['id']}") for _ in range(20)])
+    assert all(response.status_code == 200 and response.json()["id"] == created["id"] for response in responses)
+    stats = singleflight.stats()
+    assert stats["leaders"] - before["leaders"] == 1
+    assert stats["coalesced"] - before["coalesced"] == 19
+    assert (await client.get("/health/singleflight")).json()["in_flight"] == 0
+
+@pytest.mark.asyncio
+async def test_coalesced_reads_stay_per_database_and_session(client: AsyncClient, db_session: AsyncSession):
+    created = (await client.post("/api/v1/entitlements/", json={"user_id": "ana", "resource_type": "doc", "resource_id": "d1"})).json()
+    other_engine = create_async_engine(TEST_DATABASE_URL)
+    sessions = [TestingSessionLocal(), TestingSessionLocal(), AsyncSession(other_engine), TestingSessionLocal()]
+    sessions[3].info[SKIP_COALESCING] = True
+    try:
+        before = singleflight.stats()
+        grants = await asyncio.gather(*(crud.get_entitlement(session, UUID(created["id"])) for session in sessions))
+        stats = singleflight.stats()
+        # The second session joins the first one's flight; another database and a pinned session run their own
+        assert stats["leaders"] - before["leaders"] == 2 and stats["coalesced"] - before["coalesced"] == 1
+        assert all(sqlalchemy_inspect(grant).session is session.sync_session for grant, session in zip(grants, sessions))
+        assert all(grant.is_active for grant in grants)
+    finally:
+        for session in sessions:
+            await session.close()
+        await other_engine.dispose()
+
+@pytest.mark.asyncio
+async def test_local_index_snapshot_and_changes(client: AsyncClient, db_session: AsyncSession):
+    api = "/api/v1/entitlements"
+    created = (await client.post(f"{api}/", json={"user_id": "ana", "resource_type": "doc", "resource_id": "d1", "access_level": "read"})).json()
+    await client.post(f"{api}/", json={"user_id": "ana", "resource_type": "folder", "resource_id": "*", "access_level": "write"})
+    await client.post(f"{api}/", json={"user_id": "ben", "resource_type": "doc", "resource_id": "d2", "access_level": "admin"})
+    await client.put("/api/v1/resources/doc/d3/parent", json={"parent_type": "folder", "parent_id": "f1"})
+    await client.post("/api/v1/groups/", json={"group_id": "crew"})
+    await client.put("/api/v1/groups/crew/members/cat")
+    await client.put("/api/v1/groups/crew/grants", json={"resource_type": "doc", "resource_id": "d1", "access_level": "write"})
+
+    keys = [(user, "doc", doc) for user in ("ana", "ben", "cat") for doc in ("d1", "d2", "d3")]
+
+    async def assert_matches_server(index):
+        decision_cache.clear()
+        for user, resource_type, resource_id in keys:
+            expected = (await client.get(f"{api}/check", params={"user_id": user, "resource_type": resource_type, "resource_id": resource_id})).json()
+            assert tuple(index.check(user, resource_type, resource_id)) == (expected["allowed"], expected["access_level"]), (user, resource_id)
+
+    index = LocalIndex()
+    response = await client.get(f"{api}/snapshot")
+    index.load_snapshot(response.text.splitlines())
+    snapshot_seq = index.seq
+
+    async def transactions_upto(seq):
+        # Change log positions are transaction ids; count the writes recorded up to seq
+        return (await db_session.execute(text("SELECT count(DISTINCT seq) FROM entitlement_changes WHERE seq <= :seq"), {"seq": seq})).scalar()
+
+    assert await transactions_upto(snapshot_seq) == 5 # Writes that change no decision, like adding a member to a group without grants, record nothing
+    assert index.check("ana", "doc", "d3").access_level == "write" # Folder wildcard through the hierarchy
+    await assert_matches_server(index)
+
+    await client.put(f"{api}/{created['id']}", json={"access_level": "admin"})
+    await client.delete("/api/v1/groups/crew/members/cat")
+    await client.put("/api/v1/resources/doc/d2/parent", json={"parent_type": "folder", "parent_id": "f1"})
+    await client.post(f"{api}/bulk/revoke", json={"items": [{"user_id": "ben", "resource_type": "doc", "resource_id": "d2"}]})
+    while True:
+        page = (await client.get(f"{api}/changes", params={"since": index.seq, "limit": 1})).json()
+        index.apply_changes(page)
+        if not page["more"]:
+            break
+    assert await transactions_upto(index.seq) == 9
+    await assert_matches_server(index)
+
+    filtered = (await client.get(f"{api}/changes", params={"since": snapshot_seq, "resource_type": "folder"})).json()
+    assert filtered["keys"] == [] and filtered["seq"] == index.seq
+
+    # A write still running holds the position back: it could commit below later ones
+    async with TestingSessionLocal() as writer:
+        await crud._record_changes(writer, [("zed", "doc", "d1")])
+        await client.post(f"{api}/", json={"user_id": "yan", "resource_type": "doc", "resource_id": "d1"})
+        page = (await client.get(f"{api}/changes", params={"since": index.seq})).json()
+        assert page["keys"] == [] and page["seq"] == index.seq
+        await writer.commit()
+    page = (await client.get(f"{api}/changes", params={"since": index.seq})).json()
+    assert sorted(page["keys"]) == [["yan", "doc", "d1"], ["zed", "doc", "d1"]]
+    index.apply_changes(page)
+
+    assert await crud.prune_changes(db_session, datetime.now(timezone.utc) + timedelta(seconds=1)) > 0
+    assert (await client.get(f"{api}/changes", params={"since": snapshot_seq})).status_code == 410
+    assert (await client.get(f"{api}/changes", params={"since": index.seq})).json()["keys"] == []
+
+@pytest.mark.asyncio
+async def test_expired_grants_read_as_inactive_and_are_swept(client: AsyncClient, db_session: AsyncSession):
+    api = "/api/v1/entitlements"
+    past = (datetime.now(timezone.utc) - timedelta(minutes=5)).isoformat()
+    future = (datetime.now(timezone.utc) + timedelta(days=1)).isoformat()
+    expired = (await client.post(f"{api}/", json={"user_id": "ana", "resource_type": "doc", "resource_id": "d1", "expires_at": past})).json()
+    await client.post(f"{api}/", json={"user_id": "ana", "resource_type": "doc", "resource_id": "d2", "expires_at": future})
+    await client.post(f"{api}/", json={"user_id": "ana", "resource_type": "doc", "resource_id": "d3"})
+    await client.post("/api/v1/groups/", json={"group_id": "crew"})
+    await client.put("/api/v1/groups/crew/members/ben")
+    await client.put("/api/v1/groups/crew/grants", json={"resource_type": "doc", "resource_id": "d1", "expires_at": past})
+
+    assert (await client.get(f"{api}/{expired['id']}")).json()["is_active"] is False
+    for fast in ("true", "false"):
+        active = (await client.get(f"{api}/", params={"is_active": "true", "count": "exact", "fast": fast})).json()
+        assert sorted(item["resource_id"] for item in active["items"]) == ["d2", "d3"] and active["total"] == 2
+        inactive = (await client.get(f"{api}/", params={"is_active": "false", "fast": fast})).json()["items"]
+        assert [(item["resource_id"], item["is_active"]) for item in inactive] == [("d1", False)]
+    exported = [json.loads(line) for line in (await client.get(f"{api}/export")).text.splitlines()]
+    assert {row["resource_id"]: row["is_active"] for row in exported} == {"d1": False, "d2": True, "d3": True}
+    assert (await client.get("/api/v1/groups/crew/grants")).json()[0]["is_active"] is False
+
+    sweeper = ExpirySweeper(session_factory=TestingSessionLocal, batch_size=2, pause=0)
+    head, _ = await crud._change_head(db_session)
+    assert await sweeper.sweep() == 3 # The entitlement, the group grant and ben's expansion row
+    assert sweeper.stats()["batches"] == 1 # One row per table fills no table's batch of 2, so none follows
+    assert await sweeper.sweep() == 0
+    await db_session.rollback()
+    stored = (await db_session.execute(text("SELECT is_active, version FROM entitlements WHERE resource_id = 'd1'"))).one()
+    assert tuple(stored) == (False, 2)
+    swept = (await db_session.execute(text("SELECT count(DISTINCT seq) FROM entitlement_changes WHERE seq > :head"), {"head": head})).scalar()
+    assert swept == 1 # One transaction recorded the changes of every table
+    changes = (await client.get(f"{api}/changes", params={"since": head})).json()
+    assert sorted(changes["keys"]) == [["ana", "doc", "d1"], ["ben", "doc", "d1"]] and changes["grants"] == []
+
+    # A table that fills its batch gets another, even when the other tables are empty
+    for resource_id in ("d4", "d5"):
+        await client.post(f"{api}/", json={"user_id": "ana", "resource_type": "doc", "resource_id": resource_id, "expires_at": past})
+    batches = sweeper.stats()["batches"]
+    assert await sweeper.sweep() == 2
+    assert sweeper.stats()["batches"] == batches + 2
+
+@pytest.mark.asyncio
+async def test_audit_trail_is_written_in_batches(client: AsyncClient, db_session: AsyncSession, monkeypatch):
+    writer = AuditWriter(session_factory=TestingSessionLocal, batch_size=2, flush_interval=60)
+    monkeypatch.setattr(crud, "audit_log", writer)
+    api = "/api/v1/entitlements"
+    created = (await client.post(f"{api}/", json={"user_id": "ana", "resource_type": "doc", "resource_id": "d1", "access_level": "read", "granted_by": "root"})).json()
+    await client.put(f"{api}/{created['id']}", json={"access_level": "write", "granted_by": "lead"})
+    await client.post(f"{api}/bulk/revoke", json={"items": [{"user_id": "ana", "resource_type": "doc", "resource_id": "d1"}]})
+    await client.post(f"{api}/bulk/upsert", json={"items": [
+        {"user_id": "ana", "resource_type": "doc", "resource_id": "d1", "access_level": "admin", "granted_by": "root"},
+        {"user_id": "ben", "resource_type": "doc", "resource_id": "d1"},
+    ]})
+    await client.delete(f"{api}/{created['id']}")
+    assert writer.stats()["queued"] == 6
+    assert (await db_session.execute(text("SELECT count(*) FROM entitlement_audit"))).scalar_one() == 0 # Nothing written on the write path
+
+    writer.start()
+    await writer.stop() # Drains the queue
+    assert writer.stats() | {"running": False} == {"running": False, "queued": 0, "written": 6, "batches": 3, "dropped": 0, "errors": 0}
+
+    events = [json.loads(line) for line in (await client.get(f"{api}/history", params={"user_id": "ana"})).text.splitlines()]
+    assert [(event["action"], event["actor"]) for event in events] == [
+        ("create", "root"), ("update", "lead"), ("revoke", "lead"), ("update", "root"), ("delete", "root"),
+    ]
+    create, update, revoke, upsert, delete = events
+    assert create["before"] is None and create["after"]["access_level"] == "read"
+    assert (update["before"]["access_level"], update["after"]["access_level"]) == ("read", "write")
+    assert (revoke["before"]["is_active"], revoke["after"]["is_active"]) == (True, False)
+    assert (upsert["before"]["is_active"], upsert["after"]["is_active"], upsert["after"]["version"]) == (False, True, 4)
+    assert delete["after"] is None and delete["before"]["id"] == created["id"] == delete["entitlement_id"]
+
+    by_resource = (await client.get(f"{api}/history", params={"resource_type": "doc", "resource_id": "d1", "since": update["occurred_at"]})).text.splitlines()
+    assert [json.loads(line)["action"] for line in by_resource] == ["update", "revoke", "update", "create", "delete"]
+    assert (await client.get(f"{api}/history", params={"resource_type": "doc"})).status_code == 422
+
+    full = AuditWriter(session_factory=TestingSessionLocal, queue_size=1)
+    for _ in range(2):
+        full.record("create", after=create["after"])
+    assert full.stats()["dropped"] == 1
+
+@pytest.mark.asyncio
+async def test_counters_follow_every_write_path(client: AsyncClient, db_session: AsyncSession):
+    api = "/api/v1/entitlements"
+    past = (datetime.now(timezone.utc) - timedelta(minutes=5)).isoformat()
+    created = (await client.post(f"{api}/", json={"user_id": "ana", "resource_type": "doc", "resource_id": "d1", "access_level": "read"})).json()
+    await client.put(f"{api}/{created['id']}", json={"access_level": "write"})
+    await client.post(f"{api}/bulk", json={"items": [
+        {"user_id": "ana", "resource_type": "doc", "resource_id": "d2"},
+        {"user_id": "ben", "resource_type": "folder", "resource_id": "f1", "access_level": "admin"},
+        {"user_id": "ben", "resource_type": "doc", "resource_id": "d9", "expires_at": past},
+    ]})
+    await client.post(f"{api}/bulk/revoke", json={"items": [{"user_id": "ana", "resource_type": "doc", "resource_id": "d2"}]})
+    await client.post(f"{api}/bulk/upsert", json={"items": [
+        {"user_id": "ana", "resource_type": "doc", "resource_id": "d2", "access_level": "admin"},
+        {"user_id": "cy", "resource_type": "doc", "resource_id": "d1"},
+    ]})
+    lines = [
+        json.dumps({"user_id": "cy", "resource_type": "doc", "resource_id": "d1", "is_active": False}),
+        json.dumps({"user_id": "cy", "resource_type": "folder", "resource_id": "f1"}),
+    ]
+    await client.post(f"{api}/import", content="\n".join(lines).encode())
+    await client.delete(f"{api}/{created['id']}")
+    await ExpirySweeper(session_factory=TestingSessionLocal, pause=0).sweep()
+
+    stats = (await client.get(f"{api}/stats", params={"group_by": ["resource_type", "is_active"]})).json()
+    assert stats == {"total": 5, "groups": [
+        {"resource_type": "doc", "is_active": False, "count": 2},
+        {"resource_type": "doc", "is_active": True, "count": 1},
+        {"resource_type": "folder", "is_active": True, "count": 2},
+    ]}
+    by_level = (await client.get(f"{api}/stats", params={"group_by": "access_level"})).json()["groups"]
+    assert by_level == [{"access_level": None, "count": 3}, {"access_level": "admin", "count": 2}]
+    assert (await client.get(f"{api}/stats")).json() == {"total": 5, "groups": [{"count": 5}]}
+    assert (await client.get(f"{api}/stats", params={"group_by": "user_id"})).status_code == 422
+    assert await crud.counter_drift(db_session) == []
+
+    await db_session.execute(text("DELETE FROM entitlements WHERE resource_type = 'folder' AND user_id = 'cy'"))
+    await db_session.commit()
+    assert await crud.counter_drift(db_session) == [
+        {"resource_type": "folder", "access_level": None, "is_active": True, "counted": 1, "actual": 0},
+    ]
+    assert await crud.rebuild_counters(db_session) == 3
+    assert await crud.counter_drift(db_session) == []
+    assert (await client.get(f"{api}/stats")).json()["total"] == 4
+
+@pytest.mark.asyncio
+async def test_duplicate_entitlements_are_merged(db_session: AsyncSession):
+    # Rows written before uq_entitlements_user_resource existed
+    await db_session.execute(text("ALTER TABLE entitlements DROP CONSTRAINT uq_entitlements_user_resource"))
+    await db_session.execute(text("""
+        INSERT INTO entitlements (id, user_id, resource_type, resource_id, access_level, is_active, expires_at, version) VALUES
+            (gen_random_uuid(), 'ana', 'doc', 'd1', 'admin', false, NULL, 1),
+            (gen_random_uuid(), 'ana', 'doc', 'd1', 'read', true, NULL, 1),
+            (gen_random_uuid(), 'ana', 'doc', 'd1', 'write', true, NULL, 1),
+            (gen_random_uuid(), 'ana', 'doc', 'd1', 'admin', true, now() - interval '1 day', 1),
+            (gen_random_uuid(), 'ben', 'doc', 'd1', 'read', true, NULL, 1)
+    """))
+    await db_session.commit()
+    await crud.rebuild_counters(db_session)
+
+    assert await crud.duplicate_entitlement_keys(db_session) == [{"user_id": "ana", "resource_type": "doc", "resource_id": "d1", "rows": 4}]
+    await db_session.commit()
+    async with engine.begin() as conn:
+        with pytest.raises(migrations.DuplicateKeysError, match=r"uq_entitlements_user_resource: 1 keys .*\"rows\": 4.*duplicates --merge"):
+            await migrations._upgrade_tables(conn)
+    deleted = await crud.merge_duplicate_entitlements(db_session)
+    assert sorted((row["access_level"], row["is_active"]) for row in deleted) == [("admin", False), ("admin", True), ("read", True)]
+    kept = (await db_session.execute(text("SELECT user_id, access_level FROM entitlements ORDER BY user_id"))).all()
+    assert [tuple(row) for row in kept] == [("ana", "write"), ("ben", "read")]
+    assert await crud.duplicate_entitlement_keys(db_session) == []
+    await db_session.commit() # counter_drift starts its own snapshot
+    assert await crud.counter_drift(db_session) == []
+
+@pytest.mark.asyncio
+async def test_copied_and_granted_by_deleted_entitlements_are_counted(db_session: AsyncSession):
+    rows = [
+        {"id": uuid4(), "user_id": user_id, "resource_type": "doc", "resource_id": "d1", "access_level": "read", "is_active": True, "granted_by": grantor}
+        for user_id, grantor in [("ana", "seed"), ("ben", "seed"), ("cara", "run")]
+    ]
+    assert await crud.copy_entitlements(db_session, rows) == 3
+    assert await crud.copy_entitlements(db_session, []) == 0
+    assert await crud.delete_entitlements_granted_by(db_session, "seed") == 2
+    changes = (await db_session.execute(text("SELECT user_id FROM entitlement_changes ORDER BY id"))).scalars().all()
+    assert changes == ["ana", "ben", "cara", "ana", "ben"]
+    await db_session.commit()
+    assert await crud.counter_drift(db_session) == []
+    assert await crud.get_entitlement_stats(db_session) == (1, [{"count": 1}])
+
+@pytest.mark.asyncio
+async def test_migrations_build_the_schema_of_the_models(db_session: AsyncSession):
+    # The migrations' fixed DDL must end where the models do; a model change needs a migration
+    async def schema():
+        async with engine.connect() as conn:
+            columns = (await conn.execute(text(
+                "SELECT table_name, column_name, data_type, is_nullable, column_default FROM information_schema.columns "
+                "WHERE table_schema = 'public' ORDER BY 1, 2"
+            ))).all()
+            indexes = (await conn.execute(text("SELECT indexdef FROM pg_indexes WHERE schemaname = 'public' ORDER BY indexname"))).all()
+            constraints = (await conn.execute(text(
+                "SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid) FROM pg_constraint "
+                "WHERE connamespace = 'public'::regnamespace ORDER BY 1, 2"
+            ))).all()
+        return [tuple(row) for row in columns], [tuple(row) for row in indexes], [tuple(row) for row in constraints]
+
+    await db_session.close()
+    expected = await schema()
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+    assert await migrations.migrate(engine) == [migration.version for migration in migrations.MIGRATIONS]
+    assert await schema() == expected
+
+@pytest.mark.asyncio
+async def test_migrations_run_once_across_concurrent_workers(db_session: AsyncSession):
+    # Tables made by create_all, as by releases before migrations: every version is pending
+    await db_session.execute(text("INSERT INTO entitlements (id, user_id, resource_type, resource_id, is_active) VALUES (gen_random_uuid(), 'ana', 'doc', 'd1', true)"))
+    await db_session.execute(text("CREATE INDEX ix_entitlements_user_id ON entitlements (user_id)")) # As made by the first releases
+    await db_session.commit()
+    with pytest.raises(migrations.SchemaVersionError):
+        await migrations.prepare_schema(engine, "check")
+
+    every = [migration.version for migration in migrations.MIGRATIONS]
+    applied = await asyncio.gather(*(migrations.migrate(engine) for _ in range(4)))
+    assert sorted(applied) == [[], [], [], every]
+    assert await migrations.check_schema(engine) == migrations.LATEST_VERSION
+    assert await migrations.migrate(engine) == []
+    versions = (await db_session.execute(text("SELECT version FROM schema_version ORDER BY version"))).scalars().all()
+    assert versions == every
+    assert await crud.get_entitlement_stats(db_session) == (1, [{"count": 1}])
+    assert not await migrations._relation_exists(await db_session.connection(), "ix_entitlements_user_id")
+
+    # Importing the app neither needs database settings nor creates an engine
+    env = {key: value for key, value in os.environ.items() if not key.startswith(("POSTGRES_", "DB_", "DATABASE_"))}
+    code = "import app.main, app.database as database, app.replicas as replicas; assert database._engine is None and replicas._replica_set is None"
+    assert subprocess.run([sys.executable, "-c", code], env=env, cwd=os.path.dirname(os.path.dirname(__file__))).returncode == 0
+
+@pytest.mark.asyncio
+async def test_reverse_lookups(client: AsyncClient, db_session: AsyncSession, monkeypatch):
+    api = "/api/v1/entitlements"
+    await client.put("/api/v1/resources/doc/d1/parent", json={"parent_type": "folder", "parent_id": "f1"})
+    for grant in [
+        {"user_id": "ana", "resource_type": "doc", "resource_id": "d1", "access_level": "read"},
+        {"user_id": "ben", "resource_type": "folder", "resource_id": "f1", "access_level": "write"},
+        {"user_id": "cara", "resource_type": "doc", "resource_id": "*", "access_level": "read"},
+        {"user_id": "dan", "resource_type": "doc", "resource_id": "d2", "is_active": False},
+    ]:
+        await client.post(f"{api}/", json=grant)
+    await client.post("/api/v1/groups/", json={"group_id": "reviewers"})
+    await client.put("/api/v1/groups/reviewers/members/eve")
+    await client.put("/api/v1/groups/reviewers/grants", json={"resource_type": "doc", "resource_id": "d2", "access_level": "admin"})
+
+    async def lookup(path, body):
+        response = await client.post(f"{api}/lookup/{path}", json=body)
+        assert response.status_code == 200 and response.headers["content-type"] == "application/x-ndjson"
+        return [tuple(json.loads(line).values()) for line in response.text.splitlines()]
+
+    # Direct, inherited, wildcard and group grants; inactive ones are left out
+    assert await lookup("users", {"resource_type": "doc", "resource_ids": ["d1", "d2", "d3"]}) == [
+        ("d1", "ana", "read"), ("d1", "ben", "write"), ("d1", "cara", "read"),
+        ("d2", "cara", "read"), ("d2", "eve", "admin"),
+        ("d3", "cara", "read"),
+    ]
+    among = {"resource_type": "doc", "resource_ids": ["d1", "d2"], "user_ids": ["ana", "eve", "dan"]}
+    assert await lookup("users", among) == [("d1", "ana", "read"), ("d2", "eve", "admin")]
+
+    hits = {"resource_type": "doc", "resource_ids": ["d1", "d2", "d9"]}
+    assert await lookup("resources", {**hits, "user_id": "ben"}) == [("d1", "write")]
+    assert await lookup("resources", {**hits, "user_id": "cara"}) == [("d1", "read"), ("d2", "read"), ("d9", "read")]
+    assert await lookup("resources", {"user_id": "ben", "resource_type": "doc"}) == [("d1", "write")]
+    assert await lookup("resources", {"user_id": "cara", "resource_type": "doc"}) == [("*", "read")]
+    assert await lookup("resources", {"user_id": "dan", "resource_type": "doc"}) == []
+
+    monkeypatch.setattr(crud, "LOOKUP_MAX_IDS", 2)
+    assert (await client.post(f"{api}/lookup/users", json={"resource_type": "doc", "resource_ids": ["d1", "d2", "d3"]})).status_code == 413
+    assert (await client.post(f"{api}/lookup/resources", json={**hits, "user_id": "ben"})).status_code == 413
+    assert (await client.post(f"{api}/lookup/users", json={"resource_type": "doc", "resource_ids": []})).status_code == 422
+
+@pytest.mark.asyncio
+async def test_metrics(client: AsyncClient, db_session: AsyncSession):
+    metrics.instrument_engine(engine) # The app's engine is replaced by the test engine here
+    create_response = await client.post("/api/v1/entitlements/", json={"user_id": "metrics_user", "resource_type": "doc", "resource_id": "doc1"})
+    await client.get(f"/api/v1/entitlements/{create_response.json()['id']}")
+    await client.get(f"/api/v1/entitlements/{uuid4()}")
+
+    response = await client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    text = response.text
+    assert 'http_requests_total{method="GET",route="/api/v1/entitlements/{entitlement_id}",status="200"}' in text
+    assert 'http_requests_total{method="GET",route="/api/v1/entitlements/{entitlement_id}",status="404"}' in text
+    assert 'http_request_duration_seconds_bucket{method="POST",route="/api/v1/entitlements/",le="+Inf"}' in text
+    assert 'db_queries_total{route="/api/v1/entitlements/{entitlement_id}",operation="get_entitlement"}' in text
+    assert 'db_query_duration_seconds_count{route="/api/v1/entitlements/",operation="create_entitlement"}' in text
+    assert "decision_cache_hits" in text
+    assert "db_pool_checked_out" in text